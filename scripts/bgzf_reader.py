@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import gzip
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+    Multithreaded reader for BGZF (bgzipped) files.
+
+    A BGZF file is a series of independent gzip members of at most 64KB each, with the
+    compressed size of every member stored in its header. The reader walks the member
+    headers on the calling thread and inflates batches of members on a thread pool
+    (zlib releases the GIL while inflating), handing back the decompressed bytes in
+    file order. Plain gzip files fall back to the single threaded gzip module.
+
+    Usage:
+        with open_gzip("your.vcf.gz", threads=8) as fh:
+            for line in fh:
+                ...
+"""
+
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+
+
+def default_threads():
+    return min(8, os.cpu_count() or 1)
+
+
+def is_bgzf(fileobj):
+    """ True if a binary stream starts with a BGZF member, the stream position is left unchanged """
+    if hasattr(fileobj, "peek"):
+        head = fileobj.peek(18)[:18]
+    else:
+        pos = fileobj.tell()
+        head = fileobj.read(18)
+        fileobj.seek(pos)
+
+    # gzip header with FEXTRA set, and a 'BC' extra subfield of length 2
+    return len(head) >= 18 and head[:4] == BGZF_MAGIC and head[12:14] == b"BC" and head[14:16] == b"\x02\x00"
+
+
+def _inflate_blocks(blocks):
+    """ inflate a batch of raw deflate BGZF payloads, checking each CRC32 and size """
+    out = []
+    for cdata, crc, isize in blocks:
+        data = zlib.decompress(cdata, -15)
+        if len(data) != isize or zlib.crc32(data) != crc:
+            raise OSError("corrupt BGZF block: CRC32 or size mismatch")
+        out.append(data)
+    return b"".join(out)
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    Raw binary stream of the decompressed contents of a BGZF file object.
+
+    blocks_per_task members are inflated per thread pool task, and at most
+    max_pending (by default 2 * threads) tasks are in flight ahead of the reader.
+    Many readers open at once can share one executor, which they leave running.
+    """
+
+    def __init__(self, fileobj, threads=None, blocks_per_task=64, close_fileobj=False, executor=None, max_pending=None):
+        self._fileobj = fileobj
+        self._close_fileobj = close_fileobj
+        self._threads = threads or default_threads()
+        self._blocks_per_task = blocks_per_task
+        self._own_pool = executor is None
+        self._pool = ThreadPoolExecutor(max_workers=self._threads) if executor is None else executor
+        self._max_pending = max_pending or 2*self._threads
+        self._pending = deque()
+        self._buffer = memoryview(b"")
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def _read_block(self):
+        """ (cdata, crc32, isize) of the next BGZF member, or None at the end of the file """
+        header = self._fileobj.read(12)
+        if not header:
+            return None
+        if len(header) < 12 or header[:4] != BGZF_MAGIC:
+            raise OSError("not a BGZF block")
+
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = self._fileobj.read(xlen)
+
+        # walk the extra subfields for the BC subfield holding the block size - 1
+        bsize = None
+        offset = 0
+        while offset + 4 <= len(extra):
+            si = extra[offset:offset+2]
+            slen = struct.unpack("<H", extra[offset+2:offset+4])[0]
+            if si == b"BC" and slen == 2:
+                bsize = struct.unpack("<H", extra[offset+4:offset+6])[0]
+            offset += 4 + slen
+        if bsize is None:
+            raise OSError("BGZF block without a BC subfield")
+
+        rest = self._fileobj.read(bsize + 1 - 12 - xlen)
+        crc, isize = struct.unpack("<II", rest[-8:])
+        return rest[:-8], crc, isize
+
+    def _fill_queue(self):
+        while not self._eof and len(self._pending) < self._max_pending:
+            blocks = []
+            while len(blocks) < self._blocks_per_task:
+                block = self._read_block()
+                if block is None:
+                    self._eof = True
+                    break
+                blocks.append(block)
+            if blocks:
+                self._pending.append(self._pool.submit(_inflate_blocks, blocks))
+
+    def readinto(self, buffer):
+        while not self._buffer:
+            self._fill_queue()
+            if not self._pending:
+                return 0
+            self._buffer = memoryview(self._pending.popleft().result())
+
+        n = min(len(buffer), len(self._buffer))
+        buffer[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            if self._own_pool:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            else:
+                for future in self._pending:
+                    future.cancel()
+                self._pending.clear()
+            if self._close_fileobj:
+                self._fileobj.close()
+        super().close()
+
+
+def open_gzip(source, threads=None, buffer_size=1 << 20, executor=None, blocks_per_task=64, max_pending=None):
+    """
+    Binary stream of the decompressed contents of a gzip file path or binary file object.
+
+    BGZF inputs are inflated on a pool of threads (threads=1 keeps the gzip module),
+    or on a shared executor; plain gzip falls back to gzip.GzipFile.
+    """
+    close_fileobj = isinstance(source, (str, os.PathLike))
+    fileobj = open(source, "rb") if close_fileobj else source
+    if not hasattr(fileobj, "peek") and not fileobj.seekable():
+        fileobj = io.BufferedReader(fileobj)
+
+    if threads != 1 and is_bgzf(fileobj):
+        reader = BgzfReader(fileobj, threads, blocks_per_task, close_fileobj, executor, max_pending)
+        return io.BufferedReader(reader, buffer_size)
+
+    gz = gzip.GzipFile(fileobj=fileobj, mode="rb")
+    if close_fileobj:
+        # GzipFile does not close a file object it was handed
+        gz.myfileobj = fileobj
+    return gz
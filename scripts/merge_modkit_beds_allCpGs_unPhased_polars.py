@@ -2,12 +2,23 @@
 
 import pandas as pd
 import polars as pl
+import numpy as np
 import os
 import sys
 import gzip
-import gcsfs
+import io
+import shutil
+import json
+import heapq
+import multiprocessing
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import repeat
+from collections import Counter
 import argparse
+from prefetch import Prefetcher
+from object_cache import ObjectCache
+from bgzf_reader import open_gzip, default_threads
 
 
 """
@@ -58,21 +69,496 @@ def read_in_gslinks(tsvfile):
     log_time('done')
     return links
 
-def merge_beds(gslinks, outputdir, haplotype):
+# bedMethyl columns kept per sample, in output order
+VALUE_COLUMNS = ["validCov", "modFraction", "modReads"]
+KEY_COLUMNS = ["#chrom", "start", "end"]
+# CpG records are single base, end = start + 1, so sites are keyed by chrom and start
+# and end is only added back on output (see with_bed_keys)
+SITE_COLUMNS = ["#chrom", "start"]
+# compact storage dtypes: positions and read counts fit in uint32, fractions in float32
+BED_DTYPES = {"start": pl.UInt32, "end": pl.UInt32, "validCov": pl.UInt32, "modFraction": pl.Float32, "modReads": pl.UInt32}
+
+
+def gcs_filesystem():
+    """ GCS filesystem of the gcloud credentials, gcsfs is only imported when no other filesystem is given """
+    import gcsfs
+    return gcsfs.GCSFileSystem()
+
+
+def karyotype_key(chrom):
+    """ sort key putting chr1..chr22 in numeric order, then X, Y, M, then any other contig by name """
+    name = chrom[3:] if chrom.startswith("chr") else chrom
+    if name.isdigit():
+        return (0, int(name), "")
+    if name in ("X", "Y", "M", "MT"):
+        return (1, ["X", "Y", "M", "MT"].index(name), "")
+    return (2, 0, chrom)
+
+
+CHROM_ORDERS = {"karyotype": karyotype_key, "lexicographic": str}
+
+
+def with_bed_keys(frame):
+    """ decode the (#chrom, start) site key of a merged DataFrame or LazyFrame to the BED style #chrom, start, end columns """
+    return frame.with_columns((pl.col("start") + 1).alias("end")).select(KEY_COLUMNS + [pl.exclude(KEY_COLUMNS)])
+
+
+class RegionIndex:
     """
-    Function reads in each modkit bed and stores the valid coverage, 
-    number of reads with mods at each position and the modified fraction
-    column. The individual dataframes are merged together based on chromosomal 
-    position. Every 10 samples the dataframe is written to disk. 
+    Sorted, merged intervals of a BED file (plain or gzipped) per chromosome, answering
+    which CpG starts fall in a region with a binary search over the interval ends.
     """
 
-    log_time('Innitialize gcs sytem')
-    # initialize GCS FileSystem
-    fs = gcsfs.GCSFileSystem()
+    def __init__(self, bed_path):
+        intervals = {}
+        opener = gzip.open if bed_path.endswith(".gz") else open
+        with opener(bed_path, "rt") as f:
+            for line in f:
+                if not line.strip() or line.startswith(("#", "track", "browser")):
+                    continue
+                fields = line.split("\t")
+                intervals.setdefault(fields[0], []).append((int(fields[1]), int(fields[2])))
+
+        self.starts = {}
+        self.ends = {}
+        for chrom, chrom_intervals in intervals.items():
+            merged = []
+            for start, end in sorted(chrom_intervals):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            merged = np.array(merged, dtype=np.int64)
+            self.starts[chrom] = merged[:, 0]
+            self.ends[chrom] = merged[:, 1]
+
+    @property
+    def chroms(self):
+        return set(self.starts)
+
+    def contains(self, chrom, positions):
+        """ boolean array of which positions on chrom fall in a region """
+        positions = np.asarray(positions, dtype=np.int64)
+        if chrom not in self.starts:
+            return np.zeros(len(positions), dtype=bool)
+        starts, ends = self.starts[chrom], self.ends[chrom]
+        # the first interval ending after each position is the only one that can hold it
+        i = np.searchsorted(ends, positions, side="right")
+        inside = i < len(ends)
+        inside[inside] = starts[i[inside]] <= positions[inside]
+        return inside
+
+
+class SiteFilter:
+    """ CpGs kept at ingest: on chroms, inside the intervals of a regions BED and with at least min_valid_cov valid coverage """
+
+    def __init__(self, chroms=None, regions=None, min_valid_cov=None):
+        self.chroms = set(chroms) if chroms else None
+        self.regions_path = regions
+        self.regions = RegionIndex(regions) if regions else None
+        self.min_valid_cov = min_valid_cov
+
+    def description(self):
+        """ JSON-able settings, recorded in the store so appends use the same filter """
+        return {"chroms": sorted(self.chroms) if self.chroms else None, "regions": self.regions_path, "min_valid_cov": self.min_valid_cov}
+
+    def apply(self, df):
+        if self.chroms is not None:
+            df = df.filter(pl.col("#chrom").is_in(list(self.chroms)))
+        if self.min_valid_cov:
+            df = df.filter(pl.col("validCov") >= self.min_valid_cov)
+        if self.regions is not None and df.height:
+            keep = np.zeros(df.height, dtype=bool)
+            chrom_column = df["#chrom"]
+            starts = df["start"].to_numpy()
+            for chrom in chrom_column.unique(maintain_order=True):
+                rows = (chrom_column == chrom).to_numpy()
+                keep[rows] = self.regions.contains(chrom, starts[rows])
+            df = df.filter(pl.Series(keep))
+        return df
+
+
+def read_bed_batches(stream, sample_name, batch_bytes=4 << 20, site_filter=None, mod_code="m"):
+    """
+    Read a decompressed binary bedMethyl stream in line aligned chunks of about batch_bytes,
+    yielding DataFrames of the CpG chrom and start and the sample's valid coverage, modified
+    fraction and modified read count (columns 0,1,9,10,11, column 2 is checked to be start + 1).
+    Only the rows of modification code mod_code (column 3) are kept, as modkit writes a row
+    per code (h and m) at every CpG; with mod_code None every row is kept and a CpG listed
+    twice is an error. A SiteFilter drops unwanted CpGs before they reach the merge.
+    """
+    tail = b""
+    last_site = None
+    while True:
+        chunk = stream.read(batch_bytes)
+        if chunk:
+            chunk = tail + chunk
+            cut = chunk.rfind(b"\n") + 1
+            if cut == 0:
+                tail = chunk
+                continue
+            data, tail = chunk[:cut], chunk[cut:]
+        else:
+            data, tail = tail, b""
+        if data.strip():
+            df = pl.read_csv(
+                io.BytesIO(data),
+                separator="\t",
+                has_header=False,
+                columns=[0, 1, 2, 3, 9, 10, 11],
+                new_columns=KEY_COLUMNS + ["modCode"] + VALUE_COLUMNS,
+            )
+            df = df.cast(BED_DTYPES)
+            if not (df["end"] - df["start"] == 1).all():
+                raise ValueError(f"{sample_name} has records longer than one base, expected CpG bedMethyl records with end = start + 1")
+            if mod_code is not None:
+                df = df.filter(pl.col("modCode").cast(pl.String) == mod_code)
+            df = df.drop("modCode")
+            if df.height:
+                # rows of one CpG are next to each other, also across a chunk boundary
+                same_site = (pl.col("#chrom") == pl.col("#chrom").shift()) & (pl.col("start") == pl.col("start").shift())
+                repeated = df.filter(same_site.fill_null(False))
+                if last_site == (df["#chrom"][0], df["start"][0]):
+                    repeated = df.head(1)
+                if repeated.height:
+                    chrom, start = repeated["#chrom"][0], repeated["start"][0]
+                    raise ValueError(f"{sample_name} has several records at {chrom}:{start}, merge the rows of one modification code (mod_code)")
+                last_site = (df["#chrom"][-1], df["start"][-1])
+            if site_filter is not None:
+                df = site_filter.apply(df)
+            yield df.drop("end").rename({col: f"{sample_name}_{col}" for col in VALUE_COLUMNS})
+        if not chunk:
+            return
+
+
+class ContigOrder:
+    """
+    Contig order learned from the inputs of a merge, as modkit writes them in the order
+    of the BAM header rather than any fixed order. Every input moving from one contig to
+    the next records that the first comes before the second, and the merge goes on to
+    the pending contig no other pending contig is known to come before. Between contigs
+    no input has ordered yet it takes the one most inputs are on, as the others more
+    likely skipped it than listed it later, then the first by fallback_key.
+    """
+
+    def __init__(self, fallback_key):
+        self.fallback_key = fallback_key
+        self._next = {}
+
+    def record(self, previous, chrom):
+        self._next.setdefault(previous, set()).add(chrom)
+
+    def precedes(self, first, second):
+        """ True if some chain of inputs has first before second """
+        seen = set()
+        todo = [first]
+        while todo:
+            for chrom in self._next.get(todo.pop(), ()):
+                if chrom == second:
+                    return True
+                if chrom not in seen:
+                    seen.add(chrom)
+                    todo.append(chrom)
+        return False
+
+    def first(self, heads):
+        """ the contig to merge next of the head contigs of the inputs, one per input """
+        counts = Counter(heads)
+        # inputs that disagree on the order make a cycle, then only the counts and fallback order are left
+        unpreceded = [chrom for chrom in counts if not any(self.precedes(other, chrom) for other in counts if other != chrom)]
+        return min(unpreceded or counts, key=lambda chrom: (-counts[chrom], self.fallback_key(chrom)))
+
+
+def contig_merge_order(contig_runs, order):
+    """
+    The contigs in the order kway_merge takes them, from the chromosomes of the runs of
+    rows of every input in file order (see partition_bed), so a merge of partitioned
+    inputs lays out its store like the serial merge. Like kway_merge it records every
+    move of an input to its next contig in the ContigOrder as the input reaches it, and
+    skips the runs of contigs already taken, whose rows are merged in late.
+    """
+    positions = [0] * len(contig_runs)
+    taken = []
+
+    def step(i):
+        positions[i] += 1
+        runs = contig_runs[i]
+        if positions[i] < len(runs):
+            order.record(runs[positions[i] - 1], runs[positions[i]])
+
+    while True:
+        for i, runs in enumerate(contig_runs):
+            while positions[i] < len(runs) and runs[positions[i]] in taken:
+                step(i)
+        heads = [runs[positions[i]] for i, runs in enumerate(contig_runs) if positions[i] < len(runs)]
+        if not heads:
+            return taken
+        chrom = order.first(heads)
+        taken.append(chrom)
+        for i, runs in enumerate(contig_runs):
+            if positions[i] < len(runs) and runs[positions[i]] == chrom:
+                step(i)
+
+
+def sort_contig_runs(batch):
+    """ the batch with every run of rows on one contig sorted by start """
+    same_chrom = pl.col("#chrom") == pl.col("#chrom").shift()
+    if not batch.select(((pl.col("start").cast(pl.Int64).diff() < 0) & same_chrom).any()).item():
+        return batch
+    run = (~same_chrom).fill_null(True).cum_sum().alias("_run")
+    return batch.with_columns(run).sort(["_run", "start"], maintain_order=True).drop("_run")
+
+
+class SortedBedSource:
+    """
+    buffered batches of one input of the k-way merge, with starts sorted within each contig.
+    An input that fails to read ends there, with the exception kept as error.
+    """
+
+    def __init__(self, name, batches, order):
+        self.name = name
+        self._batches = batches
+        self._order = order
+        self._last_chrom = None
+        self._batch_rows = 0
+        self.buffer = None
+        self.error = None
+        self.refill()
+
+    def _next_batch(self):
+        """ the next batch, None once the input is exhausted or has failed """
+        if self.error is not None:
+            return None
+        try:
+            return next(self._batches, None)
+        except Exception as e:
+            log_time(f"Error reading {self.name}: {e}")
+            self.error = e
+            return None
+
+    def refill(self):
+        """ load the next batch once the buffer is used up, buffer is None when the input is exhausted """
+        while self.buffer is not None and self.buffer.height == 0 or self.buffer is None:
+            batch = self._next_batch()
+            if batch is None:
+                self.buffer = None
+                return
+            self.buffer = sort_contig_runs(batch)
+            self._batch_rows = max(self._batch_rows, batch.height)
+            if batch.height:
+                break
+        self._find_head()
+
+    def extend(self):
+        """
+        append the next batch to a buffer wholly on head_chrom that is down to less than a
+        batch, so it holds at most two; False if the buffer is full or the input exhausted
+        """
+        if self._head_rows < self.buffer.height or self.buffer.height >= self._batch_rows:
+            return False
+        batch = self._next_batch()
+        if batch is None:
+            return False
+        self._batch_rows = max(self._batch_rows, batch.height)
+        self.buffer = sort_contig_runs(pl.concat([self.buffer, batch]))
+        self._find_head()
+        return True
+
+    def _find_head(self):
+        """ contig of the first row of the buffer and the number of leading rows on it """
+        chroms = self.buffer["#chrom"]
+        self._head = chroms[0]
+        on_head = chroms == self._head
+        self._head_rows = self.buffer.height if on_head.all() else int(on_head.arg_min())
+        if self._head != self._last_chrom:
+            if self._last_chrom is not None:
+                self._order.record(self._last_chrom, self._head)
+            self._last_chrom = self._head
+
+    @property
+    def head_chrom(self):
+        return self._head
+
+    @property
+    def open_end(self):
+        """ last start of a buffer wholly on head_chrom, whose next batch may continue it, else None """
+        return self.buffer["start"][-1] if self._head_rows == self.buffer.height else None
+
+    def take(self, chrom, frontier):
+        """ remove and return the leading rows on chrom with start <= frontier """
+        n = self._head_rows if self._head == chrom else 0
+        if frontier is not None:
+            n = int(np.searchsorted(self.buffer["start"].head(n).to_numpy(), frontier, side="right"))
+        rows = self.buffer.head(n)
+        self.buffer = self.buffer.slice(n)
+        if self.buffer.height:
+            self._find_head()
+        else:
+            self.refill()
+        return rows
+
+
+def align_blocks(blocks, value_dtypes):
+    """
+    One row per start of the union of the blocks' starts, with the value columns of every
+    block scattered into the rows of its starts (null where no block has a value), a later
+    block overwriting the columns it shares with an earlier one.
+    """
+    block_starts = [block["start"].to_numpy() for block in blocks]
+    # a stable sort merges the sorted runs of the blocks in one pass
+    starts = np.sort(np.concatenate(block_starts), kind="stable")
+    starts = starts[np.concatenate([[True], starts[1:] != starts[:-1]])]
+
+    # every column as its values and a mask of the rows holding one, shared by the columns of a block
+    columns = {}
+    for block, block_start in zip(blocks, block_starts):
+        rows = np.searchsorted(starts, block_start)
+        in_block = np.zeros(len(starts), dtype=bool)
+        in_block[rows] = True
+        for col in block.columns:
+            if col not in value_dtypes:
+                continue
+            column = block[col]
+            if col not in columns and not column.null_count():
+                data = np.zeros(len(starts), dtype=column.to_numpy().dtype)
+                data[rows] = column.to_numpy()
+                columns[col] = (data, in_block)
+                continue
+            # a column with missing values of its own (from a sparse store), or written by several blocks
+            observed = column.drop_nulls().to_numpy()
+            if col in columns:
+                data, present = columns[col][0], columns[col][1].copy()
+            else:
+                data, present = np.zeros(len(starts), dtype=observed.dtype), np.zeros(len(starts), dtype=bool)
+            observed_rows = rows[column.is_not_null().to_numpy()]
+            data[observed_rows] = observed
+            present[observed_rows] = True
+            columns[col] = (data, present)
+
+    frame = {"start": starts}
+    masks = {}
+    selected = ["start"]
+    for col, dtype in value_dtypes.items():
+        if col not in columns:
+            selected.append(pl.lit(None, dtype=dtype).alias(col))
+            continue
+        data, present = columns[col]
+        mask = masks.setdefault(id(present), f"_present{len(masks)}")
+        frame[mask] = present
+        frame[col] = data
+        selected.append(pl.when(pl.col(mask)).then(pl.col(col)).alias(col))
+    return pl.DataFrame(frame).select(selected)
+
+
+def kway_merge(sources, order, sample_names=None, late=None):
+    """
+    Streaming k-way merge of bedMethyl sources sorted by start within each contig,
+    yielding DataFrames with one row per CpG (#chrom and start) and the value columns of
+    every source (null where a source has no data). Every block is on a single contig,
+    so sources are aligned on their integer start alone, and contigs follow the
+    ContigOrder learned from the sources.
+
+    Each step merges the current contig up to the smallest last start among the sources
+    whose buffer could still continue it, so every CpG is emitted once with all of its
+    samples. The source setting that frontier is first topped up with its next batch,
+    so a step covers about a batch of every source whatever their number, and memory
+    is bounded by two batches per source.
+
+    Rows a source has after the merge has passed them, on a contig already finished or
+    at a start already emitted because the source disagrees with the others on the
+    contig order, are handed to late(sample_name, chrom, rows) to be merged in
+    afterwards (see merge_late) instead of stopping the merge.
+
+    sample_names sets the value columns of the output, by default those of the sources.
+    """
+    if sample_names is None:
+        sample_names = [source.name for source in sources]
+    value_dtypes = {f"{name}_{col}": BED_DTYPES[col] for name in sample_names for col in VALUE_COLUMNS}
+    sources = [source for source in sources if source.buffer is not None]
+    finished = set()
+    emitted = {}
+    chrom = None
+
+    def late_rows(source, chrom, rows):
+        if late is None:
+            raise ValueError(f"{source.name} is not coordinate sorted on {chrom}")
+        late(source.name, chrom, rows)
+
+    while sources:
+        for source in sources:
+            while source.buffer is not None and source.head_chrom in finished:
+                late_chrom = source.head_chrom
+                late_rows(source, late_chrom, source.take(late_chrom, None))
+        sources = [source for source in sources if source.buffer is not None]
+        if not sources:
+            break
+
+        heads = [source.head_chrom for source in sources]
+        if chrom not in heads:
+            if chrom is not None:
+                finished.add(chrom)
+            chrom = order.first(heads)
+        on_chrom = [source for source in sources if source.head_chrom == chrom]
+
+        # sources whose whole buffer is on chrom may have more of it in their next batch
+        open_ends = [(source.open_end, i) for i, source in enumerate(on_chrom) if source.open_end is not None]
+        heapq.heapify(open_ends)
+        while open_ends and on_chrom[open_ends[0][1]].extend():
+            i = open_ends[0][1]
+            if on_chrom[i].open_end is None:
+                heapq.heappop(open_ends)
+            else:
+                heapq.heapreplace(open_ends, (on_chrom[i].open_end, i))
+        frontier = open_ends[0][0] if open_ends else None
+
+        blocks = []
+        for source in on_chrom:
+            rows = source.take(chrom, frontier)
+            if chrom in emitted and rows.height and rows["start"][0] <= emitted[chrom]:
+                late_rows(source, chrom, rows.filter(pl.col("start") <= emitted[chrom]).with_columns(pl.lit(chrom).alias("#chrom")))
+                rows = rows.filter(pl.col("start") > emitted[chrom])
+            if rows.height:
+                blocks.append(rows)
+
+        sources = [source for source in sources if source.buffer is not None]
+        if not blocks:
+            continue
+        merged = align_blocks(blocks, value_dtypes)
+        emitted[chrom] = merged["start"][-1]
+        yield merged.with_columns(pl.lit(chrom).alias("#chrom")).select(SITE_COLUMNS + list(value_dtypes))
 
-    # empty dataframe to fill with cpg data
-    combined_df = None
 
+class LateRows:
+    """
+    Rows the k-way merge received after it had passed them (see kway_merge), spilled to
+    spill_dir/<chrom>/<sample_name>/part-NNNNNN.parquet until merge_late adds them to the store.
+    """
+
+    def __init__(self, spill_dir):
+        self.spill_dir = spill_dir
+        self._parts = 0
+
+    def __call__(self, sample_name, chrom, rows):
+        if not rows.height:
+            return
+        part_dir = os.path.join(self.spill_dir, chrom, sample_name)
+        if not os.path.isdir(part_dir):
+            log_time(f"{sample_name} has CpGs on {chrom} after the merge passed them (contigs in a different order?), merging them in afterwards")
+            os.makedirs(part_dir)
+        rows.select(SITE_COLUMNS + [pl.exclude(SITE_COLUMNS)]).write_parquet(os.path.join(part_dir, f"part-{self._parts:06d}.parquet"))
+        self._parts += 1
+
+    def chroms(self):
+        return sorted(os.listdir(self.spill_dir)) if os.path.isdir(self.spill_dir) else []
+
+    def sample_rows(self, chrom):
+        """ {sample_name: all of its late rows on chrom, sorted by start} """
+        chrom_dir = os.path.join(self.spill_dir, chrom)
+        return {name: pl.read_parquet(os.path.join(chrom_dir, name, "*.parquet")).sort("start") for name in sorted(os.listdir(chrom_dir))}
+
+
+def valid_inputs(gslinks):
+    """ (link, sample name) of every usable entry of the link list """
     for i, file in enumerate(gslinks, 1):
 
         print("file", file)
@@ -81,61 +567,622 @@ def merge_beds(gslinks, outputdir, haplotype):
             log_time(f"Invalid file entry at line {i}. Skipping...")
             continue
 
-        sample_name = file.split("/")[-1].replace(".bed.gz", "")
-        log_time(f"Processing file: {sample_name}")
+        yield file, file.split("/")[-1].replace(".bed.gz", "")
+
+
+def write_merged(merged_blocks, store_dir, chrom_dir_index):
+    """
+    Write merged blocks to a parquet store, filling samples without data at a CpG with 0.
+
+    Each block becomes store_dir/<NNNN>_<chrom>/part-NNNNNN.parquet where NNNN is
+    chrom_dir_index(chrom), so the store's file paths sort in chromosome order.
+    """
+    last_chrom = None
+    for merged in merged_blocks:
+        chrom = merged["#chrom"][0]
+        if chrom != last_chrom:
+            log_time(f"Merging {chrom}")
+            chrom_dir = os.path.join(store_dir, f"{chrom_dir_index(chrom):04d}_{chrom}")
+            os.makedirs(chrom_dir, exist_ok=True)
+            n = len(os.listdir(chrom_dir))
+            last_chrom = chrom
+        merged.fill_null(0).write_parquet(os.path.join(chrom_dir, f"part-{n:06d}.parquet"))
+        n += 1
+
+
+def sparse_block(merged, sample_names, first_site):
+    """
+    Split a merged block into its site table (site_index and coordinates) and COO cells,
+    one row of (site_index, sample_index, values) per sample observed at a site, in
+    site then sample order. site_index counts from first_site within the chromosome.
+    """
+    site_index = pl.int_range(first_site, first_site + merged.height, dtype=pl.UInt32, eager=True).alias("site_index")
+    merged = merged.with_columns(site_index)
+    sites = merged.select(["site_index"] + SITE_COLUMNS)
+
+    cells = []
+    for i, name in enumerate(sample_names):
+        columns = [f"{name}_{col}" for col in VALUE_COLUMNS]
+        observed = merged.select(["site_index"] + columns).filter(pl.col(columns[0]).is_not_null())
+        observed = observed.rename(dict(zip(columns, VALUE_COLUMNS)))
+        cells.append(observed.with_columns(pl.lit(i, dtype=pl.UInt32).alias("sample_index")))
+    cells = pl.concat(cells).select(["site_index", "sample_index"] + VALUE_COLUMNS).sort(["site_index", "sample_index"])
+
+    return sites, cells
+
+
+def write_sparse(merged_blocks, store_dir, chrom_dir_index, sample_names):
+    """
+    Write merged blocks to a sparse store: store_dir/sites/<NNNN>_<chrom>/part-NNNNNN.parquet
+    holds the CpGs and store_dir/cells/<NNNN>_<chrom>/part-NNNNNN.parquet the observed
+    (site_index, sample_index) cells, with store_dir/samples.tsv naming the sample indexes.
+    Samples without data at a CpG are left out instead of written as 0.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    samples_path = os.path.join(store_dir, "samples.tsv")
+    if not os.path.exists(samples_path):
+        # chromosome workers may race to write it, each writes its own copy and renames it in place
+        tmp_path = f"{samples_path}.{os.getpid()}"
+        pl.DataFrame({"sample_index": range(len(sample_names)), "sample_name": sample_names}).write_csv(tmp_path, separator="\t")
+        os.replace(tmp_path, samples_path)
+
+    last_chrom = None
+    for merged in merged_blocks:
+        chrom = merged["#chrom"][0]
+        if chrom != last_chrom:
+            log_time(f"Merging {chrom}")
+            chrom_dir = f"{chrom_dir_index(chrom):04d}_{chrom}"
+            for table in ("sites", "cells"):
+                os.makedirs(os.path.join(store_dir, table, chrom_dir), exist_ok=True)
+            n = 0
+            first_site = 0
+            last_chrom = chrom
+        sites, cells = sparse_block(merged, sample_names, first_site)
+        part = f"part-{n:06d}.parquet"
+        sites.write_parquet(os.path.join(store_dir, "sites", chrom_dir, part))
+        cells.write_parquet(os.path.join(store_dir, "cells", chrom_dir, part))
+        first_site += sites.height
+        n += 1
+
+
+def store_chrom_dirs(store_dir, sparse=False):
+    """ {chrom: partition directory name} of a dense or sparse store, in chromosome order """
+    table_dir = os.path.join(store_dir, "sites") if sparse else store_dir
+    names = sorted(name for name in os.listdir(table_dir) if os.path.isdir(os.path.join(table_dir, name)))
+    return {name.split("_", 1)[1]: name for name in names}
+
+
+def read_sample_names(store_dir):
+    return pl.read_csv(os.path.join(store_dir, "samples.tsv"), separator="\t")["sample_name"].to_list()
+
+
+def dense_cells(sites, cells, sample_names, sample_indexes):
+    """ join sparse cells back onto their sites as per sample value columns, null where a sample was not observed """
+    dense = sites
+    for name, i in zip(sample_names, sample_indexes):
+        columns = cells.filter(pl.col("sample_index") == i).drop("sample_index")
+        columns = columns.rename({col: f"{name}_{col}" for col in VALUE_COLUMNS})
+        dense = dense.join(columns, on="site_index", how="left")
+    return dense.sort("site_index").drop("site_index")
+
+
+def densify(store_dir, chrom, start=None, end=None, samples=None):
+    """
+    Dense table (#chrom, start, end and the value columns of every sample) of the CpGs
+    of a sparse store on chrom overlapping [start, end), for all samples or the listed
+    sample names. Cells that were not observed are null, use fill_null(0) for the
+    layout of the dense output.
+    """
+    all_samples = read_sample_names(store_dir)
+    samples = all_samples if samples is None else list(samples)
+    sample_indexes = [all_samples.index(name) for name in samples]
+
+    chrom_dir = store_chrom_dirs(store_dir, sparse=True).get(chrom)
+    if chrom_dir is None:
+        raise KeyError(f"{chrom} is not in {store_dir}")
+
+    sites = pl.scan_parquet(os.path.join(store_dir, "sites", chrom_dir, "*.parquet"))
+    if start is not None:
+        sites = sites.filter(pl.col("start") >= start)
+    if end is not None:
+        sites = sites.filter(pl.col("start") < end)
+    sites = sites.collect()
+
+    # sites are numbered in position order, so the slice is a contiguous site_index range
+    in_slice = pl.col("site_index").is_between(sites["site_index"].min(), sites["site_index"].max()) if sites.height else pl.lit(False)
+    cells = (
+        pl.scan_parquet(os.path.join(store_dir, "cells", chrom_dir, "*.parquet"))
+        .filter(in_slice & pl.col("sample_index").is_in(sample_indexes))
+        .collect()
+    )
+    return with_bed_keys(dense_cells(sites, cells, samples, sample_indexes))
+
+
+def write_sparse_tsv(store_dir, out_path):
+    """ write the dense, 0 filled TSV of a sparse store one part at a time """
+    sample_names = read_sample_names(store_dir)
+    header = KEY_COLUMNS + [f"{name}_{col}" for name in sample_names for col in VALUE_COLUMNS]
+    with open(out_path, "w") as out:
+        out.write("\t".join(header) + "\n")
+        for chrom_dir in store_chrom_dirs(store_dir, sparse=True).values():
+            for part in sorted(os.listdir(os.path.join(store_dir, "sites", chrom_dir))):
+                sites = pl.read_parquet(os.path.join(store_dir, "sites", chrom_dir, part))
+                cells = pl.read_parquet(os.path.join(store_dir, "cells", chrom_dir, part))
+                dense = dense_cells(sites, cells, sample_names, range(len(sample_names)))
+                with_bed_keys(dense).fill_null(0).write_csv(out, separator="\t", include_header=False)
+
+
+def scan_store(store_dir):
+    """ LazyFrame over a merged parquet store with BED style keys, in chromosome then position order """
+    return with_bed_keys(pl.scan_parquet(os.path.join(store_dir, "*", "*.parquet")))
+
+
+def store_path(outputdir, haplotype, sparse=False):
+    return f'{outputdir}/combined_methylation_{haplotype}.{"sparse" if sparse else "parquet"}'
+
+
+def write_store(merged_blocks, store_dir, chrom_dir_index, sample_names, sparse=False):
+    if sparse:
+        write_sparse(merged_blocks, store_dir, chrom_dir_index, sample_names)
+    else:
+        write_merged(merged_blocks, store_dir, chrom_dir_index)
+
+
+def finish_outputs(store_dir, outputdir, haplotype, output_format, sparse=False, keep_store=False):
+    """ stream the parquet store out to the TSV when one was requested, dropping the store for tsv only output unless keep_store """
+    if output_format in ("tsv", "both"):
+        log_time('making output tsv')
+        tsv_path = f'{outputdir}/combined_methylation_{haplotype}.tsv'
+        if sparse:
+            write_sparse_tsv(store_dir, tsv_path)
+        else:
+            scan_store(store_dir).sink_csv(tsv_path, separator="\t")
+    if output_format == "tsv" and not keep_store:
+        shutil.rmtree(store_dir)
+
+
+def merge_beds(gslinks, outputdir, haplotype, batch_mb=4, chrom_order="karyotype", workers=1, output_format="parquet", sparse=False, prefetch=0, retries=5, cache_dir=None, cache_max_gb=None, append=False, append_batch=10, site_filter=None, decode_threads=None, fs=None, mod_code="m"):
+    """
+    Function streams every modkit bed and keeps the valid coverage, number of
+    reads with mods at each position and the modified fraction column. The
+    coordinate sorted inputs are k-way merged on chromosomal position in a
+    single pass, writing the merged rows as they are completed, so memory
+    is bounded by two batch_mb batches of each input instead of the whole
+    cohort table.
+    Contigs are taken in the order the inputs list them, and rows an input
+    has out of that order are merged in at the end (see kway_merge).
+
+    The merged table is written to a parquet store partitioned by chromosome,
+    combined_methylation_<haplotype>.parquet/, with uint32 coverage and read
+    counts and float32 fractions. output_format "tsv" or "both" also streams
+    it out to combined_methylation_<haplotype>.tsv.
+
+    With sparse the store is combined_methylation_<haplotype>.sparse/ instead,
+    holding only the observed (CpG, sample) cells (see write_sparse and densify),
+    so 0 coverage stays distinct from a sample without data at the CpG.
+
+    With prefetch > 0 every input is downloaded in pieces up to prefetch
+    ahead of the merge to a local spool on a thread pool, retrying transient
+    errors retries times, instead of being streamed from GCS as it is parsed
+    (with workers > 1 whole inputs are downloaded up to prefetch ahead of
+    their partitioning).
+
+    With a cache_dir inputs are read through an ObjectCache capped at
+    cache_max_gb, so a rerun downloads only new or changed objects: cached
+    inputs are read from the cache and missing ones are added to it as they
+    are read, as long as they fit in the cap.
+
+    With append the samples not yet in an existing store are merged into it
+    append_batch at a time (see append_samples), and a rerun after a crash
+    resumes after the last completed batch.
+
+    Bgzipped inputs are inflated on decode_threads threads (plain gzip inputs
+    are read with the gzip module), see bgzf_reader.py.
+
+    A SiteFilter keeps only the CpGs on its chromosomes, in its regions and
+    above its minimum valid coverage, dropping the rest as each input is read.
+    Only the rows of modification code mod_code are merged (see read_bed_batches).
+
+    Inputs are read through the fsspec filesystem fs, GCS by default.
+
+    With workers > 1 the inputs are partitioned by chromosome and every
+    chromosome is merged in its own process (see merge_beds_by_chrom).
+    """
+
+    inputs = list(valid_inputs(gslinks))
+    store_dir = store_path(outputdir, haplotype, sparse)
+    decode_threads = decode_threads or default_threads()
+    fs = gcs_filesystem() if fs is None else fs
+    cache = open_cache(fs, cache_dir, cache_max_gb)
+
+    def merge(batch_inputs, out_store, base_store=None, base_samples=()):
+        if workers > 1:
+            return merge_beds_by_chrom(batch_inputs, out_store, outputdir, haplotype, batch_mb, chrom_order, workers, sparse, prefetch, retries, cache, base_store, base_samples, site_filter, decode_threads, fs, mod_code)
+        return merge_serial(batch_inputs, out_store, outputdir, haplotype, batch_mb, chrom_order, sparse, prefetch, retries, cache, base_store, base_samples, site_filter, decode_threads, fs, mod_code)
+
+    settings = {"sparse": sparse, "chrom_order": chrom_order, "filter": site_filter.description() if site_filter else None, "mod_code": mod_code}
+    if append:
+        append_samples(inputs, store_dir, merge, settings, append_batch)
+    else:
+        shutil.rmtree(store_dir, ignore_errors=True)
+        sample_names = merge(inputs, store_dir)
+        write_state(store_dir, dict(settings, samples=sample_names))
+
+    if cache is not None:
+        log_time(cache.summary())
+
+    # an append store is kept for the next append
+    finish_outputs(store_dir, outputdir, haplotype, output_format, sparse, keep_store=append)
+
+    log_time('done')
+
+
+def write_state(store_dir, state):
+    """ record the layout and merged samples of a store in store_dir/merge_state.json """
+    os.makedirs(store_dir, exist_ok=True)
+    tmp_path = os.path.join(store_dir, "merge_state.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_path, os.path.join(store_dir, "merge_state.json"))
+
+
+def read_state(store_dir):
+    """ the merge_state.json of a store, or None if there is no completed store """
+    path = os.path.join(store_dir, "merge_state.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def swap_store(next_dir, store_dir):
+    """ replace store_dir with next_dir, the previous store is kept as store_dir.prev until the new one is in place """
+    prev_dir = store_dir + ".prev"
+    if os.path.exists(store_dir):
+        os.rename(store_dir, prev_dir)
+    os.rename(next_dir, store_dir)
+    shutil.rmtree(prev_dir, ignore_errors=True)
+
+
+def append_samples(inputs, store_dir, merge, settings, append_batch=10):
+    """
+    Merge the inputs whose samples are not yet in the store at store_dir into it,
+    append_batch samples at a time. Every batch is k-way merged with the existing
+    store as one more source into store_dir.next, which then replaces the store, so
+    the old inputs are never re-read: new CpGs are added, existing samples are
+    filled at them (with 0 in a dense store) and the new samples are filled at the
+    existing CpGs. The store's merge_state.json lists the merged samples, so a rerun
+    of an interrupted append skips the batches already completed.
+
+    merge(inputs, out_store, base_store, base_samples) merges one batch and returns
+    the names of the samples it could read. settings (layout, chromosome order and
+    site filter) must match those the store was merged with.
+    """
+    # a crash between the two renames of swap_store leaves only the previous store
+    if not os.path.exists(store_dir) and os.path.exists(store_dir + ".prev"):
+        os.rename(store_dir + ".prev", store_dir)
+    shutil.rmtree(store_dir + ".next", ignore_errors=True)
+
+    state = read_state(store_dir)
+    if state is None:
+        shutil.rmtree(store_dir, ignore_errors=True)
+        state = dict(settings, samples=[])
+    elif any(state.get(key) != value for key, value in settings.items()):
+        merged_with = {key: state.get(key) for key in settings}
+        raise ValueError(f"{store_dir} was merged with {merged_with}, not {settings}")
+
+    merged = set(state["samples"])
+    todo = [(file, sample_name) for file, sample_name in inputs if sample_name not in merged]
+    log_time(f"{len(inputs) - len(todo)} samples already merged in {store_dir}, appending {len(todo)}")
+
+    for i in range(0, len(todo), append_batch):
+        batch = todo[i:i + append_batch]
+        next_dir = store_dir + ".next"
+        base_store = store_dir if state["samples"] else None
+        added = merge(batch, next_dir, base_store, state["samples"])
+        if not added:
+            shutil.rmtree(next_dir, ignore_errors=True)
+            continue
+
+        state = dict(state, samples=state["samples"] + added)
+        write_state(next_dir, state)
+        swap_store(next_dir, store_dir)
+        log_time(f"Appended {len(added)} samples, {len(state['samples'])} samples in {store_dir}")
+
+
+def store_batches(store_dir, sparse, sample_names, chrom_dir=None):
+    """ dense merged blocks of a store in chromosome and position order, of every chromosome or one partition """
+    chrom_dirs = [chrom_dir] if chrom_dir is not None else list(store_chrom_dirs(store_dir, sparse).values())
+    for chrom_dir in chrom_dirs:
+        if sparse:
+            for part in sorted(os.listdir(os.path.join(store_dir, "sites", chrom_dir))):
+                sites = pl.read_parquet(os.path.join(store_dir, "sites", chrom_dir, part)).drop("end", strict=False)
+                cells = pl.read_parquet(os.path.join(store_dir, "cells", chrom_dir, part))
+                yield dense_cells(sites, cells, sample_names, range(len(sample_names)))
+        else:
+            for part in sorted(os.listdir(os.path.join(store_dir, chrom_dir))):
+                # stores written before sites were keyed by start alone carry an end column
+                yield pl.read_parquet(os.path.join(store_dir, chrom_dir, part)).drop("end", strict=False)
+
+
+def merge_late(late, store_dir, sparse, sample_names, order, chrom_dir_index):
+    """
+    Merge the LateRows of a k-way merge into the store: the partition of every contig
+    with late rows is merged again with each sample's late rows as one more source,
+    which fill in that sample's values (0 or missing in the partition) at those CpGs.
+    """
+    for chrom in late.chroms():
+        log_time(f"Merging late rows on {chrom}")
+        index = chrom_dir_index(chrom)
+        chrom_dir = f"{index:04d}_{chrom}"
+        sources = []
+        if chrom in store_chrom_dirs(store_dir, sparse):
+            sources.append(SortedBedSource(store_dir, store_batches(store_dir, sparse, sample_names, chrom_dir), order))
+        for sample_name, rows in late.sample_rows(chrom).items():
+            sources.append(SortedBedSource(sample_name, iter([rows]), order))
+
+        merged_dir = os.path.join(f"{late.spill_dir}.merged", chrom)
+        write_store(kway_merge(sources, order, sample_names), merged_dir, lambda _: index, sample_names, sparse)
+        for table in (["sites", "cells"] if sparse else [""]):
+            shutil.rmtree(os.path.join(store_dir, table, chrom_dir), ignore_errors=True)
+            os.makedirs(os.path.join(store_dir, table), exist_ok=True)
+            os.rename(os.path.join(merged_dir, table, chrom_dir), os.path.join(store_dir, table, chrom_dir))
+        shutil.rmtree(merged_dir)
+
+    shutil.rmtree(late.spill_dir, ignore_errors=True)
+    shutil.rmtree(f"{late.spill_dir}.merged", ignore_errors=True)
+
+
+def drop_samples(store_dir, sparse, sample_names, dropped):
+    """
+    Remove the value columns (dense) or cells (sparse) of the dropped samples from a
+    store of sample_names, renumbering the sample indexes of a sparse store. CpGs only
+    the dropped samples had stay in the store without data.
+    """
+    kept = [name for name in sample_names if name not in dropped]
+    if sparse:
+        new_index = {sample_names.index(name): i for i, name in enumerate(kept)}
+        for chrom_dir in store_chrom_dirs(store_dir, sparse).values():
+            cells_dir = os.path.join(store_dir, "cells", chrom_dir)
+            for part in sorted(os.listdir(cells_dir)):
+                path = os.path.join(cells_dir, part)
+                cells = pl.read_parquet(path).filter(pl.col("sample_index").is_in(list(new_index)))
+                cells.with_columns(pl.col("sample_index").replace_strict(new_index, return_dtype=pl.UInt32)).write_parquet(path)
+        pl.DataFrame({"sample_index": range(len(kept)), "sample_name": kept}).write_csv(os.path.join(store_dir, "samples.tsv"), separator="\t")
+    else:
+        columns = [f"{name}_{col}" for name in dropped for col in VALUE_COLUMNS]
+        for chrom_dir in store_chrom_dirs(store_dir).values():
+            for part in sorted(os.listdir(os.path.join(store_dir, chrom_dir))):
+                path = os.path.join(store_dir, chrom_dir, part)
+                pl.read_parquet(path).drop(columns).write_parquet(path)
+
+
+def merge_serial(inputs, store_dir, outputdir, haplotype, batch_mb=4, chrom_order="karyotype", sparse=False, prefetch=0, retries=5, cache=None, base_store=None, base_samples=(), site_filter=None, decode_threads=None, fs=None, mod_code="m"):
+    """
+    Single process k-way merge of the inputs, and of the merged store base_store
+    holding base_samples if given, into store_dir. Returns the input samples merged.
+    An input that cannot be opened or fails part way through is left out of the store.
+
+    Every input is open for the whole merge, so bgzipped inputs share one pool of
+    decode_threads inflate threads and keep only two 1MB inflate tasks in flight each.
+    With prefetch or a cache they are opened as Prefetcher streams, so the spool
+    holds only the next prefetch pieces of each input and drops every piece once
+    read, and a cache only gains each missing input as it is read.
+    """
+
+    log_time('Innitialize gcs sytem')
+    # initialize GCS FileSystem
+    if fs is None:
+        fs = gcs_filesystem() if cache is None else cache.fs
+    order = ContigOrder(CHROM_ORDERS[chrom_order])
+
+    sources = []
+    open_files = []
+    prefetch_dir = os.path.join(outputdir, f"prefetch_{haplotype}")
+    prefetcher = Prefetcher(fs, depth=max(prefetch, 1), spool_dir=prefetch_dir, retries=retries, cache=cache) if prefetch or cache is not None else None
+    inflate_pool = ThreadPoolExecutor(max_workers=decode_threads or default_threads())
+
+    for file, sample_name in inputs:
+
+        log_time(f"Opening file: {sample_name}")
 
         try:
-            # open GCS file and stream through gzip
-            with fs.open(file, "rb") as f:
-                with gzip.open(f, "rt") as gz_file:
-                    df = pl.read_csv(
-                        gz_file,
-                        separator="\t",
-                        has_header=False,
-                        columns=[0, 1, 2, 9, 10, 11],
-                        new_columns=[
-                            "#chrom",
-                            "start",
-                            "end",
-                            f"{sample_name}_validCov",
-                            f"{sample_name}_modFraction",
-                            f"{sample_name}_modReads",
-                        ],
-                    )
+            if prefetcher is not None:
+                f = prefetcher.open(file)
+            else:
+                # open GCS file and stream through gzip
+                f = fs.open(file, "rb")
+            # reading the first batch surfaces read errors here
+            gz_file = open_gzip(f, executor=inflate_pool, blocks_per_task=16, max_pending=2)
+            open_files.extend([gz_file, f])
+            batches = read_bed_batches(gz_file, sample_name, int(batch_mb * (1 << 20)), site_filter, mod_code)
+            source = SortedBedSource(sample_name, batches, order)
+            if source.error is not None:
+                raise source.error
+            sources.append(source)
 
         except Exception as e:
             log_time(f"Error reading {sample_name}: {e}")
             log_time("Make sure you authenticated with gcloud")
             continue
 
-        # outer merge on genomic coordinates
-        if combined_df is None:
-            combined_df = df
+    input_sources = list(sources)
+    merged_samples = [source.name for source in sources]
+    sample_names = list(base_samples) + merged_samples
+    if base_store is not None and not merged_samples:
+        # nothing to add to the store
+        return merged_samples
+    if base_store is not None:
+        sources.insert(0, SortedBedSource(base_store, store_batches(base_store, sparse, base_samples), order))
+
+    log_time(f'Merging {len(sample_names)} samples')
+    # save the combined data as each merged block is completed, chromosomes come out in the inputs' order
+    chrom_index = {}
+    chrom_dir_index = lambda chrom: chrom_index.setdefault(chrom, len(chrom_index))
+    late = LateRows(os.path.join(outputdir, f"late_{haplotype}"))
+    write_store(kway_merge(sources, order, sample_names, late), store_dir, chrom_dir_index, sample_names, sparse)
+    merge_late(late, store_dir, sparse, sample_names, order, chrom_dir_index)
+
+    if base_store is not None and sources[0].error is not None:
+        raise sources[0].error
+    # an input that failed part way is dropped like one that could not be opened
+    failed = [source.name for source in input_sources if source.error is not None]
+    if failed:
+        log_time(f"Dropping {len(failed)} samples that could not be read to the end: {', '.join(failed)}")
+        drop_samples(store_dir, sparse, sample_names, failed)
+        merged_samples = [name for name in merged_samples if name not in failed]
+
+    for f in open_files:
+        f.close()
+    inflate_pool.shutdown()
+    if prefetcher is not None:
+        prefetcher.close()
+        shutil.rmtree(prefetch_dir, ignore_errors=True)
+
+    return merged_samples
+
+
+def partition_bed(file, sample_name, spool_dir, batch_bytes, local=False, site_filter=None, decode_threads=1, fs=None, mod_code="m"):
+    """
+    Split one bedMethyl into per chromosome parquet parts at
+    spool_dir/<chrom>/<sample_name>/part-NNNNNN.parquet, in file order.
+    A local (prefetched) file is removed once it has been read. A bgzipped
+    input is inflated on decode_threads threads.
+
+    Returns the runs of rows on one chromosome in file order as a list of their
+    chromosomes (see contig_merge_order), or None if the file could not be read.
+    """
+    chroms = []
+    try:
+        if local:
+            f = open(file, "rb")
         else:
-            combined_df = combined_df.join(
-                df,
-                on=["#chrom", "start", "end"],
-                how="outer",
-                coalesce=True,
-            )
+            f = (gcs_filesystem() if fs is None else fs).open(file, "rb")
+        with f, open_gzip(f, decode_threads) as gz_file:
+            for n, batch in enumerate(read_bed_batches(gz_file, sample_name, batch_bytes, site_filter, mod_code)):
+                for (chrom,), part in batch.partition_by("#chrom", as_dict=True, maintain_order=True).items():
+                    part_dir = os.path.join(spool_dir, chrom, sample_name)
+                    os.makedirs(part_dir, exist_ok=True)
+                    part.write_parquet(os.path.join(part_dir, f"part-{n:06d}.parquet"))
+                for chrom in batch["#chrom"].filter(batch["#chrom"].ne_missing(batch["#chrom"].shift())):
+                    if not chroms or chrom != chroms[-1]:
+                        chroms.append(chrom)
 
-        log_time(f"Completed {sample_name}")
+    except Exception as e:
+        log_time(f"Error reading {sample_name}: {e}")
+        log_time("Make sure you authenticated with gcloud")
+        return None
 
-        # checkpoint every 10 samples
-        # if i % 10 == 0:
-        #     log_time(f"writing out combined file with {i} samples")
-        #     combined_df.write_csv(
-        #         f"{outputdir}/combined_methylation_{haplotype}.tsv",
-        #         separator="\t"
-        #     )
+    finally:
+        if local:
+            os.remove(file)
 
-    log_time("Filling in zeros")
-    combined_df = combined_df.fill_null(0)
+    log_time(f"Partitioned {sample_name}")
+    return chroms
 
 
-    log_time('making output tsv')
-    # save the combined data to CSV
-    combined_df.write_csv(f'{outputdir}/combined_methylation_{haplotype}.tsv', separator="\t")
+def merge_chrom(spool_dir, chrom, chrom_index, sample_names, chrom_order, store_dir, sparse=False, base_store=None, base_samples=(), base_chrom_dir=None):
+    """ k-way merge the spooled parts of one chromosome, and its partition of base_store if any, into the parquet store """
+    order = ContigOrder(CHROM_ORDERS[chrom_order])
+
+    sources = []
+    if base_chrom_dir is not None:
+        sources.append(SortedBedSource(base_store, store_batches(base_store, sparse, base_samples, base_chrom_dir), order))
+    for sample_name in sample_names[len(base_samples):]:
+        part_dir = os.path.join(spool_dir, chrom, sample_name)
+        if not os.path.isdir(part_dir):
+            continue
+        parts = [os.path.join(part_dir, part) for part in sorted(os.listdir(part_dir))]
+        batches = map(pl.read_parquet, parts)
+        sources.append(SortedBedSource(sample_name, batches, order))
+
+    # a sample whose parts of the chromosome are not in position order has late rows
+    late = LateRows(os.path.join(spool_dir, f"{chrom}.late"))
+    write_store(kway_merge(sources, order, sample_names, late), store_dir, lambda _: chrom_index, sample_names, sparse)
+    merge_late(late, store_dir, sparse, sample_names, order, lambda _: chrom_index)
+
+
+def open_cache(fs, cache_dir, cache_max_gb):
+    """ ObjectCache of fs in cache_dir, or None without a cache_dir """
+    if cache_dir is None:
+        return None
+    max_bytes = None if cache_max_gb is None else int(cache_max_gb * (1 << 30))
+    return ObjectCache(fs, cache_dir, max_bytes)
+
+
+def prefetch_partitions(pool, inputs, spool_dir, prefetch_dir, batch_bytes, workers, prefetch, retries, cache=None, site_filter=None, decode_threads=1, fs=None, mod_code="m"):
+    """
+    Download the inputs up to prefetch ahead on a thread pool and partition each
+    local copy on the process pool as soon as it lands, keeping at most workers
+    partitions queued so the downloads stay a bounded distance ahead.
+    """
+    if fs is None:
+        fs = gcs_filesystem() if cache is None else cache.fs
+    futures = []
+    with Prefetcher(fs, [file for file, _ in inputs], prefetch, prefetch_dir, retries, cache=cache) as prefetcher:
+        for file, sample_name in inputs:
+            running = [future for future in futures if future is not None and not future.done()]
+            if len(running) >= workers:
+                wait(running, return_when=FIRST_COMPLETED)
+            try:
+                local_path = prefetcher.fetch(file)
+            except Exception as e:
+                log_time(f"Error reading {sample_name}: {e}")
+                log_time("Make sure you authenticated with gcloud")
+                futures.append(None)
+                continue
+            futures.append(pool.submit(partition_bed, local_path, sample_name, spool_dir, batch_bytes, True, site_filter, decode_threads, mod_code=mod_code))
+
+    return [future.result() if future is not None else None for future in futures]
+
+
+def merge_beds_by_chrom(inputs, store_dir, outputdir, haplotype, batch_mb=4, chrom_order="karyotype", workers=2, sparse=False, prefetch=0, retries=5, cache=None, base_store=None, base_samples=(), site_filter=None, decode_threads=None, fs=None, mod_code="m"):
+    """
+    Parallel merge: every input is partitioned by chromosome into a local parquet spool
+    (one sample per process), then every chromosome is k-way merged in its own process,
+    together with its partition of base_store if given, straight into its numbered
+    partition of the parquet store. Partitions are numbered in the contig order of the
+    serial merge (see contig_merge_order), so both write the same store. Peak memory is about one chromosome's worth
+    of merge per worker. Returns the input samples merged. The decode_threads are
+    split among the partitioning processes.
+    """
+
+    spool_dir = os.path.join(outputdir, f"spool_{haplotype}")
+    os.makedirs(spool_dir, exist_ok=True)
+
+    batch_bytes = int(batch_mb * (1 << 20))
+    threads_per_input = max(1, (decode_threads or default_threads()) // workers)
+
+    # forked workers can deadlock on the polars thread pool of the parent, start them fresh
+    mp_context = multiprocessing.get_context("spawn")
+
+    log_time(f"Partitioning {len(inputs)} samples by chromosome with {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+        if prefetch or cache is not None:
+            prefetch_dir = os.path.join(outputdir, f"prefetch_{haplotype}")
+            partitioned = prefetch_partitions(pool, inputs, spool_dir, prefetch_dir, batch_bytes, workers, max(prefetch, 1), retries, cache, site_filter, threads_per_input, fs, mod_code)
+            shutil.rmtree(prefetch_dir, ignore_errors=True)
+        else:
+            partitioned = list(pool.map(partition_bed, *zip(*inputs), repeat(spool_dir), repeat(batch_bytes), repeat(False), repeat(site_filter), repeat(threads_per_input), repeat(fs), repeat(mod_code)))
+
+    merged_samples = [sample_name for (_, sample_name), chroms in zip(inputs, partitioned) if chroms is not None]
+    sample_names = list(base_samples) + merged_samples
+    if base_store is not None and not merged_samples:
+        shutil.rmtree(spool_dir)
+        return merged_samples
+    base_chrom_dirs = store_chrom_dirs(base_store, sparse) if base_store is not None else {}
+    # the contigs in the order the serial merge takes them
+    contig_runs = [list(base_chrom_dirs)] + [runs for runs in partitioned if runs is not None]
+    chroms = contig_merge_order(contig_runs, ContigOrder(CHROM_ORDERS[chrom_order]))
+
+    log_time(f"Merging {len(sample_names)} samples over {len(chroms)} chromosomes with {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+        list(pool.map(merge_chrom, repeat(spool_dir), chroms, range(len(chroms)), repeat(sample_names), repeat(chrom_order), repeat(store_dir), repeat(sparse),
+                      repeat(base_store), repeat(base_samples), [base_chrom_dirs.get(chrom) for chrom in chroms]))
+
+    shutil.rmtree(spool_dir)
+
+    return merged_samples
 
 
 if __name__ == "__main__":
@@ -156,6 +1203,116 @@ if __name__ == "__main__":
         help="name of output directory."
     )
 
+    parser.add_argument(
+        "-w","--workers",
+        type=int,
+        default=1,
+        help="number of processes; above 1 the inputs are partitioned by chromosome and chromosomes are merged in parallel. (default: 1)"
+    )
+
+    parser.add_argument(
+        "--output-format",
+        choices=["parquet", "tsv", "both"],
+        default="parquet",
+        help="parquet store partitioned by chromosome, the combined TSV, or both. (default: parquet)"
+    )
+
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        help="store only the observed (CpG, sample) cells with a site table instead of the 0 filled dense table."
+    )
+
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="number of pieces of every input to download ahead of the merge to a local spool under the output directory (whole inputs with --workers > 1), 0 streams them from GCS. (default: 0)"
+    )
+
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=5,
+        help="retries with exponential backoff of a prefetch download after a transient error. (default: 5)"
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="directory of a local cache of the inputs keyed by link and object version, reruns only download new or changed inputs. (default: no cache)"
+    )
+
+    parser.add_argument(
+        "--cache-max-gb",
+        type=float,
+        default=None,
+        help="size cap of --cache-dir, least recently used inputs are evicted past it and inputs that do not fit next to those being cached are not cached. (default: no cap)"
+    )
+
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="merge only the samples not yet in the existing store of the output directory into it, resuming an interrupted append."
+    )
+
+    parser.add_argument(
+        "--append-batch",
+        type=int,
+        default=10,
+        help="samples merged into the store per --append step, a crashed run restarts after the last completed step. (default: 10)"
+    )
+
+    parser.add_argument(
+        "--regions",
+        type=str,
+        default=None,
+        help="BED (or bed.gz) of target regions, only CpGs inside them are merged. (default: all CpGs)"
+    )
+
+    parser.add_argument(
+        "--chroms",
+        type=str,
+        default=None,
+        help="comma separated chromosomes to merge, e.g. chr1,chr2,chrX. (default: all chromosomes)"
+    )
+
+    parser.add_argument(
+        "--min-valid-cov",
+        type=int,
+        default=None,
+        help="drop a sample's CpGs with less valid coverage than this before merging. (default: keep all)"
+    )
+
+    parser.add_argument(
+        "--mod-code",
+        type=str,
+        default="m",
+        help="modkit modification code of the rows to merge, e.g. m (5mC) or h (5hmC); the other codes' rows at the same CpGs are dropped. (default: m)"
+    )
+
+    parser.add_argument(
+        "--decode-threads",
+        type=int,
+        default=None,
+        help="threads inflating bgzipped inputs, shared by all inputs (split across --workers), plain gzip is read single threaded. (default: min(8, CPUs))"
+    )
+
+    parser.add_argument(
+        "--batch-mb",
+        type=float,
+        default=4,
+        help="MB of each decompressed input held in memory by the streaming merge. (default: 4)"
+    )
+
+    parser.add_argument(
+        "--chrom-order",
+        choices=sorted(CHROM_ORDERS),
+        default="karyotype",
+        help="contigs are merged in the order the input beds list them (their BAM header order); this orders contigs the inputs leave unordered. (default: karyotype, chr1..chr22, X, Y, M, others by name)"
+    )
+
     # parser.add_argument(
     #     "-p","--haplotypes",
     #     type=str,
@@ -179,7 +1336,11 @@ if __name__ == "__main__":
     os.makedirs(output_dir, exist_ok=True)
     log_time(f"Output directory ensured at: {output_dir}")
 
-    merge_beds(gs_links, output_dir, 'unphased')
+    site_filter = None
+    if args.regions or args.chroms or args.min_valid_cov:
+        site_filter = SiteFilter(args.chroms.split(",") if args.chroms else None, args.regions, args.min_valid_cov)
+
+    merge_beds(gs_links, output_dir, 'unphased', args.batch_mb, args.chrom_order, args.workers, args.output_format, args.sparse, args.prefetch, args.retries, args.cache_dir, args.cache_max_gb, args.append, args.append_batch, site_filter, args.decode_threads, mod_code=args.mod_code)
 
     # Merge the data within each haplotype
     # methylation matches Variant genoytpes - not methylation status 
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import shutil
+import threading
+from datetime import datetime
+
+"""
+    On-disk cache of remote objects read through an fsspec filesystem.
+
+    Objects are stored under a key hashed from their URL and version (the GCS
+    generation, etag or md5, size and modification time the filesystem reports),
+    so a rerun reads unchanged objects from local disk and downloads only new or
+    replaced ones. The cache is capped at max_bytes, evicting the least recently
+    used objects first. An object can also be added while it is streamed
+    elsewhere, through a CacheWriter that reserves its size in the cap up front.
+
+    Usage:
+        cache = ObjectCache(gcsfs.GCSFileSystem(), "/mnt/cache", max_bytes=200 << 30)
+        path = cache.get("gs://bucket/sample.bed.gz")  # local path, do not modify or remove it
+
+        key = cache.key(link)
+        if cache.lookup(link, key) is None:
+            writer = cache.writer(link, key, size)  # None if it does not fit in max_bytes
+            ...writer.write(data)..., then writer.commit()
+"""
+
+# info() fields that change when an object is replaced, from gcsfs, s3fs and local/memory filesystems
+VERSION_FIELDS = ("generation", "etag", "ETag", "md5Hash", "size", "mtime", "LastModified", "updated", "created")
+
+
+def log_time(message):
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+
+
+class ObjectCache:
+    """
+    Local copies of the objects of fs in cache_dir/objects/<ab>/<key>, where key is the
+    sha256 of the URL and version fields. The modification time of a cached file is its
+    last use, which orders the LRU eviction. The sizes of the objects being written
+    through CacheWriters are kept free of the cached objects.
+    """
+
+    def __init__(self, fs, cache_dir, max_bytes=None, chunk_size=8 << 20):
+        self.fs = fs
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.hits = 0
+        self.misses = 0
+        self.downloaded_bytes = 0
+        self._reserved = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+
+    def key(self, link, info=None):
+        """ cache key of the current version of link, from its info() if already fetched """
+        info = self.fs.info(link) if info is None else info
+        version = {field: str(info[field]) for field in VERSION_FIELDS if info.get(field) is not None}
+        return hashlib.sha256(json.dumps([link, version], sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, "objects", key[:2], key)
+
+    def lookup(self, link, key=None):
+        """ path of the cached copy of link's current version (or of key), None on a miss """
+        path = self.path(self.key(link) if key is None else key)
+        if not os.path.exists(path):
+            with self._lock:
+                self.misses += 1
+            log_time(f"cache miss: {link}")
+            return None
+        os.utime(path)
+        with self._lock:
+            self.hits += 1
+        log_time(f"cache hit: {link}")
+        return path
+
+    def get(self, link):
+        """ path of the cached copy of link's current version, downloading it on a miss """
+        key = self.key(link)
+        path = self.lookup(link, key)
+        if path is not None:
+            return path
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        try:
+            with self.fs.open(link, "rb") as src, open(tmp_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, self.chunk_size)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        with self._lock:
+            self.downloaded_bytes += os.path.getsize(path)
+            self.evict(keep=path)
+        return path
+
+    def writer(self, link, key, size):
+        """
+        CacheWriter adding the size bytes of link under key, or None if they do not fit in
+        max_bytes next to the objects already being written
+        """
+        with self._lock:
+            if self.max_bytes is not None and self._reserved + size > self.max_bytes:
+                log_time(f"not caching {link}, {size} bytes do not fit next to the {self._reserved} being cached")
+                return None
+            self._reserved += size
+            self.evict()
+        return CacheWriter(self, link, self.path(key), size)
+
+    def _release(self, writer, committed):
+        with self._lock:
+            self._reserved -= writer.size
+            if committed:
+                self.downloaded_bytes += writer.size
+                self.evict(keep=writer.path)
+
+    def evict(self, keep=None):
+        """ remove the least recently used objects until they fit in max_bytes less the reserved bytes, never keep """
+        if self.max_bytes is None:
+            return
+        objects = []
+        for root, _, files in os.walk(os.path.join(self.cache_dir, "objects")):
+            for name in files:
+                if ".tmp." in name:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                objects.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in objects)
+        for _, size, path in sorted(objects):
+            if total <= self.max_bytes - self._reserved:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            log_time(f"cache evicted {path}")
+
+    def summary(self):
+        return f"cache: {self.hits} hits, {self.misses} misses, {self.downloaded_bytes / (1 << 30):.2f} GB downloaded"
+
+
+class CacheWriter:
+    """
+    A new object of an ObjectCache written piece by piece to a temporary file next to its
+    path, and moved there on commit; abort drops it. Either releases its reserved size.
+    """
+
+    def __init__(self, cache, link, path, size):
+        self.link = link
+        self.path = path
+        self.size = size
+        self._cache = cache
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._tmp_path = f"{path}.tmp.{os.getpid()}.{id(self)}"
+        self._file = open(self._tmp_path, "wb")
+        self._bytes = 0
+
+    def write(self, data):
+        self._file.write(data)
+        self._bytes += len(data)
+
+    def commit(self):
+        self._file.close()
+        if self._bytes != self.size:
+            # the object changed while it was read, do not cache a mix of versions
+            self.abort()
+            return
+        os.replace(self._tmp_path, self.path)
+        self._cache._release(self, True)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+        self._cache._release(self, False)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+import io
+import os
+import shutil
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+"""
+    Bounded read-ahead download of remote inputs through any fsspec filesystem.
+
+    Inputs consumed one after the other are fetched whole: while one is being
+    parsed the next depth inputs are copied to a local spool directory (or into
+    memory) on a thread pool, keeping the network busy while the CPU works.
+    Inputs read side by side, as in a k-way merge, are opened as streams that
+    fetch range_size pieces up to depth ahead of their read position, so only
+    that window of every input is spooled at a time. Transient read errors are
+    retried with exponential backoff. With an ObjectCache (see object_cache.py)
+    inputs are read through the cache, and cached objects are hard linked into
+    the spool when possible, or opened directly by a stream.
+
+    Usage:
+        prefetcher = Prefetcher(gcsfs.GCSFileSystem(), links, depth=4, spool_dir="spool")
+        for link in links:
+            local = prefetcher.fetch(link)  # path of the local copy, or a BytesIO without a spool_dir
+            ...
+        streams = [prefetcher.open(link) for link in links]  # binary file objects, read them in any order
+        prefetcher.close()
+"""
+
+# missing objects and bad credentials will not get better by retrying
+PERMANENT_ERRORS = (FileNotFoundError, PermissionError, IsADirectoryError)
+
+# errors worth retrying: connection resets and timeouts are OSErrors, but gcsfs raises
+# throttling (429) and server (5xx) responses as HttpError and aiohttp its own ClientErrors
+TRANSIENT_ERRORS = (OSError,)
+try:
+    from gcsfs.retry import HttpError
+    TRANSIENT_ERRORS += (HttpError,)
+except ImportError:
+    pass
+try:
+    from aiohttp import ClientError
+    TRANSIENT_ERRORS += (ClientError,)
+except ImportError:
+    pass
+try:
+    from google.auth.exceptions import TransportError
+    TRANSIENT_ERRORS += (TransportError,)
+except ImportError:
+    pass
+
+
+def log_time(message):
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+
+
+def is_client_error(e):
+    """ True for an HTTP error of a 4xx response other than a timeout (408) or throttling (429) """
+    status = getattr(e, "code", None) or getattr(e, "status", None)
+    return isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
+
+
+def with_retries(func, retries=5, backoff=1.0, max_backoff=60.0, description="request", retryable=TRANSIENT_ERRORS):
+    """
+    call func(), retrying the retryable errors other than PERMANENT_ERRORS and 4xx
+    responses up to retries times with doubling sleeps
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except PERMANENT_ERRORS:
+            raise
+        except retryable as e:
+            if attempt == retries or is_client_error(e):
+                raise
+            delay = min(max_backoff, backoff * 2**attempt)
+            log_time(f"{description} failed ({e}), retry {attempt + 1}/{retries} in {delay:g}s")
+            time.sleep(delay)
+
+
+class Prefetcher:
+    """
+    Download links on a pool of depth threads, at most depth ahead of the one being fetched.
+
+    With a spool_dir every link is copied to spool_dir/<n>_<basename> and fetch returns
+    the path, which the caller removes when done with it; without one fetch returns a
+    BytesIO of the contents. open streams a link instead (see PrefetchStream), its pieces
+    fetched on the same pool. Errors of the retryable types are retried (see with_retries).
+    """
+
+    def __init__(self, fs, links=(), depth=4, spool_dir=None, retries=5, backoff=1.0, chunk_size=8 << 20, cache=None, range_size=4 << 20, retryable=TRANSIENT_ERRORS):
+        self._fs = fs
+        self._cache = cache
+        self._queue = deque(links)
+        self._submitted = 0
+        self._depth = max(1, depth)
+        self._spool_dir = spool_dir
+        self._retries = retries
+        self._retryable = retryable
+        self._backoff = backoff
+        self._chunk_size = chunk_size
+        self._range_size = range_size
+        self._pending = OrderedDict()
+        self._pool = ThreadPoolExecutor(max_workers=self._depth)
+        if spool_dir is not None:
+            os.makedirs(spool_dir, exist_ok=True)
+
+    def _download(self, n, link):
+        def copy():
+            if self._cache is not None:
+                return self._from_cache(n, link)
+            if self._spool_dir is None:
+                with self._fs.open(link, "rb") as src:
+                    return io.BytesIO(src.read())
+            path = os.path.join(self._spool_dir, f"{n:06d}_{os.path.basename(link)}")
+            with self._fs.open(link, "rb") as src, open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst, self._chunk_size)
+            return path
+
+        return with_retries(copy, self._retries, self._backoff, description=f"download of {link}", retryable=self._retryable)
+
+    def _from_cache(self, n, link):
+        cached = self._cache.get(link)
+        if self._spool_dir is None:
+            with open(cached, "rb") as f:
+                return io.BytesIO(f.read())
+        path = os.path.join(self._spool_dir, f"{n:06d}_{os.path.basename(link)}")
+        try:
+            # a hard link keeps the data readable if the cache evicts it, and removing it leaves the cache intact
+            os.link(cached, path)
+        except OSError:
+            shutil.copyfile(cached, path)
+        return path
+
+    def _submit(self, link):
+        self._submitted += 1
+        return self._pool.submit(self._download, self._submitted, link)
+
+    def _fill(self):
+        while self._queue and len(self._pending) < self._depth:
+            link = self._queue.popleft()
+            self._pending[link] = self._submit(link)
+
+    def fetch(self, link):
+        """ local copy of link, waiting for its download; raises the download's error if it failed """
+        self._fill()
+        future = self._pending.pop(link, None)
+        if future is None:
+            # fetched out of order, or again, download it now
+            if link in self._queue:
+                self._queue.remove(link)
+            future = self._submit(link)
+        self._fill()
+        return future.result()
+
+    def open(self, link):
+        """
+        binary stream of link, fetched range_size at a time up to depth ahead of its reads;
+        with a cache a cached copy is opened directly and a missing one is cached as it is read
+        """
+        info = with_retries(lambda: self._fs.info(link), self._retries, self._backoff, description=f"info of {link}", retryable=self._retryable)
+        tee = None
+        if self._cache is not None:
+            key = self._cache.key(link, info)
+            cached = self._cache.lookup(link, key)
+            if cached is not None:
+                return open(cached, "rb")
+            tee = self._cache.writer(link, key, info["size"])
+        self._submitted += 1
+        return io.BufferedReader(PrefetchStream(self, self._submitted, link, info["size"], tee))
+
+    def _fetch_range(self, n, link, start, end):
+        def copy():
+            data = self._fs.cat_file(link, start=start, end=end)
+            if len(data) != end - start:
+                raise OSError(f"read {len(data)} of the {end - start} bytes at {start}")
+            if self._spool_dir is None:
+                return data
+            path = os.path.join(self._spool_dir, f"{n:06d}_{os.path.basename(link)}.{start}")
+            with open(path, "wb") as f:
+                f.write(data)
+            return path
+
+        return with_retries(copy, self._retries, self._backoff, description=f"download of {link} at {start}", retryable=self._retryable)
+
+    def _submit_range(self, n, link, start, end):
+        return self._pool.submit(self._fetch_range, n, link, start, end)
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        for future in self._pending.values():
+            if not future.cancelled() and future.exception() is None and isinstance(future.result(), str):
+                os.remove(future.result())
+        self._pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _discard(future):
+    """ remove the spooled piece of a finished fetch no longer wanted """
+    if not future.cancelled() and future.exception() is None and isinstance(future.result(), str):
+        os.remove(future.result())
+
+
+class PrefetchStream(io.RawIOBase):
+    """
+    Sequential reader of one link of a Prefetcher, fetched in range_size pieces on its pool
+    up to depth pieces ahead of the read position. With a spool_dir a fetched piece waits in
+    a file there and is removed as soon as it is read. With a tee (see ObjectCache.writer)
+    the pieces read are also written to it, committed at the end of the link and
+    aborted if the stream is closed before.
+    """
+
+    def __init__(self, prefetcher, n, link, size, tee=None):
+        self._prefetcher = prefetcher
+        self._n = n
+        self._link = link
+        self._size = size
+        self._tee = tee
+        self._offset = 0
+        self._ahead = deque()
+        self._piece = memoryview(b"")
+        self._fill()
+
+    def _fill(self):
+        while self._offset < self._size and len(self._ahead) < self._prefetcher._depth:
+            end = min(self._size, self._offset + self._prefetcher._range_size)
+            self._ahead.append(self._prefetcher._submit_range(self._n, self._link, self._offset, end))
+            self._offset = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not len(self._piece):
+            if not self._ahead:
+                if self._tee is not None:
+                    self._tee.commit()
+                    self._tee = None
+                return 0
+            piece = self._ahead.popleft().result()
+            if isinstance(piece, str):
+                with open(piece, "rb") as f:
+                    data = f.read()
+                os.remove(piece)
+                piece = data
+            if self._tee is not None:
+                self._tee.write(piece)
+            self._piece = memoryview(piece)
+            self._fill()
+        n = min(len(buffer), len(self._piece))
+        buffer[:n] = self._piece[:n]
+        self._piece = self._piece[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            while self._ahead:
+                future = self._ahead.popleft()
+                future.cancel()
+                future.add_done_callback(_discard)
+            if self._tee is not None:
+                self._tee.abort()
+                self._tee = None
+        super().close()
@@ -1,5 +1,6 @@
 import argparse
 import pandas as pd
+import polars as pl
 import numpy as np
 import pysam
 import os
@@ -8,6 +9,9 @@ import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 import seaborn as sns
 import datetime
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 
 # convert this to manhattan plot for QTL hits
@@ -26,7 +30,182 @@ sns.set(
     }
 )
 
-def manhattan_plot(df, cohort, directory_path, prefix, pval, vertical):   
+CAVIAR_TYPE = 'CAVIAR Top Variant Type (SV>=SNV probability)'
+
+def load_qtl_table(path, pval_field, cache=True):
+    """
+    Read only the columns the plots use from a QTL result TSV with the multithreaded
+    polars reader, and parse variant_id (chr1_806320_806320_INS_102 or chr1:986336:C:A)
+    into a categorical chrom, int32 start and int32 size (null for SNVs), plus log10p.
+    Rows whose variant_id has no chrom or int32 position are dropped with a message.
+
+    With cache the parsed table is kept as <input>.qtl_<pval_field>.parquet next to
+    the input and reused while it is newer than the input.
+    """
+    cache_path = f"{os.path.splitext(path)[0]}.qtl_{pval_field}.parquet"
+    if cache and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        print(f"reading cached table {cache_path}")
+        return pl.read_parquet(cache_path).to_pandas()
+
+    qtl = pl.read_csv(
+        path,
+        separator="\t",
+        columns=['variant_id', pval_field, 'slope', CAVIAR_TYPE],
+        schema_overrides={pval_field: pl.Float64, 'slope': pl.Float64},
+    )
+    fields = pl.col('variant_id').str.replace_all(":", "_", literal=True).str.split_exact("_", 4)
+    qtl = qtl.with_columns(
+        fields.struct.field('field_0').cast(pl.Categorical).alias('chrom'),
+        fields.struct.field('field_1').cast(pl.Int32, strict=False).alias('start'),
+        fields.struct.field('field_4').cast(pl.Int32, strict=False).alias('size'),
+        (-pl.col(pval_field).log10()).alias('log10p'),
+        pl.col(CAVIAR_TYPE).cast(pl.Categorical),
+    )
+    # a variant_id without a chrom and an int32 position can't be placed
+    unplaced = qtl.filter(pl.col('chrom').is_null() | pl.col('start').is_null())
+    if unplaced.height:
+        print(f"dropping {unplaced.height} rows of {path} without a chrom and position in variant_id, e.g. {unplaced['variant_id'][0]}")
+        qtl = qtl.filter(pl.col('chrom').is_not_null() & pl.col('start').is_not_null())
+
+    if cache:
+        try:
+            qtl.write_parquet(cache_path)
+        except OSError as e:
+            print(f"could not cache the table at {cache_path}: {e}")
+
+    return qtl.to_pandas()
+
+def genome_layout(numeric_chrom, start):
+    """
+    Lay the numbered chromosomes end to end in numeric order, each offset by the largest
+    start of the chromosomes before it. Returns the cumulative genome position of every
+    row (nan off the numbered chromosomes), the chromosome index of every row (-1 off them),
+    the chromosome numbers and the tick position at the middle of each chromosome.
+    """
+    numbered = ~np.isnan(numeric_chrom) & ~np.isnan(start)
+    chrom_numbers = np.unique(numeric_chrom[numbered])
+    chrom_index = np.full(len(numeric_chrom), -1)
+    chrom_index[numbered] = np.searchsorted(chrom_numbers, numeric_chrom[numbered])
+
+    lengths = np.zeros(len(chrom_numbers))
+    np.maximum.at(lengths, chrom_index[numbered], start[numbered])
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+    genome_x = np.full(len(start), np.nan)
+    genome_x[numbered] = start[numbered] + offsets[chrom_index[numbered]]
+    return genome_x, chrom_index, chrom_numbers, offsets + lengths/2
+
+def marker_cells(size_inches, marker_size, dpi):
+    """ cells along a figure side of size_inches when a cell is half the diameter of a marker of area marker_size (points^2) """
+    cell_px = max(1.0, np.sqrt(marker_size) * dpi / 72 / 2)
+    return int(size_inches * dpi / cell_px)
+
+def decimate(x, y, keep, width_px, height_px, group=None):
+    """
+    Indexes of the points worth drawing: every point where keep is True, and of the
+    rest one point per cell of a width_px x height_px grid over the data range (per
+    group, so every color stays represented), since the others would be drawn over
+    the same pixels. Cells of half a marker (see marker_cells) look the same as a
+    full render.
+    """
+    finite = np.isfinite(x) & np.isfinite(y)
+    kept = np.flatnonzero(keep & finite)
+    rest = np.flatnonzero(~keep & finite)
+    if len(rest) == 0:
+        return kept
+
+    def pixel(values, n):
+        low, high = values[finite].min(), values[finite].max()
+        scale = n / (high - low) if high > low else 0
+        return np.minimum(((values[rest] - low) * scale).astype(np.int64), n - 1)
+
+    cell = pixel(x, width_px) * height_px + pixel(y, height_px)
+    if group is not None:
+        cell = cell * (group.max() + 1) + group[rest]
+    _, first = np.unique(cell, return_index=True)
+    return np.sort(np.concatenate([kept, rest[first]]))
+
+def export_tiles(df, path, pval, keep_log10p=-np.log10(0.05), zoom_levels=8, base_cells=1024, height_cells=256, row_group_size=16384):
+    """
+    Write a pyramid of the Manhattan points to a Parquet file for interactive browsing.
+
+    Zoom level z thins the points to one per cell of a (base_cells * 2^z) x height_cells
+    grid over the genome and -log10(p) (see decimate), and level zoom_levels holds every
+    point. Significant points and SVs are kept at every level. The cells of a level nest
+    in those of the level above, so every point is stored once with min_zoom, the
+    coarsest level showing it, and level z is the points with min_zoom <= z. Rows are
+    sorted by min_zoom and genome position so query_tiles reads only the row groups of
+    one level and region, and the cell width of each level is kept in the file metadata.
+    """
+    numeric_chrom = pd.to_numeric(df['chrom'].astype(str).str.strip("chr"), errors='coerce').to_numpy(dtype=float)
+    start = pd.to_numeric(df['start'], errors='coerce').to_numpy(dtype=float)
+    genome_x, chrom_index, _, _ = genome_layout(numeric_chrom, start)
+    on_chrom = np.flatnonzero(chrom_index >= 0)
+    genome_x = genome_x[on_chrom]
+    logp = df[pval].to_numpy(dtype=float)[on_chrom]
+    is_sv = (df[CAVIAR_TYPE]=='SV').to_numpy()[on_chrom]
+    keep = (logp >= keep_log10p) | is_sv
+    span = int(genome_x.max() - genome_x.min()) + 1 if len(on_chrom) else 1
+
+    min_zoom = np.full(len(on_chrom), zoom_levels, dtype=np.uint8)
+    levels = {zoom_levels: 1}
+    for zoom in reversed(range(zoom_levels)):
+        cells = base_cells * 2**zoom
+        min_zoom[decimate(genome_x, logp, keep, cells, height_cells, chrom_index[on_chrom] % 2)] = zoom
+        levels[zoom] = -(-span // cells)
+    for zoom in sorted(levels):
+        print(f"tile zoom {zoom}: {(min_zoom <= zoom).sum()} points, {levels[zoom]} bp cells")
+
+    tiles = pl.DataFrame({
+        'min_zoom': min_zoom,
+        'variant_id': df['variant_id'].to_numpy()[on_chrom],
+        'chrom': df['chrom'].astype(str).to_numpy()[on_chrom],
+        'start': start[on_chrom].astype(np.int32),
+        'size': pd.to_numeric(df['size'], errors='coerce').to_numpy(dtype=float)[on_chrom],
+        'genome_x': genome_x.astype(np.int64),
+        'log10p': logp.astype(np.float32),
+        'slope': df['slope'].to_numpy(dtype=np.float32)[on_chrom],
+        'is_sv': is_sv,
+    }).with_columns(pl.col('size').cast(pl.Int32, strict=False)).sort(['min_zoom', 'genome_x'])
+
+    tiles.write_parquet(path, row_group_size=row_group_size, statistics=True,
+                        metadata={'qtl_tile_bin_bp': json.dumps({str(zoom): levels[zoom] for zoom in sorted(levels)})})
+    print(f"wrote {tiles.shape[0]} tile points to {path}")
+    return path
+
+def query_tiles(path, region=None, zoom=None, width_px=1000):
+    """
+    Points of a tile file (see export_tiles) in region, chr1 or chr1:1000000-2000000
+    (the whole genome when None), at zoom, or by default at the coarsest level whose
+    cells are no wider than the region over width_px pixels. Returns a polars DataFrame
+    and the zoom level used.
+    """
+    levels = {int(zoom): bin_bp for zoom, bin_bp in json.loads(pl.read_parquet_metadata(path)['qtl_tile_bin_bp']).items()}
+    tiles = pl.scan_parquet(path)
+
+    query = pl.lit(True)
+    interval = ""
+    if region is not None:
+        chrom, _, interval = region.partition(":")
+        query = pl.col('chrom') == chrom
+        if interval:
+            low, high = (int(x.replace(",", "")) for x in interval.split("-"))
+            query = query & pl.col('start').is_between(low, high)
+
+    if zoom is None:
+        if interval:
+            extent = high - low + 1
+        else:
+            # the coarsest level spans the same range as the full one
+            extent = tiles.filter(query & (pl.col('min_zoom') == 0)).select(
+                pl.col('genome_x').max() - pl.col('genome_x').min() + 1).collect().item() or 1
+        fine_enough = [z for z in sorted(levels) if levels[z] <= extent / width_px]
+        zoom = fine_enough[0] if fine_enough else max(levels)
+
+    points = tiles.filter((pl.col('min_zoom') <= zoom) & query).collect().sort('genome_x')
+    return points, zoom
+
+def manhattan_plot(df, cohort, directory_path, prefix, pval, vertical, keep_log10p=-np.log10(0.05), decimate_points=True, dpi=300):   
     
     #pval = 'bh_fdr'
         
@@ -62,13 +241,17 @@ def manhattan_plot(df, cohort, directory_path, prefix, pval, vertical):
 
     colors=['#4D4D4D', '#B3B3B3']
     
-    # make numeric chrom names
+    # make numeric chrom names, chromosomes without a number (X, Y, M) are not plotted
     # df['numeric_chrom'] = df.index.get_level_values('chrom').str.strip("chr")
-    df['numeric_chrom'] = df['chrom'].str.strip("chr")
+    df['numeric_chrom'] = df['chrom'].astype(str).str.strip("chr")
     df['numeric_chrom'] = pd.to_numeric(df['numeric_chrom'], errors='coerce')
-    df_sorted = df.sort_values(by='numeric_chrom', ascending=False)
     # df_sorted.to_csv(directory_path+"/"+cohort.upper()+"_"+directory_path+"_variance_std.csv", header=True, index=True, sep=',')
 
+    numeric_chrom = df['numeric_chrom'].to_numpy(dtype=float)
+    start = pd.to_numeric(df['start'], errors='coerce').to_numpy(dtype=float)
+    genome_x, chrom_index, chrom_numbers, tick_positions = genome_layout(numeric_chrom, start)
+    on_chrom = chrom_index >= 0
+    logp = df[pval].to_numpy(dtype=float)
 
     # fig, (ax_combined, axs, ax_std_deviation) = plt.subplots(3, 1, figsize=(10, 12), sharex=False)
     if vertical:
@@ -80,39 +263,28 @@ def manhattan_plot(df, cohort, directory_path, prefix, pval, vertical):
 
     fig, axs = plt.subplots(figsize=(w,h))
 
+    # filtered = df_sorted.loc[df_sorted['type_alt'].isin(['INS', 'DEL'])]
+    is_sv = (df[CAVIAR_TYPE]=='SV').to_numpy() & on_chrom
 
-    # Scatter plot for qtl ( manhattan )
-#     axs.scatter(np.arange(variance_per_column.shape[0]), variance_per_column, color='blue', alpha=0.7, s=2)
-    xtix = []
-    xtix_labels = []
-    last_group_end = 0
-    colori = 0
-    
-    for chrom, group in df_sorted.groupby('numeric_chrom'):
-        # axs.scatter(group['start'], group[pval], color=chrom_colors[chrom], alpha=0.4, s=2)
-        if vertical:
-            axs.scatter( group[pval], group['start'], color=colors[colori%2], alpha=1, s=16, label='SNV')
-            xtix.append( (last_group_end+axs.get_yticks()[-2])/2)
-            xtix_labels.append( 'chr'+str(chrom) )
-            last_group_end = axs.get_yticks()[-1]
-        else:
-            axs.scatter(group['start'], group[pval], color=colors[colori%2], alpha=1, s=2, label='SNV')
-            xtix.append( (last_group_end+axs.get_xticks()[-2])/2)
-            xtix_labels.append( 'chr'+str(chrom) )
-            last_group_end = axs.get_xticks()[-1]
-        
-        colori+=1
+    # keep every significant point and SV, thin the rest to one point per pixel and color
+    drawn = np.flatnonzero(on_chrom)
+    if decimate_points:
+        keep = (logp >= keep_log10p) | is_sv
+        marker_size = 16 if vertical else 2
+        drawn = drawn[decimate(genome_x[drawn], logp[drawn], keep[drawn], marker_cells(w, marker_size, dpi), marker_cells(h, marker_size, dpi), chrom_index[drawn] % 2)]
+        print(f"drawing {len(drawn)} of {on_chrom.sum()} points")
 
-    # filtered = df_sorted.loc[df_sorted['type_alt'].isin(['INS', 'DEL'])]
-    filtered = df_sorted.loc[df_sorted['CAVIAR Top Variant Type (SV>=SNV probability)']=='SV']
-    for chrom, group in filtered.groupby('numeric_chrom'):
-        if vertical:
-            axs.scatter(group[pval], group['start'], color='red', alpha=0.7, s=20, label='SV')
-        else:    
-            axs.scatter(group['start'], group[pval], color='red', alpha=0.7, s=20, label='SV')
-        # xtix.append( (last_group_end+axs.get_xticks()[-2])/2)
-        # xtix_labels.append( chrom )
-        # last_group_end = axs.get_xticks()[-1]
+    # Scatter plot for qtl ( manhattan ), every chromosome in one rasterized collection with alternating colors
+    point_colors = np.array(colors)[chrom_index[drawn] % 2]
+    xtix = tick_positions
+    xtix_labels = ['chr'+str(int(chrom)) for chrom in chrom_numbers]
+
+    if vertical:
+        axs.scatter(logp[drawn], genome_x[drawn], c=point_colors, alpha=1, s=16, label='SNV', rasterized=True)
+        axs.scatter(logp[is_sv], genome_x[is_sv], color='red', alpha=0.7, s=20, label='SV', rasterized=True)
+    else:
+        axs.scatter(genome_x[drawn], logp[drawn], c=point_colors, alpha=1, s=2, label='SNV', rasterized=True)
+        axs.scatter(genome_x[is_sv], logp[is_sv], color='red', alpha=0.7, s=20, label='SV', rasterized=True)
         
     # median_p = df[pval].median()
     median_p = -np.log10(0.05)
@@ -144,9 +316,10 @@ def manhattan_plot(df, cohort, directory_path, prefix, pval, vertical):
     # Show the plots
     plt.tight_layout()
     
-    plt.savefig(directory_path+"/"+prefix+"_"+directory_path+"_qtl_manhattan.png",dpi=300)
+    plt.savefig(directory_path+"/"+prefix+"_"+os.path.basename(os.path.normpath(directory_path))+"_qtl_manhattan.png",dpi=dpi)
+    plt.close(fig)
 
-def plot_volcano(df, prefix, directory_path, pval, alpha=0.3):
+def plot_volcano(df, prefix, directory_path, pval, alpha=0.3, keep_log10p=-np.log10(0.05), decimate_points=True, dpi=300):
     """ Linear Regression Volcano Plot""" 
 
     print(f"Plotting volcano")
@@ -157,8 +330,15 @@ def plot_volcano(df, prefix, directory_path, pval, alpha=0.3):
     df['size'] = pd.to_numeric(df['size'], errors='coerce')
     df_sorted = df.sort_values(by='size', ascending=True) 
 
-    sns.scatterplot(x='slope', y=pval, data=df_sorted, color='#B3B3B3', s=16, ax=axs)
-    sns.scatterplot(x='slope', y=pval, data=df_sorted.loc[(df_sorted['size']>20) | (df_sorted['size']<-20)], hue='size', edgecolor='k', alpha=0.7, s=18, ax=axs, palette='viridis')
+    # the grey background only needs one point per pixel outside the significant points and SVs
+    background = df_sorted
+    if decimate_points:
+        keep = (df_sorted[pval] >= keep_log10p) | (df_sorted[CAVIAR_TYPE]=='SV')
+        drawn = decimate(df_sorted['slope'].to_numpy(dtype=float), df_sorted[pval].to_numpy(dtype=float), keep.to_numpy(), marker_cells(10, 16, dpi), marker_cells(10, 16, dpi))
+        background = df_sorted.iloc[drawn]
+
+    sns.scatterplot(x='slope', y=pval, data=background, color='#B3B3B3', s=16, ax=axs, rasterized=True)
+    sns.scatterplot(x='slope', y=pval, data=df_sorted.loc[(df_sorted['size']>20) | (df_sorted['size']<-20)], hue='size', edgecolor='k', alpha=0.7, s=18, ax=axs, palette='viridis', rasterized=True)
     # bh_num_sig = df.loc[(df['bh_corrected_P_Value_Age']<alpha)].shape[0]
     axs.axhline(y=-np.log10(alpha), color='red', label=f'FDR={alpha}')
 
@@ -170,7 +350,88 @@ def plot_volcano(df, prefix, directory_path, pval, alpha=0.3):
 
     # t = plt.xticks(rotation=90)
 
-    plt.savefig(f"{directory_path}/{prefix}_volcano.png",dpi=300, facecolor='white', transparent=False)
+    plt.savefig(f"{directory_path}/{prefix}_volcano.png",dpi=dpi, facecolor='white', transparent=False)
+    plt.close(fig)
+
+
+def plot_qtl_file(in_qtl_tsv, cohort, output_directory, pval_field="bh_fdr", vertical=False, keep_log10p=-np.log10(0.05), decimate_points=True, cache=True, tiles=False):
+    """
+    load one QTL result TSV and write its Manhattan and volcano PNGs, and with tiles its
+    <prefix>_qtl_tiles.parquet (see export_tiles), returning the seconds spent in each step
+    """
+    timings = {'in_qtl_tsv': in_qtl_tsv}
+    start = time.perf_counter()
+
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory, exist_ok=True)
+
+    # 'variant_id'
+    # chr1_806320_806320_INS_102
+    # chr1:986336:C:A
+    qtl_df = load_qtl_table(in_qtl_tsv, pval_field, cache=cache)
+    timings['rows'] = qtl_df.shape[0]
+    timings['load_s'] = time.perf_counter() - start
+
+    print(qtl_df.shape )
+    # manifest rows name TSVs in other directories, the outputs go to output_directory
+    prefix = os.path.splitext(os.path.basename(in_qtl_tsv))[0]
+    if tiles:
+        export_tiles(qtl_df, f"{output_directory}/{prefix}_qtl_tiles.parquet", 'log10p', keep_log10p)
+    manhattan_plot(qtl_df, cohort, output_directory, prefix, 'log10p', vertical, keep_log10p, decimate_points)
+    timings['manhattan_s'] = time.perf_counter() - start - timings['load_s']
+
+    plot_volcano(qtl_df, prefix, output_directory, 'log10p', alpha=0.3, keep_log10p=keep_log10p, decimate_points=decimate_points)
+    timings['total_s'] = time.perf_counter() - start
+    timings['volcano_s'] = timings['total_s'] - timings['load_s'] - timings['manhattan_s']
+    return timings
+
+def _plot_manifest_row(row):
+    """ plot_qtl_file of one manifest row, recording a failure instead of raising so the rest of the batch finishes """
+    try:
+        timings = plot_qtl_file(**row)
+        timings['error'] = ''
+    except Exception as e:
+        print(f"Error plotting {row['in_qtl_tsv']}: {e}")
+        timings = {'in_qtl_tsv': row['in_qtl_tsv'], 'error': str(e)}
+    return timings
+
+def plot_manifest(manifest, workers=1, pval_field="bh_fdr", vertical=False, keep_log10p=-np.log10(0.05), decimate_points=True, cache=True, tiles=False):
+    """
+    Plot every QTL TSV of a manifest on a pool of worker processes.
+
+    The manifest is a TSV with in_qtl_tsv, cohort and output_directory columns, and
+    optional pval_field and vertical columns overriding the command line defaults.
+    Per file timings are printed and written to <manifest>_timings.tsv.
+    """
+    manifest_df = pd.read_csv(manifest, sep="\t")
+    missing = {'in_qtl_tsv', 'cohort', 'output_directory'} - set(manifest_df.columns)
+    if missing:
+        print(f"manifest {manifest} is missing columns: {', '.join(sorted(missing))}")
+        sys.exit(1)
+
+    if 'pval_field' not in manifest_df.columns:
+        manifest_df['pval_field'] = pval_field
+    manifest_df['pval_field'] = manifest_df['pval_field'].fillna(pval_field)
+    if 'vertical' not in manifest_df.columns:
+        manifest_df['vertical'] = vertical
+    manifest_df['vertical'] = manifest_df['vertical'].fillna(vertical).astype(str).str.lower().isin(['true', '1', 'yes'])
+
+    rows = [dict(row, keep_log10p=keep_log10p, decimate_points=decimate_points, cache=cache, tiles=tiles)
+            for row in manifest_df[['in_qtl_tsv', 'cohort', 'output_directory', 'pval_field', 'vertical']].to_dict('records')]
+
+    start = time.perf_counter()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            timings = list(pool.map(_plot_manifest_row, rows))
+    else:
+        timings = [_plot_manifest_row(row) for row in rows]
+
+    timings_df = pd.DataFrame(timings, columns=['in_qtl_tsv', 'rows', 'load_s', 'manhattan_s', 'volcano_s', 'total_s', 'error'])
+    timings_df['rows'] = timings_df['rows'].astype('Int64')
+    timings_df.to_csv(f"{os.path.splitext(manifest)[0]}_timings.tsv", sep="\t", index=False, float_format="%.2f")
+    print(timings_df.to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+    print(f"plotted {(timings_df['error'] == '').sum()} of {len(rows)} files in {time.perf_counter() - start:.1f}s with {workers} workers")
+    return timings_df
 
 
 if __name__ == "__main__":
@@ -182,21 +443,18 @@ if __name__ == "__main__":
     parser.add_argument(
         "-i","--in_qtl_tsv",
         type=str,
-        required=True,
         help="Path to the input qtl tsv to be analyzed."
     )
 
     parser.add_argument(
         "-c","--cohort",
         type=str,
-        required=True,
         help="cohort ID."
     )
 
     parser.add_argument(
         "-o","--output_directory",
         type=str,
-        required=True,
         help="Path to the input qtl tsv to be analyzed."
     )
 
@@ -214,31 +472,76 @@ if __name__ == "__main__":
     )
 
 
-    args = parser.parse_args()
-
-    if not os.path.isdir(args.output_directory):
-        os.makedirs(args.output_directory, exist_ok=True)
-
-    qtl_df = pd.read_csv(args.in_qtl_tsv, sep="\t")
+    parser.add_argument(
+        "--keep_log10p",
+        type=float,
+        default=-np.log10(0.05),
+        help="points at or above this -log10(p) and SVs are always drawn, the rest are thinned to one per pixel. (default: -log10(0.05))"
+    )
 
-    # 'variant_id'
-    # chr1_806320_806320_INS_102
-    # chr1:986336:C:A
-    qtl_df[['chrom','start','end_ref','type_alt','size']] = qtl_df['variant_id'].str.split(r'[_:]', expand=True)  
-    qtl_df['log10p'] = -np.log10(qtl_df[args.pval_field])  
+    parser.add_argument(
+        '--no_decimate', 
+        action='store_true', 
+        help='Draw every point instead of thinning the non-significant ones'
+    )
 
-    print(qtl_df.shape )
-    prefix = args.in_qtl_tsv.split(".")[0]
-    manhattan_plot(qtl_df, args.cohort, args.output_directory, prefix, 'log10p', args.vertical )
+    parser.add_argument(
+        '--no_cache', 
+        action='store_true', 
+        help='Do not read or write the parsed table cache (<input>.qtl_<pval_field>.parquet)'
+    )
 
-    plot_volcano(qtl_df, prefix, args.output_directory, 'log10p', alpha=0.3)
+    parser.add_argument(
+        "-m","--manifest",
+        type=str,
+        help="TSV of QTL files to plot in one run, with in_qtl_tsv, cohort and output_directory columns and optional pval_field and vertical columns; replaces -i, -c and -o."
+    )
 
+    parser.add_argument(
+        "-w","--workers",
+        type=int,
+        default=1,
+        help="number of processes plotting manifest files. (default: 1)"
+    )
 
+    parser.add_argument(
+        '--tiles', 
+        action='store_true', 
+        help='Also write a zoomable pyramid of the Manhattan points to <output_directory>/<prefix>_qtl_tiles.parquet'
+    )
 
+    parser.add_argument(
+        "--query_tiles",
+        type=str,
+        help="Print the points of a _qtl_tiles.parquet file in --region as a TSV instead of plotting."
+    )
 
+    parser.add_argument(
+        "--region",
+        type=str,
+        help="region for --query_tiles, chr1 or chr1:1000000-2000000. (default: the whole genome)"
+    )
 
+    parser.add_argument(
+        "--zoom",
+        type=int,
+        help="zoom level for --query_tiles. (default: the coarsest level with cells no wider than the region over 1000 pixels)"
+    )
 
+    args = parser.parse_args()
 
+    if args.query_tiles:
+        query_start = time.perf_counter()
+        points, zoom = query_tiles(args.query_tiles, args.region, args.zoom)
+        print(f"{points.shape[0]} points at zoom {zoom} in {(time.perf_counter() - query_start)*1000:.1f} ms", file=sys.stderr)
+        points.write_csv(sys.stdout, separator="\t")
+        sys.exit(0)
 
+    if args.manifest:
+        plot_manifest(args.manifest, args.workers, args.pval_field, args.vertical, args.keep_log10p, not args.no_decimate, not args.no_cache, args.tiles)
+        sys.exit(0)
 
+    if not (args.in_qtl_tsv and args.cohort and args.output_directory):
+        parser.error("-i, -c and -o are required without a --manifest")
 
+    plot_qtl_file(args.in_qtl_tsv, args.cohort, args.output_directory, args.pval_field, args.vertical, args.keep_log10p, not args.no_decimate, not args.no_cache, args.tiles)
@@ -10,11 +10,22 @@ import seaborn as sns
 import datetime
 import json
 from pathlib import Path
-import gzip
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from svlen_summary import sum_ins_del
+from vcf_scan import VcfScanner, LengthHistogramAccumulator
 
 labelsize=10
 ticksize=9
 
+# SV size strata of the stratified metrics, bin i holds SIZE_EDGES[i] <= size < SIZE_EDGES[i+1]
+SIZE_EDGES = [50, 100, 1000, 10000, np.iinfo(np.int64).max]
+SIZE_LABELS = ["50-100bp", "100bp-1kb", "1kb-10kb", ">10kb"]
+
+# truvari bench output vcf of each count
+BENCH_VCFS = {"TP-base":"tp-base.vcf.gz", "TP-comp":"tp-comp.vcf.gz", "FP":"fp.vcf.gz", "FN":"fn.vcf.gz"}
+
 sns.set(
     style="white",  # sets the background to white
     rc={
@@ -47,67 +58,56 @@ def plot_total_bp(df, cohort):
     plt.savefig(f"{cohort}_INSDEL_length_hifiasmShasta.png",dpi=300, facecolor='white', transparent=False)
 
 
-def open_vcf(path):
-    if str(path).endswith(".gz"):
-        return gzip.open(path, "rt")
-    return open(path, "r")
+def map_ordered(func, items, workers=1):
+    """ map func over items, on a process pool when workers > 1, returning results in item order """
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(func, items))
+    return [func(item) for item in items]
 
-def sum_ins_del(vcf_path):
-    total_ins = 0
-    total_del = 0
 
-    with open_vcf(vcf_path) as f:
-        for line in f:
-            if line.startswith("#"):
-                continue
+def fn_fp_vcfs(d, cohort):
+    """ sample name, shasta only (fp) and hifiasm only (fn) vcf of a truvari bench directory, or None """
 
-            fields = line.strip().split("\t")
-            ref = fields[3]
-            alts = fields[4].split(",")
+    sample = f"{cohort}_"+Path(d).name.split("_")[1]
 
-            for alt in alts:
-                # skip symbolic calls like <INS>, <DEL>, <DUP>, etc
-                if alt.startswith("<") and alt.endswith(">"):
-                    continue
+    shastaOnly = Path(d) / "fp.vcf.gz"
+    if not shastaOnly.exists():
+        return None
 
-                # compute length delta
-                d = len(alt) - len(ref)
+    hifiasmOnly = Path(d) / "fn.vcf.gz"
+    if not hifiasmOnly.exists():
+        return None
 
-                if d > 0:
-                    total_ins += d
-                elif d < 0:
-                    total_del += abs(d)
+    if sample == "RUSH_HG002.PPMI":
+        # this one was run with shasta as base instead so swap fp/fn s
+        tmp = hifiasmOnly
+        hifiasmOnly = shastaOnly
+        shastaOnly = tmp
 
-    return total_ins, total_del
+    return sample, shastaOnly, hifiasmOnly
 
-def count_bps_fn_fp(dirs, cohort):
 
-    indel_len_list = []
-
-    for d in dirs:
-
-        sample = f"{cohort}_"+Path(d).name.split("_")[1]
-
-        
+def count_bps_fn_fp(dirs, cohort, workers=1):
+    """
+    Sum the INS/DEL bp of the fp (shasta only) and fn (hifiasm only) vcfs of every
+    directory, returning the per sample and assembler totals that are plotted. With
+    workers > 1 every vcf of every directory is scanned concurrently.
+    """
 
-        shastaOnly = Path(d) / "fp.vcf.gz"
-        if not shastaOnly.exists():
-            continue
+    indel_len_list = []
 
-        
+    samples = [vcfs for vcfs in (fn_fp_vcfs(d, cohort) for d in dirs) if vcfs is not None]
+    vcf_paths = [path for _, shastaOnly, hifiasmOnly in samples for path in (shastaOnly, hifiasmOnly)]
 
-        hifiasmOnly = Path(d) / "fn.vcf.gz"
-        if not hifiasmOnly.exists():
-            continue
+    # one process per vcf already, so each decompresses on a single thread
+    scan = partial(sum_ins_del, threads=1) if workers > 1 else sum_ins_del
+    totals = map_ordered(scan, vcf_paths, workers)
 
-        if sample == "RUSH_HG002.PPMI":
-            # this one was run with shasta as base instead so swap fp/fn s
-            tmp = hifiasmOnly
-            hifiasmOnly = shastaOnly
-            shastaOnly = tmp
+    for i, (sample, _, _) in enumerate(samples):
 
-        shasta_ins, shasta_del = sum_ins_del(shastaOnly)
-        hifiasm_ins, hifiasm_del = sum_ins_del(hifiasmOnly)
+        shasta_ins, shasta_del = totals[2*i]
+        hifiasm_ins, hifiasm_del = totals[2*i+1]
 
         indel_len_list.append({
             "sample": sample,
@@ -129,6 +129,74 @@ def count_bps_fn_fp(dirs, cohort):
 
     plot_total_bp(df, cohort)
 
+    return df
+
+
+
+def stratify_vcf(vcf_path):
+    """ record counts per SV type and SIZE_EDGES bin of one truvari output vcf, from a single pass """
+    scanner = VcfScanner(vcf_path, threads=1)
+    sizes = scanner.register(LengthHistogramAccumulator(SIZE_EDGES, by_type=True))
+    scanner.run()
+
+    return sizes.counts
+
+
+def stratum_metrics(counts):
+    """ precision, recall and f1 of a dict of TP-base, TP-comp, FP and FN counts """
+    comp = counts["TP-comp"] + counts["FP"]
+    base = counts["TP-base"] + counts["FN"]
+    precision = counts["TP-comp"] / comp if comp else 0
+    recall = counts["TP-base"] / base if base else 0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0
+
+    return {**counts, "precision": precision, "recall": recall, "f1": f1}
+
+
+def stratified_metrics(dirs, cohort, workers=1):
+    """
+    Precision/recall/F1 per sample, SV type and SV size bin from one streaming pass over
+    the tp-base, tp-comp, fp and fn vcfs of every truvari bench directory. Every vcf of
+    every directory is a separate pool task when workers > 1.
+
+    Rows with svtype or size_bin "ALL" sum over the types or the >=50bp size bins.
+    """
+
+    samples = []
+    for d in dirs:
+        vcfs = [Path(d) / name for name in BENCH_VCFS.values()]
+        if all(vcf.exists() for vcf in vcfs):
+            samples.append((cohort+"_"+Path(d).name.split("_")[1], vcfs))
+
+    vcf_paths = [vcf for _, vcfs in samples for vcf in vcfs]
+    hists = map_ordered(stratify_vcf, vcf_paths, workers)
+
+    rows = []
+    for i, (sample, _) in enumerate(samples):
+        # SV type -> per size bin counts for TP-base, TP-comp, FP and FN
+        sample_hists = dict(zip(BENCH_VCFS, hists[len(BENCH_VCFS)*i:len(BENCH_VCFS)*(i+1)]))
+        zeros = np.zeros(len(SIZE_LABELS), dtype=np.int64)
+        svtypes = sorted({svtype for hist in sample_hists.values() for svtype in hist})
+
+        for svtype in svtypes + ["ALL"]:
+            if svtype == "ALL":
+                type_counts = {name: sum(hist.values(), zeros) for name, hist in sample_hists.items()}
+            else:
+                type_counts = {name: hist.get(svtype, zeros) for name, hist in sample_hists.items()}
+
+            for b, size_bin in enumerate(SIZE_LABELS + ["ALL"]):
+                if size_bin == "ALL":
+                    counts = {name: int(hist.sum()) for name, hist in type_counts.items()}
+                else:
+                    counts = {name: int(hist[b]) for name, hist in type_counts.items()}
+                rows.append({"sample": sample, "svtype": svtype, "size_bin": size_bin, **stratum_metrics(counts)})
+
+    df = pd.DataFrame(rows)
+
+    print(df.loc[(df["svtype"]=="ALL")].head(len(SIZE_LABELS)+1))
+    df.to_csv(f"{cohort}_truvariBench_stratified.csv", index=False, header=True)
+
+    return df
 
 
 def plot_data(df, cohort):
@@ -211,39 +279,41 @@ def plot_data(df, cohort):
 
 
 
-def load_jsons(dirs, cohort):
+def read_summary(d, cohort):
+    """ truvari bench metrics of one directory's summary.json, None if it has none """
 
+    json_path = Path(d) / "summary.json"
+    if not json_path.exists():
+        return None
 
-    metrics_list = []
+    with open(json_path) as f:
+        data = json.load(f)
 
-    for d in dirs:
-        json_path = Path(d) / "summary.json"
-        if not json_path.exists():
-            continue
+    # print(json.dumps(data, indent=4))
+
+    # get TP-base, TP-comp, FP, FN, precision, recall, f1
+    metrics = {}
 
-        with open(json_path) as f:
-            data = json.load(f)
+    # Extract values
+    metrics["TP-base"] = data.get("TP-base", 0)
+    metrics["TP-comp"] = data.get("TP-comp", 0)
+    metrics["FP"] = data.get("FP", 0)
+    metrics["FN"] = data.get("FN", 0)
 
-        # print(json.dumps(data, indent=4))
+    # Precision, recall, f1 may be under 'stats' or 'metrics'
+    metrics["precision"] = data.get("precision", 0)
+    metrics["recall"] = data.get("recall", 0)
+    metrics["f1"] = data.get("f1", 0)
 
-        # get TP-base, TP-comp, FP, FN, precision, recall, f1
-        metrics = {}
+    # Store sample/assembler info
+    metrics["sample"] = cohort+"_"+Path(d).name.split("_")[1]
 
-        # Extract values
-        metrics["TP-base"] = data.get("TP-base", 0)
-        metrics["TP-comp"] = data.get("TP-comp", 0)
-        metrics["FP"] = data.get("FP", 0)
-        metrics["FN"] = data.get("FN", 0)
+    return metrics
 
-        # Precision, recall, f1 may be under 'stats' or 'metrics'
-        metrics["precision"] = data.get("precision", 0)
-        metrics["recall"] = data.get("recall", 0)
-        metrics["f1"] = data.get("f1", 0)
 
-        # Store sample/assembler info
-        metrics["sample"] = cohort+"_"+Path(d).name.split("_")[1]
+def load_jsons(dirs, cohort, workers=1):
 
-        metrics_list.append(metrics)
+    metrics_list = [metrics for metrics in map_ordered(partial(read_summary, cohort=cohort), dirs, workers) if metrics is not None]
 
     # Combine into a DataFrame
     df_metrics = pd.DataFrame(metrics_list)
@@ -253,6 +323,8 @@ def load_jsons(dirs, cohort):
 
     plot_data(df_metrics, cohort)
 
+    return df_metrics
+
 
 if __name__ == "__main__":
 
@@ -273,11 +345,27 @@ if __name__ == "__main__":
         help="Name of cohort for naming output files."
     )
 
+    parser.add_argument(
+        "-w","--workers",
+        type=int,
+        default=1,
+        help="Number of processes reading directories and scanning fp/fn vcfs concurrently (default: 1)"
+    )
+
+    parser.add_argument(
+        "--stratify",
+        action="store_true",
+        help="Also write precision/recall/F1 per SV type and SV size bin from the tp-base/tp-comp/fp/fn vcfs"
+    )
+
     args = parser.parse_args()
 
-    load_jsons(args.dirs, args.cohort)
+    load_jsons(args.dirs, args.cohort, args.workers)
+
+    if args.stratify:
+        stratified_metrics(args.dirs, args.cohort, args.workers)
 
 
-    count_bps_fn_fp(args.dirs, args.cohort)
+    count_bps_fn_fp(args.dirs, args.cohort, args.workers)
 
 
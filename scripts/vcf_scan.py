@@ -0,0 +1,613 @@
+#!/usr/bin/env python3
+import io
+from functools import cached_property
+from itertools import chain, islice
+
+import numpy as np
+
+from bgzf_reader import open_gzip
+
+"""
+    Single pass VCF scanning shared by the SV scripts.
+
+    A VcfScanner decodes a VCF once, in blocks of records, and hands every block to the
+    accumulators registered on it. Block columns (SVTYPE, SVLEN, genotypes, ...) are only
+    decoded when an accumulator asks for them, and are decoded once however many
+    accumulators use them.
+
+    Usage:
+        scanner = VcfScanner("your.vcf.gz")
+        ins_del = scanner.register(InsDelAccumulator())
+        svtypes = scanner.register(SvTypeAccumulator())
+        scanner.run()
+        print(ins_del.total_ins, ins_del.total_del, svtypes.svTypes)
+
+    vcf_variant_counts.py feeds pysam records to the same accumulators through record_blocks.
+"""
+
+
+def open_vcf(path, threads=None):
+    """ text stream of a VCF, bgzipped VCFs are inflated on threads (see bgzf_reader) """
+    return io.TextIOWrapper(open_vcf_binary(path, threads))
+
+
+def open_vcf_binary(path, threads=None):
+    """ binary stream of the decompressed VCF """
+    if str(path).endswith(".gz"):
+        return open_gzip(path, threads)
+    return open(path, "rb")
+
+
+class LengthAccumulator:
+    """
+    Compact store of the SV lengths of one SVTYPE.
+
+    Lengths are kept exactly in a growable int64 array. In sketch mode only counts over
+    fixed signed log-spaced bins are kept, so memory stays constant however many records
+    are added, at the cost of ~12% relative resolution for lengths above 10bp.
+    """
+
+    # integer bin edges, one bin per value up to 10 then 20 bins per decade up to 1Gbp
+    edges = np.unique(np.round(np.logspace(0, 9, 9*20+1))).astype(np.int64)
+
+    def __init__(self, sketch=False):
+        self.sketch = sketch
+        self.count = 0
+        if sketch:
+            # negative bins, a zero bin, then positive bins
+            self._hist = np.zeros(2*len(self.edges)+1, dtype=np.int64)
+        else:
+            self._buf = np.empty(1024, dtype=np.int64)
+
+    def __len__(self):
+        return self.count
+
+    def extend(self, lengths):
+        """ add a sequence of integer lengths """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if self.sketch:
+            self._hist += np.bincount(self._bin_index(lengths), minlength=len(self._hist))
+        else:
+            needed = self.count + len(lengths)
+            if needed > len(self._buf):
+                grown = np.empty(max(needed, 2*len(self._buf)), dtype=np.int64)
+                grown[:self.count] = self._buf[:self.count]
+                self._buf = grown
+            self._buf[self.count:needed] = lengths
+        self.count += len(lengths)
+
+    def merge(self, other):
+        """ add the lengths of another accumulator, keeping the order they were added in """
+        if other.sketch:
+            if not self.sketch:
+                raise ValueError('cannot merge a length sketch into exact lengths')
+            self._hist += other._hist
+            self.count += other.count
+        else:
+            self.extend(other.values())
+
+    def values(self):
+        """ the exact lengths in the order they were added """
+        if self.sketch:
+            raise ValueError('exact lengths are not kept in sketch mode')
+        return self._buf[:self.count]
+
+    def _bin_index(self, lengths):
+        mag = np.searchsorted(self.edges, np.abs(lengths), side='right')
+        return len(self.edges) + np.sign(lengths)*mag
+
+    def histogram(self):
+        """ (low, high, count) arrays of the non-empty bins, high is exclusive """
+        if self.sketch:
+            hist = self._hist
+        else:
+            hist = np.bincount(self._bin_index(self.values()), minlength=2*len(self.edges)+1)
+
+        # magnitude bounds of each bin, mirrored for the negative bins
+        upper = np.append(self.edges, np.iinfo(np.int64).max)
+        pos_low = np.concatenate(([0], self.edges))
+        pos_high = np.concatenate(([1], upper[1:]))
+        low = np.concatenate((1-pos_high[:0:-1], pos_low))
+        high = np.concatenate((1-pos_low[:0:-1], pos_high))
+
+        nonzero = hist > 0
+        return low[nonzero], high[nonzero], hist[nonzero]
+
+    def plot_values(self, max_points):
+        """
+        Lengths to draw in a violin/strip plot.
+
+        All lengths when there are at most max_points of them, otherwise max_points
+        evenly spaced quantiles, which keep the shape of the distribution.
+        """
+        if not self.sketch:
+            if self.count <= max_points:
+                return self.values()
+            order = np.sort(self.values())
+            return order[np.linspace(0, self.count-1, max_points).astype(np.int64)]
+
+        low, high, counts = self.histogram()
+        n_points = min(self.count, max_points)
+        cumulative = np.cumsum(counts)
+        ranks = np.linspace(0, self.count-1, n_points)
+        bins = np.searchsorted(cumulative, ranks, side='right')
+        # geometric midpoint of each bin, the bins are log spaced
+        mid = np.sign(low+high-1) * np.sqrt(np.maximum(np.abs(low), 1) * np.maximum(np.abs(high-1), 1))
+        mid[(low == 0) & (high == 1)] = 0
+        return np.round(mid[bins]).astype(np.int64)
+
+
+def new_svtype(length_sketch=False):
+    """ empty svTypes entry: record count and a LengthAccumulator of SV lengths """
+    return {'count':0,'lengths':LengthAccumulator(length_sketch)}
+
+
+def _info_value(info, key):
+    """ raw value of key in an INFO string, True for a flag, None if absent """
+    for field in info.split(";"):
+        name, _, value = field.partition("=")
+        if name == key:
+            return value if value else True
+    return None
+
+
+def _parse_gt(gt):
+    """ GT string to a tuple of allele indexes, '.' alleles are None, () for an empty string """
+    if not gt:
+        return ()
+    return tuple(None if allele == "." else int(allele) for allele in gt.replace("|", "/").split("/"))
+
+
+class _Codes(dict):
+    """ number of every distinct key in order of first appearance, counted on lookup """
+
+    def __missing__(self, key):
+        code = self[key] = len(self)
+        return code
+
+
+def genotype_array(gts, num_records, num_samples):
+    """
+    Pack per record, per sample GT tuples into a records x samples x ploidy int16 array.
+
+    Missing ('.') alleles, and the padding of samples with a lower ploidy than the block, are -1.
+    """
+    ploidy = max((len(gt) for gt in gts), default=0)
+
+    # None alleles become nan in a float array, pad short genotypes with None as well
+    padded = [gt if len(gt) == ploidy else tuple(gt) + (None,)*(ploidy-len(gt)) for gt in gts]
+    gt_array = np.array(padded, dtype=np.float32).reshape(num_records, num_samples, ploidy)
+
+    return np.nan_to_num(gt_array, nan=-1).astype(np.int16)
+
+
+def gt_string_array(gt_strings, num_records, num_samples):
+    """
+    genotype_array of GT strings, one per record and sample ('' for no GT). A block holds
+    few distinct strings, so each is parsed once and the array is gathered from them.
+    """
+    codes = _Codes()
+    index = np.fromiter(map(codes.__getitem__, gt_strings), dtype=np.intp, count=len(gt_strings))
+    alleles = genotype_array([_parse_gt(gt) for gt in codes], len(codes), 1)[:, 0, :]
+    return alleles[index].reshape(num_records, num_samples, alleles.shape[1])
+
+
+class SiteBlock:
+    """
+    Columns of a block of VCF records. Every column is decoded on first use and cached,
+    so accumulators sharing a block share the decoding work.
+    """
+
+    def __init__(self, num_samples):
+        self.num_samples = num_samples
+
+    @cached_property
+    def svlen(self):
+        """
+        SVLEN of each record (the first value of a multi-valued SVLEN, 0 for '.'), or when
+        there is no SVLEN the REF length if REF and the number of ALTs have the same length, else 0.
+        """
+        lengths = []
+        for raw, ref, alts in zip(self._raw_svlen, self.ref, self.alts):
+            if raw is None:
+                lengths.append(len(ref) if len(alts) - len(ref) == 0 else 0)
+            else:
+                lengths.append(raw)
+        return lengths
+
+    @cached_property
+    def sv_size(self):
+        """
+        Absolute SV size of each record: |SVLEN|, or for sequence-resolved records without
+        SVLEN the |REF/ALT length difference| of the first ALT (0 for symbolic ALTs).
+        """
+        sizes = []
+        for raw, ref, alts in zip(self._raw_svlen, self.ref, self.alts):
+            if raw is not None:
+                sizes.append(abs(raw))
+            elif alts[0].startswith("<"):
+                sizes.append(0)
+            else:
+                sizes.append(abs(len(alts[0]) - len(ref)))
+        return sizes
+
+    @cached_property
+    def sv_kind(self):
+        """ SVTYPE of each record, or INS/DEL/SNV from the REF/ALT lengths when there is no SVTYPE """
+        kinds = []
+        for svtype, ref, alts in zip(self.svtype, self.ref, self.alts):
+            if svtype is None:
+                d = len(alts[0]) - len(ref)
+                svtype = "INS" if d > 0 else "DEL" if d < 0 else "SNV"
+            kinds.append(svtype)
+        return kinds
+
+    @cached_property
+    def alt_dosage(self):
+        """ records x samples number of alleles that are not '.' nor 0 """
+        return (self.genotypes > 0).sum(axis=2, dtype=np.int16)
+
+
+class TextBlock(SiteBlock):
+    """ SiteBlock over tab split VCF text lines """
+
+    def __init__(self, fields, num_samples):
+        super().__init__(num_samples)
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.fields)
+
+    @cached_property
+    def chrom(self):
+        return [f[0] for f in self.fields]
+
+    @cached_property
+    def pos(self):
+        return [int(f[1]) for f in self.fields]
+
+    @cached_property
+    def ref(self):
+        return [f[3] for f in self.fields]
+
+    @cached_property
+    def alts(self):
+        return [f[4].split(",") for f in self.fields]
+
+    @cached_property
+    def svtype(self):
+        return [_info_value(f[7], "SVTYPE") for f in self.fields]
+
+    @cached_property
+    def _raw_svlen(self):
+        raw = []
+        for f in self.fields:
+            value = _info_value(f[7], "SVLEN")
+            if value is None or value is True:
+                raw.append(None)
+            else:
+                first = value.split(",")[0]
+                raw.append(0 if first == "." else int(first))
+        return raw
+
+    @cached_property
+    def genotypes(self):
+        gt_strings = []
+        for f in self.fields:
+            keys = f[8].split(":") if len(f) > 8 else []
+            if "GT" not in keys:
+                gt_strings.extend([""]*self.num_samples)
+            elif keys[0] == "GT":
+                # where the VCF spec puts it
+                gt_strings.extend([sample.partition(":")[0] for sample in f[9:]])
+            else:
+                gt_index = keys.index("GT")
+                for sample in f[9:]:
+                    values = sample.split(":")
+                    gt_strings.append(values[gt_index] if gt_index < len(values) else "")
+        return gt_string_array(gt_strings, len(self.fields), self.num_samples)
+
+
+class RecordBlock(SiteBlock):
+    """ SiteBlock over pysam VariantRecords """
+
+    def __init__(self, records, num_samples):
+        super().__init__(num_samples)
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    @cached_property
+    def chrom(self):
+        return [record.contig for record in self.records]
+
+    @cached_property
+    def pos(self):
+        return [record.pos for record in self.records]
+
+    @cached_property
+    def ref(self):
+        return [record.ref for record in self.records]
+
+    @cached_property
+    def alts(self):
+        # a '.' ALT is None in pysam, keep it as '.' like the text decoder
+        return [record.alts or (".",) for record in self.records]
+
+    @cached_property
+    def svtype(self):
+        return [record.info['SVTYPE'] for record in self.records]
+
+    @cached_property
+    def _raw_svlen(self):
+        raw = []
+        for record in self.records:
+            if 'SVLEN' not in record.info:
+                raw.append(None)
+                continue
+            svlen = record.info['SVLEN']
+            # Number=A/. SVLEN fields come back as a tuple, keep the first alt's length
+            if isinstance(svlen, tuple):
+                svlen = svlen[0]
+            raw.append(svlen if svlen is not None else 0)
+        return raw
+
+    @cached_property
+    def genotypes(self):
+        # pysam formats a whole record in C, far faster than looking up the GT of every sample
+        fields = [str(record).rstrip("\n").split("\t") for record in self.records]
+        return TextBlock(fields, self.num_samples).genotypes
+
+
+def text_blocks(lines, num_samples, batch_size=1000):
+    """ split the data lines of a VCF into TextBlocks of batch_size records, skipping header lines """
+    records = (line.rstrip("\r\n").split("\t") for line in lines if not line.startswith("#"))
+    while True:
+        fields = list(islice(records, batch_size))
+        if not fields:
+            return
+        yield TextBlock(fields, num_samples)
+
+
+def record_blocks(records, num_samples, batch_size=1000):
+    """ group pysam VariantRecords into RecordBlocks of batch_size records """
+    records = iter(records)
+    while True:
+        block = list(islice(records, batch_size))
+        if not block:
+            return
+        yield RecordBlock(block, num_samples)
+
+
+class AlleleCountAccumulator:
+    """ per sample number of alleles that are not '.' nor 0 """
+
+    def __init__(self, samples):
+        self.samples = list(samples)
+        self.counts = np.zeros(len(self.samples), dtype=np.int64)
+
+    def update(self, block):
+        self.counts += block.alt_dosage.sum(axis=0, dtype=np.int64)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def variant_counts(self):
+        return {sample:int(count) for sample, count in zip(self.samples, self.counts)}
+
+
+class SvTypeAccumulator:
+    """
+    Record count and SV lengths per SVTYPE, as a vcf_variant_counts svTypes dictionary
+    in order of first appearance.
+    """
+
+    def __init__(self, length_sketch=False, svTypes=None):
+        self.length_sketch = length_sketch
+        self.svTypes = {} if svTypes is None else svTypes
+
+    def update(self, block):
+        block_lengths = {}
+        for svtype, length in zip(block.svtype, block.svlen):
+            block_lengths.setdefault(svtype, []).append(length)
+
+        for svtype, lengths in block_lengths.items():
+            if svtype not in self.svTypes:
+                self.svTypes[svtype] = new_svtype(self.length_sketch)
+            self.svTypes[svtype]['count'] += len(lengths)
+            self.svTypes[svtype]['lengths'].extend(lengths)
+
+    def merge(self, other):
+        for svtype, vals in other.svTypes.items():
+            if svtype not in self.svTypes:
+                self.svTypes[svtype] = new_svtype(vals['lengths'].sketch)
+            self.svTypes[svtype]['count'] += vals['count']
+            self.svTypes[svtype]['lengths'].merge(vals['lengths'])
+
+
+class InsDelAccumulator:
+    """
+    Total inserted and deleted bp from the REF/ALT length difference of every
+    sequence-resolved ALT. Symbolic ALTs like <INS>, <DEL>, <DUP> are skipped.
+    """
+
+    def __init__(self):
+        self.total_ins = 0
+        self.total_del = 0
+
+    def update(self, block):
+        for ref, alts in zip(block.ref, block.alts):
+            for alt in alts:
+                # skip symbolic calls like <INS>, <DEL>, <DUP>, etc
+                if alt.startswith("<") and alt.endswith(">"):
+                    continue
+
+                # compute length delta
+                d = len(alt) - len(ref)
+
+                if d > 0:
+                    self.total_ins += d
+                elif d < 0:
+                    self.total_del += abs(d)
+
+    def update_from_bytes(self, stream, chunk_size=1 << 22):
+        """
+        Fast path over the raw bytes of the VCF data lines, used by VcfScanner when this is
+        the only accumulator. Reads chunk_size blocks, splits off only the first five fields
+        of each line and never builds str objects; totals match update().
+
+        Returns the number of records read.
+        """
+        total_ins = 0
+        total_del = 0
+        num_records = 0
+        tail = b""
+
+        while True:
+            chunk = stream.read(chunk_size)
+            if chunk:
+                chunk = tail + chunk
+                cut = chunk.rfind(b"\n")
+                if cut < 0:
+                    tail = chunk
+                    continue
+                tail = chunk[cut+1:]
+                lines = chunk[:cut].split(b"\n")
+            else:
+                lines = [tail]
+
+            for line in lines:
+                if not line or line[0] == 35: # '#'
+                    continue
+                num_records += 1
+
+                fields = line.split(b"\t", 5)
+                ref_len = len(fields[3])
+                for alt in fields[4].rstrip(b"\r").split(b","):
+                    # skip symbolic calls like <INS>, <DEL>, <DUP>, etc
+                    if alt[:1] == b"<" and alt[-1:] == b">":
+                        continue
+
+                    d = len(alt) - ref_len
+                    if d > 0:
+                        total_ins += d
+                    elif d < 0:
+                        total_del -= d
+
+            if not chunk:
+                break
+
+        self.total_ins += total_ins
+        self.total_del += total_del
+        return num_records
+
+    def merge(self, other):
+        self.total_ins += other.total_ins
+        self.total_del += other.total_del
+
+
+class LengthHistogramAccumulator:
+    """
+    Record counts binned by absolute SV size (SiteBlock.sv_size), optionally per SV type
+    (SiteBlock.sv_kind).
+
+    edges are increasing bin edges; bin i holds edges[i] <= size < edges[i+1], sizes
+    outside the edges are not counted.
+    """
+
+    def __init__(self, edges, by_type=False):
+        self.edges = np.asarray(edges)
+        self.by_type = by_type
+        self.counts = {}
+
+    def update(self, block):
+        sizes = np.asarray(block.sv_size, dtype=np.int64)
+        keys = block.sv_kind if self.by_type else [None]*len(block)
+        bins = np.searchsorted(self.edges, sizes, side='right') - 1
+        in_range = (bins >= 0) & (bins < len(self.edges)-1)
+
+        for key in set(keys):
+            selected = in_range & (np.asarray(keys, dtype=object) == key)
+            hist = np.bincount(bins[selected], minlength=len(self.edges)-1)
+            self.counts[key] = self.counts.get(key, 0) + hist
+
+    def merge(self, other):
+        for key, hist in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + hist
+
+
+class VcfScanner:
+    """
+    Decode a plain or gzipped VCF once and feed every block of records to the registered
+    accumulators. The header is read on construction so accumulators can be built from
+    scanner.samples before run().
+
+    When the only accumulator has an update_from_bytes fast path (InsDelAccumulator) and
+    fast is True, run() hands it the raw decompressed bytes instead of decoding blocks.
+    bgzipped VCFs are inflated on threads threads (default up to 8, 1 for the gzip module).
+    """
+
+    def __init__(self, path, batch_size=1000, fast=True, threads=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.fast = fast
+        self.accumulators = []
+        self.num_records = 0
+
+        self._fh = open_vcf_binary(path, threads)
+        self.header = []
+        self._first_line = b""
+        for line in iter(self._fh.readline, b""):
+            if not line.startswith(b"#"):
+                # headerless VCF, keep the first data line for run()
+                self._first_line = line
+                break
+            self.header.append(line.decode())
+            if line.startswith(b"#CHROM"):
+                break
+        self.samples = self.header[-1].rstrip("\r\n").split("\t")[9:] if self.header else []
+
+    def register(self, accumulator):
+        """ add an accumulator to the scan, returns it for convenience """
+        self.accumulators.append(accumulator)
+        return accumulator
+
+    def run(self):
+        """ scan every record, returns the number of records """
+        with self._fh:
+            if self.fast and len(self.accumulators) == 1 and hasattr(self.accumulators[0], "update_from_bytes"):
+                stream = io.BufferedReader(_Prepend(self._first_line, self._fh)) if self._first_line else self._fh
+                self.num_records += self.accumulators[0].update_from_bytes(stream)
+                return self.num_records
+
+            lines = io.TextIOWrapper(self._fh)
+            if self._first_line:
+                lines = chain([self._first_line.decode()], lines)
+
+            for block in text_blocks(lines, len(self.samples), self.batch_size):
+                self.num_records += len(block)
+                for accumulator in self.accumulators:
+                    accumulator.update(block)
+        return self.num_records
+
+
+class _Prepend(io.RawIOBase):
+    """ raw stream of some already read bytes followed by the rest of a stream """
+
+    def __init__(self, head, stream):
+        self._head = head
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._head:
+            n = min(len(buffer), len(self._head))
+            buffer[:n] = self._head[:n]
+            self._head = self._head[n:]
+            return n
+        data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
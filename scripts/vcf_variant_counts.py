@@ -1,11 +1,17 @@
 import argparse
 import pandas as pd
+import numpy as np
 import pysam
 import os
 import sys
 import matplotlib.pyplot as plt
 import seaborn as sns
 import datetime
+import hashlib
+import json
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from vcf_scan import record_blocks, AlleleCountAccumulator, SvTypeAccumulator, InsDelAccumulator, new_svtype
 
 """
 	Script to count up SV types and VCF alleles per sample. 
@@ -14,6 +20,10 @@ import datetime
 
 	Add: --plot_violin to output a violin+swarm plot of the counts per sample
 
+	Add: --workers 8 to count regions of a tabix/CSI indexed vcf in parallel
+
+	Add: --genotype_cache DIR to reuse one parse of the vcf across runs with different plot flags
+
 	Author: Melissa Meredith UCSC
 	02/2025
 """
@@ -32,15 +42,447 @@ sns.set(
 
 
 
-def vcfEntriesPerSample(in_vcf):
+def vcf_cache_key(in_vcf):
+	""" size, mtime and header hash identifying the version of a vcf a genotype cache was built from """
+	stat = os.stat(in_vcf)
+	with pysam.VariantFile(in_vcf) as vcf_file:
+		header_hash = hashlib.sha1(str(vcf_file.header).encode()).hexdigest()
+
+	return {'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns, 'header_sha1':header_hash}
+
+
+def genotype_cache_path(cache_dir, in_vcf, key):
+	""" cache directory for one version of a vcf, several vcfs can share cache_dir """
+	digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+	return os.path.join(cache_dir, f'{os.path.basename(in_vcf)}.{digest}')
+
+
+def genotype_codes(block):
+	"""
+	records x samples 2-bit genotype codes of a vcf_scan block: the number of alt alleles
+	(0 hom ref, 1 het, 2 hom alt) and 3 for a genotype without any called allele
+	"""
+	called = (block.genotypes >= 0).any(axis=2)
+	return np.where(called, block.alt_dosage, 3).astype(np.uint8)
+
+
+def code_dosage(codes):
+	""" alt allele dosage of 2-bit genotype codes, 0 for the missing code """
+	return np.where(codes == 3, 0, codes)
+
+
+def pack_codes(codes):
+	""" pack a records x samples array of 2-bit codes into 4 samples per byte """
+	num_records, num_samples = codes.shape
+	padded = np.zeros((num_records, -(-num_samples//4)*4), dtype=np.uint8)
+	padded[:, :num_samples] = codes
+	quads = padded.reshape(num_records, -1, 4)
+	return quads[:,:,0] | (quads[:,:,1] << 2) | (quads[:,:,2] << 4) | (quads[:,:,3] << 6)
+
+
+def unpack_codes(packed, num_samples):
+	""" inverse of pack_codes """
+	shifts = np.array([0, 2, 4, 6], dtype=np.uint8)
+	quads = (packed[:,:,None] >> shifts) & 3
+	return quads.reshape(packed.shape[0], -1)[:, :num_samples]
+
+
+def genotype_shard_path(cache_path, shard):
+	""" directory of the genotypes of one region (shard) of a vcf in its cache """
+	return os.path.join(cache_path, f'shard_{shard:06d}')
+
+
+class GenotypeCacheWriter:
+	"""
+	Write the 2-bit packed genotype codes (see genotype_codes) and columnar site arrays
+	(contig, pos, SVTYPE, SVLEN) of the records of one shard of a vcf while it is being
+	counted, so every worker writes its own region.
+
+	Every array is appended to a raw binary file block by block; shard.json, written last
+	by close(), marks the shard complete. A shard that saw more than 2 alt alleles in a
+	genotype cannot be coded and is left without shard.json.
+	"""
+
+	site_dtypes = {'contig':np.int32, 'pos':np.int64, 'svtype':np.int32, 'svlen':np.int64}
+
+	def __init__(self, path, num_samples):
+		os.makedirs(path, exist_ok=True)
+		self.path = path
+		self.num_samples = num_samples
+		self.contigs = {}
+		self.svtypes = {}
+		self.num_records = 0
+		self.valid = True
+		# a shard rewritten after a failed run is incomplete until closed again
+		if os.path.exists(os.path.join(path, 'shard.json')):
+			os.remove(os.path.join(path, 'shard.json'))
+		self._files = {name:open(os.path.join(path, name+'.bin'), 'wb') for name in ['genotypes', *self.site_dtypes]}
+
+	def _codes(self, names, lookup):
+		return [lookup.setdefault(name, len(lookup)) for name in names]
+
+	def add_block(self, block):
+		""" append the sites and genotype codes of a vcf_scan RecordBlock """
+		dosage = block.alt_dosage
+		if dosage.size and dosage.max() > 2:
+			self.valid = False
+		if not self.valid:
+			return
+
+		sites = {
+			'contig':self._codes(block.chrom, self.contigs),
+			'pos':block.pos,
+			'svtype':self._codes(block.svtype, self.svtypes),
+			'svlen':block.svlen,
+		}
+		for name, dtype in self.site_dtypes.items():
+			np.asarray(sites[name], dtype=dtype).tofile(self._files[name])
+		pack_codes(genotype_codes(block)).tofile(self._files['genotypes'])
+		self.num_records += len(block)
+
+	def close(self):
+		for fh in self._files.values():
+			fh.close()
+
+		if not self.valid:
+			print(f'genotypes with more than 2 alt alleles do not fit the 2-bit genotype cache, not caching {self.path}')
+			return
+
+		shard = {
+			'num_records':self.num_records,
+			'contigs':list(self.contigs),
+			'svtypes':list(self.svtypes),
+		}
+		with open(os.path.join(self.path, 'shard.json'), 'w') as fh:
+			json.dump(shard, fh)
+
+
+def finish_genotype_cache(cache_path, key, samples, num_shards):
+	""" write meta.json, marking a cache complete, once every shard of it was written """
+	shards = [os.path.basename(genotype_shard_path(cache_path, i)) for i in range(num_shards)]
+	if not all(os.path.exists(os.path.join(cache_path, shard, 'shard.json')) for shard in shards):
+		print(f'not every region fit the genotype cache, not caching {cache_path}')
+		return
+
+	meta = {
+		'key':key,
+		'samples':list(samples),
+		'shards':shards,
+	}
+	with open(os.path.join(cache_path, 'meta.json'), 'w') as fh:
+		json.dump(meta, fh)
+	print(f'wrote genotype cache {cache_path} of {num_shards} regions')
+
+
+def load_genotype_cache(path, key, length_sketch=False, chunk_records=100_000):
+	"""
+	Recount the per sample alleles and the svTypes accumulators from a genotype cache.
+
+	The packed genotype codes of every shard are memory mapped and unpacked chunk_records
+	rows at a time, shards in file order. Returns None if the cache is missing,
+	incomplete or was built from another version of the vcf.
+	"""
+	meta_path = os.path.join(path, 'meta.json')
+	if not os.path.exists(meta_path):
+		return None
+
+	with open(meta_path) as fh:
+		meta = json.load(fh)
+	if meta['key'] != key or 'shards' not in meta:
+		return None
+
+	num_records = 0
+	num_samples = len(meta['samples'])
+	sample_counts = np.zeros(num_samples, dtype=np.int64)
+	svTypes = {}
+	for shard in meta['shards']:
+		shard_path = os.path.join(path, shard)
+		with open(os.path.join(shard_path, 'shard.json')) as fh:
+			shard_meta = json.load(fh)
+		shard_records = shard_meta['num_records']
+		num_records += shard_records
+		if shard_records == 0:
+			continue
+
+		packed = np.memmap(os.path.join(shard_path, 'genotypes.bin'), dtype=np.uint8, mode='r', shape=(shard_records, -(-num_samples//4)))
+		for i in range(0, shard_records, chunk_records):
+			sample_counts += code_dosage(unpack_codes(np.asarray(packed[i:i+chunk_records]), num_samples)).sum(axis=0, dtype=np.int64)
+
+		svtype_codes = np.fromfile(os.path.join(shard_path, 'svtype.bin'), dtype=np.int32)
+		svlens = np.fromfile(os.path.join(shard_path, 'svlen.bin'), dtype=np.int64)
+		# svtype codes were assigned in order of first appearance in the shard, and shards are in file order
+		for code, svtype in enumerate(shard_meta['svtypes']):
+			lengths = svlens[svtype_codes == code]
+			if svtype not in svTypes:
+				svTypes[svtype] = new_svtype(length_sketch)
+			svTypes[svtype]['count'] += len(lengths)
+			svTypes[svtype]['lengths'].extend(lengths)
+
+	variant_counts = {sample:int(count) for sample, count in zip(meta['samples'], sample_counts)}
+	return num_records, variant_counts, svTypes
+
+
+def count_records(records, variant_counts, svTypes, batch_size=1000, length_sketch=False, cache_writer=None, checkpoint=None, checkpoint_every=500_000, extra_accumulators=()):
+	"""
+	Add the SV type, SV length and per sample alleles of each record to the accumulators.
+
+	Records are decoded in vcf_scan blocks of batch_size records, so the per sample allele
+	counts are array reductions over a genotype array instead of a python loop over every
+	sample. extra_accumulators (e.g. a vcf_scan.InsDelAccumulator) are fed the same blocks,
+	and each block is also appended to cache_writer when one is given.
+
+	When a checkpoint function is given it is called with the number of records counted
+	so far, at the first block boundary after every checkpoint_every records, once
+	variant_counts and svTypes hold every record read so far.
+
+	Returns the number of records counted.
+	"""
+	num_records = 0
+	last_checkpoint = 0
+	allele_counter = AlleleCountAccumulator(variant_counts)
+	accumulators = [allele_counter, SvTypeAccumulator(length_sketch, svTypes), *extra_accumulators]
+
+	def flush_sample_counts():
+		# sample columns are in header order, the same order as the variant_counts keys
+		for sample, count in zip(variant_counts, allele_counter.counts):
+			variant_counts[sample] += int(count)
+		allele_counter.counts[:] = 0
+
+	for block in record_blocks(records, len(variant_counts), batch_size):
+
+		# increment the record counter
+		num_records += len(block)
+
+		# add up the SV types and lengths and the alleles ( 1's ) of each sample column
+		for accumulator in accumulators:
+			accumulator.update(block)
+
+		if cache_writer is not None:
+			cache_writer.add_block(block)
+
+		if checkpoint is not None and num_records - last_checkpoint >= checkpoint_every:
+			flush_sample_counts()
+			checkpoint(num_records)
+			last_checkpoint = num_records
+
+	flush_sample_counts()
+
+	return num_records
+
+
+def region_shards(vcf_file, shard_size):
+	"""
+	Split the contigs of an indexed vcf into (contig, start, end) regions in file order.
+
+	Contigs without a header length, and the last region of every contig, are left open ended
+	so records past the declared contig length are still counted.
+	"""
+	shards = []
+	for contig in vcf_file.index.keys():
+		length = None
+		if contig in vcf_file.header.contigs:
+			length = vcf_file.header.contigs[contig].length
+
+		if not shard_size or length is None or length <= shard_size:
+			shards.append((contig, 0, None))
+			continue
+
+		for start in range(0, length, shard_size):
+			end = start + shard_size
+			shards.append((contig, start, end if end < length else None))
+
+	return shards
+
+
+def count_region(in_vcf, contig, start, end, batch_size=1000, length_sketch=False, ins_del=False, cache_shard_path=None):
+	"""
+	Count the records that start inside one region of an indexed vcf, writing their
+	genotypes to the genotype cache shard at cache_shard_path if given.
+
+	Records overlapping the left edge of the region started in the previous shard and
+	were counted there, so they are skipped here.
+	"""
+	vcf_file = pysam.VariantFile(in_vcf)
+
+	variant_counts = {sample:0 for sample in vcf_file.header.samples}
+	svTypes = {}
+	extra_accumulators = [InsDelAccumulator()] if ins_del else []
+	cache_writer = GenotypeCacheWriter(cache_shard_path, len(variant_counts)) if cache_shard_path else None
+
+	records = (record for record in vcf_file.fetch(contig, start, end) if record.start >= start)
+	num_records = count_records(records, variant_counts, svTypes, batch_size, length_sketch, cache_writer, extra_accumulators=extra_accumulators)
+
+	vcf_file.close()
+	if cache_writer is not None:
+		cache_writer.close()
+
+	return num_records, variant_counts, svTypes, extra_accumulators
+
+
+def _count_region_star(shard_args):
+	return count_region(*shard_args)
+
+
+def merge_counts(shard_results, variant_counts, svTypes, extra_accumulators=()):
+	"""
+	Merge per shard accumulators into the genome wide ones.
+
+	Shards are merged in file order so SV type order and length order match a serial pass.
+	"""
+	num_records = 0
+	svtype_counter = SvTypeAccumulator(svTypes=svTypes)
+	for shard_records, shard_counts, shard_svTypes, shard_extra in shard_results:
+		num_records += shard_records
+
+		for sample, count in shard_counts.items():
+			variant_counts[sample] += count
+
+		svtype_counter.merge(SvTypeAccumulator(svTypes=shard_svTypes))
+
+		for accumulator, shard_accumulator in zip(extra_accumulators, shard_extra):
+			accumulator.merge(shard_accumulator)
+
+	return num_records
+
+
+def write_checkpoint(path, state):
+	""" atomically replace a pickled checkpoint, a crash mid write leaves the previous one in place """
+	tmp_path = path+'.tmp'
+	with open(tmp_path, 'wb') as fh:
+		pickle.dump(state, fh, protocol=pickle.HIGHEST_PROTOCOL)
+	os.replace(tmp_path, path)
+
+
+def read_checkpoint(path, key, config):
+	""" load a pickled checkpoint, exit if it belongs to another vcf version or other counting options """
+	if not os.path.exists(path):
+		return None
+
+	with open(path, 'rb') as fh:
+		state = pickle.load(fh)
+
+	if state['key'] != key or state['config'] != config:
+		print(f'checkpoint {path} was written for a different vcf or different options, remove it to start over')
+		sys.exit(1)
+
+	return state
+
+
+def count_serial_resumable(in_vcf, vcf_file, variant_counts, svTypes, batch_size, length_sketch, checkpoint_dir, checkpoint_every, resume, key, extra_accumulators=()):
+	"""
+	Single process pass that checkpoints the accumulators with the BGZF virtual offset
+	(or plain file offset) of the next record to checkpoint_dir/state.pkl.
+
+	On resume the file is seeked to the saved offset, so every record before it is
+	counted exactly once from the saved accumulators.
+	"""
+	state_path = os.path.join(checkpoint_dir, 'state.pkl')
+	config = {'mode':'serial', 'length_sketch':length_sketch, 'extra':[type(acc).__name__ for acc in extra_accumulators]}
+	num_done = 0
+
+	state = read_checkpoint(state_path, key, config) if resume else None
+	if state is not None:
+		num_done = state['num_records']
+		variant_counts.update(state['variant_counts'])
+		svTypes.update(state['svTypes'])
+		for accumulator, saved in zip(extra_accumulators, state['extra_accumulators']):
+			accumulator.merge(saved)
+		vcf_file.seek(state['offset'])
+		print(f'resuming {in_vcf} after {num_done} records at {state["last_site"]}')
+
+	last_site = [None]
+	def tracked(records):
+		for record in records:
+			last_site[0] = (record.contig, record.pos)
+			yield record
+
+	def checkpoint(num_records):
+		write_checkpoint(state_path, {
+			'key':key,
+			'config':config,
+			'num_records':num_done+num_records,
+			'offset':vcf_file.tell(),
+			'last_site':last_site[0],
+			'variant_counts':variant_counts,
+			'svTypes':svTypes,
+			'extra_accumulators':extra_accumulators,
+		})
+
+	num_records = count_records(tracked(vcf_file), variant_counts, svTypes, batch_size, length_sketch, checkpoint=checkpoint, checkpoint_every=checkpoint_every, extra_accumulators=extra_accumulators)
+
+	# the pass finished, a later run should start over
+	if os.path.exists(state_path):
+		os.remove(state_path)
+
+	return num_done+num_records
+
+
+def count_shards_resumable(in_vcf, shards, workers, batch_size, length_sketch, checkpoint_dir, resume, key, ins_del=False):
+	"""
+	Count shards in a process pool, saving each finished shard's accumulators to
+	checkpoint_dir/shard_NNNNNN.pkl. On resume finished shards are loaded instead of recounted.
+
+	Returns the shard results in file order.
+	"""
+	config = {'mode':'shards', 'length_sketch':length_sketch, 'ins_del':ins_del, 'shards':shards}
+	shard_paths = [os.path.join(checkpoint_dir, f'shard_{i:06d}.pkl') for i in range(len(shards))]
+
+	shard_results = [None]*len(shards)
+	if resume:
+		for i, shard_path in enumerate(shard_paths):
+			state = read_checkpoint(shard_path, key, config)
+			if state is not None:
+				shard_results[i] = state['result']
+		print(f'resuming {in_vcf} with {sum(r is not None for r in shard_results)} of {len(shards)} regions already counted')
+
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		futures = {pool.submit(count_region, in_vcf, *shard, batch_size, length_sketch, ins_del):i for i, shard in enumerate(shards) if shard_results[i] is None}
+		for future in as_completed(futures):
+			i = futures[future]
+			shard_results[i] = future.result()
+			write_checkpoint(shard_paths[i], {'key':key, 'config':config, 'result':shard_results[i]})
+
+	for shard_path in shard_paths:
+		if os.path.exists(shard_path):
+			os.remove(shard_path)
+
+	return shard_results
+
+
+def vcfEntriesPerSample(in_vcf, workers=1, shard_size=10_000_000, batch_size=1000, length_sketch=False, genotype_cache=None, checkpoint_dir=None, checkpoint_every=500_000, resume=False, ins_del=False):
 	"""
 	Function that takes in a vcf with multiple samples and counts up genotypes of vcf entries per sample
 
 	for each sample column the number of alleles is counted and output as a tsv. 
 
+	With workers > 1 and a tabix/CSI index the genome is split into contig or shard_size
+	regions that are counted in separate processes and merged back in file order.
+
+	With a genotype_cache directory the counts are loaded from a packed genotype cache of
+	this version of the vcf when there is one, otherwise the cache is written during the pass,
+	one shard per region with workers.
+
+	With a checkpoint_dir the accumulators are checkpointed during the pass (every
+	checkpoint_every records, or after every region with workers) and resume=True picks
+	up from the last checkpoint.
+
+	With ins_del the total inserted and deleted bp are summed in the same pass and
+	written to a tsv, like svlen_summary.py does for a single vcf.
 	"""
 
+	extra_accumulators = [InsDelAccumulator()] if ins_del else []
+	key = None
+	if genotype_cache or checkpoint_dir:
+		key = vcf_cache_key(in_vcf)
 
+	if genotype_cache:
+		cache_path = genotype_cache_path(genotype_cache, in_vcf, key)
+		# the cache has no REF/ALT sequence to sum INS/DEL bp from
+		cached = None if ins_del else load_genotype_cache(cache_path, key, length_sketch)
+		if cached is not None:
+			print(f'loaded counts from genotype cache {cache_path}')
+			num_records, variant_counts, svTypes = cached
+			return write_sample_counts(in_vcf, num_records, variant_counts, svTypes)
 
 	# # Open the VCF file using pysam
 	vcf_file = pysam.VariantFile(in_vcf) 
@@ -49,52 +491,72 @@ def vcfEntriesPerSample(in_vcf):
 	variant_counts = {sample:0 for sample in vcf_file.header.samples}
 	# make a dictionary of SV types in the vcf
 	svTypes = {}
-	# keep track of the number of variants in the vcf
-	num_records = 0
-
-	for record in vcf_file:
 
-		# increment the record counter
-		num_records+=1
-
-		# add the SV type to the dictionary and/or increment the count and keep track of the SV length
-		if record.info['SVTYPE'] not in svTypes.keys():
-			if 'SVLEN' not in record.info:
-				ref_len = len(record.ref)
-				alt_len = len(record.alts)
-				if alt_len - ref_len == 0:
-					varLen = ref_len
-				else:
-					varLen = 0
-				svTypes[record.info['SVTYPE']]={'count':1,'lengths':[varLen]}
-			else:
-				svTypes[record.info['SVTYPE']]={'count':1,'lengths':[record.info['SVLEN']]}
+	write_cache = False
+	if genotype_cache and checkpoint_dir:
+		print('the genotype cache is not written by checkpointed runs')
+	elif genotype_cache:
+		write_cache = True
+		# the cache is incomplete until every shard of this pass is written
+		if os.path.exists(os.path.join(cache_path, 'meta.json')):
+			os.remove(os.path.join(cache_path, 'meta.json'))
+
+	if checkpoint_dir:
+		os.makedirs(checkpoint_dir, exist_ok=True)
+
+	if workers > 1 and vcf_file.index is None:
+		print(f'no tabix/CSI index found for {in_vcf}, counting with a single process')
+		workers = 1
+
+	num_shards = 1
+	if workers > 1:
+		shards = region_shards(vcf_file, shard_size)
+		num_shards = len(shards)
+		vcf_file.close()
+		print(f'counting {len(shards)} regions with {workers} workers')
+
+		if checkpoint_dir:
+			shard_results = count_shards_resumable(in_vcf, shards, workers, batch_size, length_sketch, checkpoint_dir, resume, key, ins_del)
+			num_records = merge_counts(shard_results, variant_counts, svTypes, extra_accumulators)
 		else:
-			svTypes[record.info['SVTYPE']]['count'] += 1
-			if 'SVLEN' in record.info:
-				svTypes[record.info['SVTYPE']]['lengths'].append(record.info['SVLEN'])
-			else:
-				ref_len = len(record.ref)
-				alt_len = len(record.alts)
-				if alt_len - ref_len == 0:
-					varLen = ref_len
-				else:
-					varLen = 0
-				svTypes[record.info['SVTYPE']]['lengths'].append(varLen)
-
-		# for each sample entry in the vcf record add up the alleles ( 1's )
-		for sample, data in record.samples.items():
-			
-			if 'GT' in data:
-				# print(record.info['SVTYPE'], 'sample', sample, data["GT"])
-				for allele in data["GT"]:
-					# count alleles that are not '.' nor 0
-					if allele is not None and allele > 0:
-						# increment the variant count for the sample 
-						variant_counts[sample] += 1
+			with ProcessPoolExecutor(max_workers=workers) as pool:
+				cache_shard_paths = [genotype_shard_path(cache_path, i) if write_cache else None for i in range(num_shards)]
+				shard_results = pool.map(_count_region_star, [(in_vcf,)+shard+(batch_size, length_sketch, ins_del, cache_shard_path) for shard, cache_shard_path in zip(shards, cache_shard_paths)])
+				num_records = merge_counts(shard_results, variant_counts, svTypes, extra_accumulators)
+	elif checkpoint_dir:
+		num_records = count_serial_resumable(in_vcf, vcf_file, variant_counts, svTypes, batch_size, length_sketch, checkpoint_dir, checkpoint_every, resume, key, extra_accumulators)
+		vcf_file.close()
+	else:
+		cache_writer = GenotypeCacheWriter(genotype_shard_path(cache_path, 0), len(variant_counts)) if write_cache else None
+		# keep track of the number of variants in the vcf
+		num_records = count_records(vcf_file, variant_counts, svTypes, batch_size, length_sketch, cache_writer, extra_accumulators=extra_accumulators)
+		vcf_file.close()
+		if cache_writer is not None:
+			cache_writer.close()
+
+	if write_cache:
+		finish_genotype_cache(cache_path, key, variant_counts, num_shards)
+
+	if ins_del:
+		write_ins_del(in_vcf, extra_accumulators[0])
+
+	return write_sample_counts(in_vcf, num_records, variant_counts, svTypes)
+
+
+def write_ins_del(in_vcf, ins_del_counter):
+	""" report and write out the total inserted and deleted bp of the vcf """
+	vcf_prefix = in_vcf.split(".")[0]
+	total_ins, total_del = ins_del_counter.total_ins, ins_del_counter.total_del
+
+	print(f"Total inserted sequence: {total_ins}")
+	print(f"Total deleted sequence:  {total_del}")
+
+	ins_del_df = pd.DataFrame([(total_ins, total_del, total_ins+total_del)], columns=['ins_bp','del_bp','total_bp'])
+	ins_del_df.to_csv(vcf_prefix+"_ins_del_bp.tsv", header=True, index=False, sep="\t")
 
-	vcf_file.close()
 
+def write_sample_counts(in_vcf, num_records, variant_counts, svTypes):
+	""" report the SV type counts and write the per sample variant counts tsv """
 
 	vcf_prefix = in_vcf.split(".")[0]
 	print(f'finished analyzing VCF: {num_records} variants in the {vcf_prefix}' )
@@ -141,25 +603,41 @@ def plot_violin_perSample(vcf_data, vcf_prefix):
 	plt.savefig(vcf_prefix+"_sample_variant_counts.png", dpi=300)
 
 
-def plot_violin_variantType(svTypes, vcf_prefix):
-	""" Plot variant type violin of variant lengths """
-	print('Plotting variant type violin')
+def write_variantType_lengths(svTypes, vcf_prefix, chunk_size=1_000_000):
+	"""
+	Write the SV lengths per SV type to a tsv in chunks, so the long-form table is never held in memory.
 
+	Sketch mode accumulators are written as a histogram with SVLEN_low (inclusive),
+	SVLEN_high (exclusive) and count columns instead of one row per record.
+	"""
+	out_tsv = vcf_prefix+"_variantType_counts.tsv"
+	sketch = any(vals['lengths'].sketch for vals in svTypes.values())
 
+	with open(out_tsv, "w") as out:
+		if sketch:
+			out.write("SVTYPE\tSVLEN_low\tSVLEN_high\tcount\n")
+		else:
+			out.write("SVTYPE\tSVLEN\n")
 
-	# convert dictionary to long-form DF
-	lfdata = []
-	for svtype, vals in svTypes.items():
-		if 'lengths' in vals.keys():
-			if len(vals['lengths'])>1:
-				for length in vals['lengths']:
-					lfdata.append({'SVTYPE':svtype, 'SVLEN':length})
-			else:
-				lfdata.append({'SVTYPE':svtype, 'SVLEN':vals['lengths']})
-	
-	lfdf = pd.DataFrame(lfdata)
+		for svtype, vals in svTypes.items():
+			if sketch:
+				low, high, counts = vals['lengths'].histogram()
+				pd.DataFrame({'SVTYPE':svtype, 'SVLEN_low':low, 'SVLEN_high':high, 'count':counts}).to_csv(out, header=False, index=False, sep="\t")
+				continue
+
+			lengths = vals['lengths'].values()
+			for i in range(0, len(lengths), chunk_size):
+				pd.DataFrame({'SVTYPE':svtype, 'SVLEN':lengths[i:i+chunk_size]}).to_csv(out, header=False, index=False, sep="\t")
+
+
+def plot_violin_variantType(svTypes, vcf_prefix, max_points=20000):
+	""" Plot variant type violin of variant lengths """
+	print('Plotting variant type violin')
+
+	write_variantType_lengths(svTypes, vcf_prefix)
 
-	lfdf.to_csv(vcf_prefix+"_variantType_counts.tsv", header=True, index=False, sep="\t")
+	# long-form DF of at most max_points representative lengths per SV type
+	lfdf = pd.concat([ pd.DataFrame({'SVTYPE':svtype, 'SVLEN':vals['lengths'].plot_values(max_points)}) for svtype, vals in svTypes.items() ], ignore_index=True)
 
 	fig, axs = plt.subplots(figsize=(18,16))
 
@@ -210,6 +688,73 @@ if __name__ == "__main__":
 		help='write out variants types for a single sample'
 	)
 
+	parser.add_argument(
+		'-w','--workers', 
+		type=int,
+		default=1,
+		help='number of processes counting regions of a tabix/CSI indexed vcf in parallel (default: 1)'
+	)
+
+	parser.add_argument(
+		'--shard_size', 
+		type=int,
+		default=10_000_000,
+		help='size in bp of the regions counted by each worker, 0 counts whole contigs (default: 10000000)'
+	)
+
+	parser.add_argument(
+		'--batch_size', 
+		type=int,
+		default=1000,
+		help='number of records decoded into each genotype array block (default: 1000)'
+	)
+
+	parser.add_argument(
+		'--length_sketch', 
+		action='store_true', 
+		help='keep a fixed size histogram of SV lengths per SV type instead of every length, for very large vcfs'
+	)
+
+	parser.add_argument(
+		'--violin_max_points', 
+		type=int,
+		default=20000,
+		help='most SV lengths per SV type drawn in the variant type violin, larger types are drawn as evenly spaced quantiles (default: 20000)'
+	)
+
+	parser.add_argument(
+		'--genotype_cache', 
+		type=str,
+		default=None,
+		help='directory of packed genotype caches; the first run on a vcf writes one, later runs on the same unchanged vcf load counts from it'
+	)
+
+	parser.add_argument(
+		'--ins_del', 
+		action='store_true', 
+		help='also sum the inserted and deleted bp of the vcf in the same pass (as svlen_summary.py does)'
+	)
+
+	parser.add_argument(
+		'--checkpoint_dir', 
+		type=str,
+		default=None,
+		help='directory to periodically checkpoint counting progress to, so a killed run can be resumed with --resume'
+	)
+
+	parser.add_argument(
+		'--checkpoint_every', 
+		type=int,
+		default=500_000,
+		help='number of records between checkpoints of a single process run (default: 500000)'
+	)
+
+	parser.add_argument(
+		'--resume', 
+		action='store_true', 
+		help='resume counting from the last checkpoint in --checkpoint_dir'
+	)
+
 	if len(sys.argv) == 0:
 		parser.print_help(sys.stderr)
 		sys.exit(1)
@@ -217,8 +762,11 @@ if __name__ == "__main__":
 	# Parse arguments
 	args = parser.parse_args()
 
+	if args.resume and not args.checkpoint_dir:
+		parser.error('--resume needs the --checkpoint_dir of the run to resume')
+
 	# Process the VCF file
-	sample_variant_count_df, svTypes = vcfEntriesPerSample(args.in_vcf_file)
+	sample_variant_count_df, svTypes = vcfEntriesPerSample(args.in_vcf_file, args.workers, args.shard_size, args.batch_size, args.length_sketch, args.genotype_cache, args.checkpoint_dir, args.checkpoint_every, args.resume, args.ins_del)
 
 	#vcf prefix
 	vcf_prefix = args.in_vcf_file.split(".")[0]
@@ -228,7 +776,7 @@ if __name__ == "__main__":
 
 	if args.plot_violin_variantType:
 
-		plot_violin_variantType(svTypes,vcf_prefix)	
+		plot_violin_variantType(svTypes,vcf_prefix,args.violin_max_points)	
 
 	if args.writeOutvariantTypes:
 		svTypesDf = pd.DataFrame( [ (k,v['count']) for k,v in svTypes.items() ], columns=['type','count'] )
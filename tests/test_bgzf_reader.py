@@ -0,0 +1,71 @@
+import gzip
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pysam
+import pytest
+
+import vcf_scan
+from bgzf_reader import BgzfReader, is_bgzf, open_gzip
+
+
+def text_lines(num_lines=20000):
+    return "".join(f"chr1\t{i}\t.\tA\tT\t.\tPASS\tSVTYPE=SNV\tGT\t0/1\n" for i in range(num_lines)).encode()
+
+
+@pytest.fixture
+def bgzipped(tmp_path):
+    """ a plain file and its bgzipped copy, of several BGZF members """
+    data = text_lines()
+    plain = tmp_path / "lines.txt"
+    plain.write_bytes(data)
+    pysam.tabix_compress(str(plain), str(tmp_path / "lines.txt.gz"))
+    return data, tmp_path / "lines.txt.gz"
+
+
+@pytest.mark.parametrize("threads", [2, 4])
+def test_bgzf_members_come_back_in_file_order(bgzipped, threads):
+    data, path = bgzipped
+    with open(path, "rb") as f:
+        assert is_bgzf(f)
+    with open_gzip(str(path), threads=threads, blocks_per_task=2) as f:
+        assert f.read() == data
+
+
+def test_readers_share_an_executor_and_a_raw_file_object(bgzipped):
+    data, path = bgzipped
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with open(path, "rb", buffering=0) as raw, open_gzip(raw, executor=executor, blocks_per_task=1, max_pending=2) as f:
+            assert f.read() == data
+        # the executor is left running for the other readers
+        assert executor.submit(sum, [1, 2]).result() == 3
+
+
+def test_plain_gzip_falls_back_to_the_gzip_module(tmp_path):
+    data = text_lines(100)
+    path = tmp_path / "lines.txt.gz"
+    with gzip.open(path, "wb") as f:
+        f.write(data)
+
+    with open(path, "rb") as f:
+        assert not is_bgzf(f)
+    with open_gzip(str(path), threads=4) as f:
+        assert isinstance(f, gzip.GzipFile)
+        assert f.read() == data
+
+
+def test_corrupt_member_is_an_error(bgzipped):
+    _, path = bgzipped
+    corrupt = bytearray(path.read_bytes())
+    # flip a bit in the CRC32 of the first member
+    bsize = int.from_bytes(corrupt[16:18], "little") + 1
+    corrupt[bsize - 8] ^= 1
+
+    with pytest.raises(OSError, match="corrupt BGZF block"):
+        BgzfReader(io.BytesIO(bytes(corrupt)), threads=2).read()
+
+
+def test_text_scanner_reads_a_bgzipped_vcf(bgzipped):
+    data, path = bgzipped
+    with vcf_scan.open_vcf(str(path), threads=2) as f:
+        assert f.read() == data.decode()
@@ -0,0 +1,461 @@
+import gzip
+import io
+import os
+import uuid
+
+import polars as pl
+import pysam
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.implementations.memory import MemoryFileSystem
+
+import merge_modkit_beds_allCpGs_unPhased_polars as merge_modkit
+from bgzf_reader import is_bgzf
+from object_cache import ObjectCache
+
+# GRCh38 BAM header order: alt and decoy contigs after chrM, chrUn_KI before chrUn_GL, chrEBV last
+HEADER_ORDER = ["chr1", "chr2", "chr11", "chrX", "chrM", "chr1_KI270706v1_random", "chr11_KI270721v1_random",
+                "chrUn_KI270302v1", "chrUn_GL000195v1", "chrEBV"]
+
+
+def bedmethyl_row(chrom, start, valid_cov, mod_reads, mod_code="m"):
+    fraction = round(100 * mod_reads / valid_cov, 2) if valid_cov else 0
+    fields = [chrom, start, start + 1, mod_code, valid_cov, ".", start, start + 1, "255,0,0", valid_cov, fraction, mod_reads,
+              valid_cov - mod_reads, 0, 0, 0, 0, 0]
+    return "\t".join(map(str, fields)) + "\n"
+
+
+def write_bedmethyl(path, sites):
+    """ gzipped bedMethyl of (chrom, start, valid_cov, mod_reads) in the order given """
+    with gzip.open(path, "wt") as f:
+        for site in sites:
+            f.write(bedmethyl_row(*site))
+    return str(path)
+
+
+def sample_sites(seed, chroms):
+    sites = []
+    for chrom in chroms:
+        for start in range(100 + seed, 100 + seed + 40 * 25, 25 + seed % 3):
+            sites.append((chrom, start, 10 + (start + seed) % 7, (start * seed) % 10))
+    return sites
+
+
+def expected_table(samples):
+    """ the merged table of the original iterative outer join, without any row order """
+    merged = None
+    for name, sites in samples.items():
+        df = pl.DataFrame(sites, schema=["#chrom", "start", f"{name}_validCov", f"{name}_modReads"], orient="row")
+        df = df.with_columns((pl.col(f"{name}_modReads") / pl.col(f"{name}_validCov") * 100).round(2).alias(f"{name}_modFraction"))
+        df = df.select("#chrom", "start", f"{name}_validCov", f"{name}_modFraction", f"{name}_modReads")
+        merged = df if merged is None else merged.join(df, on=["#chrom", "start"], how="full", coalesce=True)
+    return merged.fill_null(0)
+
+
+def read_merged(store_dir, sparse=False):
+    if sparse:
+        blocks = merge_modkit.store_batches(store_dir, True, merge_modkit.read_sample_names(store_dir))
+        return pl.concat([block.fill_null(0) for block in blocks])
+    return merge_modkit.scan_store(store_dir).collect().drop("end")
+
+
+def assert_same_table(merged, expected):
+    assert merged.columns == expected.columns
+    assert merged.height == expected.height
+    merged = merged.sort("#chrom", "start")
+    expected = expected.sort("#chrom", "start").cast(dict(merged.schema))
+    assert merged.select("#chrom", "start").equals(expected.select("#chrom", "start"))
+    for col in expected.columns[2:]:
+        assert (merged[col] - expected[col]).abs().max() < 1e-3, col
+
+
+@pytest.fixture
+def header_ordered_samples(tmp_path):
+    """ three inputs in BAM header order, two of them missing different alt contigs """
+    samples = {
+        "S0": sample_sites(1, HEADER_ORDER),
+        "S1": sample_sites(2, [chrom for chrom in HEADER_ORDER if chrom not in ("chr1_KI270706v1_random", "chrUn_GL000195v1")]),
+        "S2": sample_sites(3, [chrom for chrom in HEADER_ORDER if chrom not in ("chr11_KI270721v1_random", "chrUn_KI270302v1")]),
+    }
+    inputs = [(write_bedmethyl(tmp_path / f"{name}.bed.gz", sites), name) for name, sites in samples.items()]
+    return samples, inputs
+
+
+@pytest.mark.parametrize("chrom_order", ["karyotype", "lexicographic"])
+@pytest.mark.parametrize("sparse", [False, True])
+def test_serial_merge_of_header_ordered_contigs(tmp_path, header_ordered_samples, chrom_order, sparse):
+    samples, inputs = header_ordered_samples
+    store_dir = str(tmp_path / "store")
+    merged_samples = merge_modkit.merge_serial(inputs, store_dir, str(tmp_path), "unphased", batch_mb=0.002, chrom_order=chrom_order,
+                                               sparse=sparse, fs=LocalFileSystem())
+
+    assert merged_samples == list(samples)
+    assert_same_table(read_merged(store_dir, sparse), expected_table(samples))
+    # every contig is in one partition, in the order of the inputs
+    assert list(merge_modkit.store_chrom_dirs(store_dir, sparse)) == HEADER_ORDER
+    assert not (tmp_path / "late_unphased").exists()
+
+
+def test_parallel_merge_of_header_ordered_contigs(tmp_path, header_ordered_samples):
+    samples, inputs = header_ordered_samples
+    store_dir = str(tmp_path / "store")
+    merge_modkit.merge_beds_by_chrom(inputs, store_dir, str(tmp_path), "unphased", batch_mb=0.002, workers=2, fs=LocalFileSystem())
+
+    assert_same_table(read_merged(store_dir), expected_table(samples))
+
+
+def test_rows_out_of_order_are_merged_in_late(tmp_path):
+    """ an input listing a contig twice, and one with starts going back between batches """
+    samples = {
+        "S0": sample_sites(1, ["chr1", "chr2", "chr3"]),
+        "S1": sample_sites(2, ["chr1", "chr3"]) + sample_sites(5, ["chr2"]),
+    }
+    split = sample_sites(4, ["chr1", "chr2"])
+    samples["S2"] = split[20:40] + split[:20] + split[40:]
+    inputs = [(write_bedmethyl(tmp_path / f"{name}.bed.gz", sites), name) for name, sites in samples.items()]
+    # S1 revisits chr2 after chr3 once the merge has passed it
+    inputs[1] = (write_bedmethyl(tmp_path / "S1.bed.gz", samples["S1"] + sample_sites(6, ["chr2"])[:3]), "S1")
+    samples["S1"] = samples["S1"] + sample_sites(6, ["chr2"])[:3]
+
+    store_dir = str(tmp_path / "store")
+    merge_modkit.merge_serial(inputs, store_dir, str(tmp_path), "unphased", batch_mb=0.001, fs=LocalFileSystem())
+
+    assert_same_table(read_merged(store_dir), expected_table(samples))
+    assert list(merge_modkit.store_chrom_dirs(store_dir)) == ["chr1", "chr2", "chr3"]
+
+
+def test_contig_order_prefers_contigs_an_input_has_seen_first():
+    order = merge_modkit.ContigOrder(str)
+    order.record("chr1", "chr2")
+    order.record("chr2", "chr10")
+    assert order.precedes("chr1", "chr10")
+    assert order.first(["chr10", "chr2"]) == "chr2"
+    # unordered contigs go by the number of inputs on them, then by the key
+    assert order.first(["chrUn_GL000195v1", "chrEBV", "chrUn_GL000195v1"]) == "chrUn_GL000195v1"
+    assert order.first(["chrEBV", "chrUn_GL000195v1"]) == "chrEBV"
+    # a cycle from disagreeing inputs falls back too
+    order.record("chr10", "chr2")
+    assert order.first(["chr10", "chr2"]) == "chr10"
+
+
+def test_align_blocks_scatters_every_source_onto_the_union_of_starts():
+    dtypes = {"A_validCov": pl.UInt32, "B_validCov": pl.UInt32}
+    a = pl.DataFrame({"start": [1, 5, 9], "A_validCov": [10, 50, 90]}, schema={"start": pl.UInt32, "A_validCov": pl.UInt32})
+    b = pl.DataFrame({"start": [5, 7], "B_validCov": [3, 4]}, schema={"start": pl.UInt32, "B_validCov": pl.UInt32})
+    aligned = merge_modkit.align_blocks([a, b], dtypes)
+    assert aligned["start"].to_list() == [1, 5, 7, 9]
+    assert aligned["A_validCov"].to_list() == [10, 50, None, 90]
+    assert aligned["B_validCov"].to_list() == [None, 3, 4, None]
+
+
+
+@pytest.mark.parametrize("fs", [LocalFileSystem(), MemoryFileSystem()], ids=["local", "memory"])
+def test_prefetched_merge(tmp_path, header_ordered_samples, fs):
+    samples, local_inputs = header_ordered_samples
+    inputs = local_inputs
+    if isinstance(fs, MemoryFileSystem):
+        root = f"/merge-{uuid.uuid4().hex}"
+        inputs = []
+        for path, name in local_inputs:
+            link = f"memory://{root}/{os.path.basename(path)}"
+            with open(path, "rb") as f:
+                fs.pipe_file(link, f.read())
+            inputs.append((link, name))
+
+    store_dir = str(tmp_path / "store")
+    merge_modkit.merge_serial(inputs, store_dir, str(tmp_path), "unphased", batch_mb=0.002, prefetch=2, fs=fs)
+
+    assert_same_table(read_merged(store_dir), expected_table(samples))
+    assert not (tmp_path / "prefetch_unphased").exists()
+    if isinstance(fs, MemoryFileSystem):
+        fs.rm(root, recursive=True)
+
+
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_prefetched_merge_through_a_cache(tmp_path, header_ordered_samples, prefetch):
+    samples, local_inputs = header_ordered_samples
+    fs = MemoryFileSystem()
+    root = f"/merge-{uuid.uuid4().hex}"
+    inputs = []
+    for path, name in local_inputs:
+        link = f"memory://{root}/{os.path.basename(path)}"
+        with open(path, "rb") as f:
+            fs.pipe_file(link, f.read())
+        inputs.append((link, name))
+    cache = ObjectCache(fs, str(tmp_path / "cache"))
+
+    # a cold cache fills as the inputs stream, the rerun reads them from it
+    for run in ("cold", "warm"):
+        store_dir = str(tmp_path / f"store_{run}")
+        merge_modkit.merge_serial(inputs, store_dir, str(tmp_path), "unphased", batch_mb=0.002, prefetch=prefetch, cache=cache, fs=fs)
+        assert_same_table(read_merged(store_dir), expected_table(samples))
+        assert not (tmp_path / "prefetch_unphased").exists()
+
+    assert (cache.misses, cache.hits) == (3, 3)
+    fs.rm(root, recursive=True)
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "tsv", "both"])
+def test_merge_writes_a_chromosome_partitioned_store(tmp_path, header_ordered_samples, output_format):
+    samples, inputs = header_ordered_samples
+    merge_modkit.merge_beds([path for path, _ in inputs], str(tmp_path), "unphased", batch_mb=0.002, output_format=output_format,
+                            fs=LocalFileSystem())
+
+    store_dir = merge_modkit.store_path(str(tmp_path), "unphased")
+    tsv_path = tmp_path / "combined_methylation_unphased.tsv"
+    assert os.path.exists(store_dir) == (output_format != "tsv")
+    assert tsv_path.exists() == (output_format != "parquet")
+    if output_format != "tsv":
+        merged = merge_modkit.scan_store(store_dir).collect()
+        assert merged.schema["start"] == pl.UInt32 and merged.schema["S0_modFraction"] == pl.Float32
+        assert merged["end"].equals(merged["start"] + 1)
+        assert_same_table(merged.drop("end"), expected_table(samples))
+    if output_format != "parquet":
+        tsv = pl.read_csv(tsv_path, separator="\t")
+        assert tsv.columns == merge_modkit.KEY_COLUMNS + [f"{name}_{col}" for name in samples for col in merge_modkit.VALUE_COLUMNS]
+        # the TSV streams out of the store in partition order
+        assert tsv["#chrom"].unique(maintain_order=True).to_list() == HEADER_ORDER
+        assert_same_table(tsv.drop("end"), expected_table(samples))
+
+
+def test_sparse_store_densifies_slices_and_keeps_zero_coverage(tmp_path):
+    samples = {"S0": sample_sites(1, ["chr1", "chr2"]), "S1": sample_sites(2, ["chr1"]) + [("chr1", 5000, 0, 0)]}
+    inputs = [(write_bedmethyl(tmp_path / f"{name}.bed.gz", sites), name) for name, sites in samples.items()]
+    sparse_dir, dense_dir = str(tmp_path / "sparse"), str(tmp_path / "dense")
+    for store_dir, sparse in [(sparse_dir, True), (dense_dir, False)]:
+        merge_modkit.merge_serial(inputs, store_dir, str(tmp_path), "unphased", batch_mb=0.001, sparse=sparse, fs=LocalFileSystem())
+
+    assert merge_modkit.read_sample_names(sparse_dir) == ["S0", "S1"]
+    cells = pl.read_parquet(os.path.join(sparse_dir, "cells", "*", "*.parquet"))
+    assert cells.height == sum(len(sites) for sites in samples.values())
+
+    dense = merge_modkit.scan_store(dense_dir).collect()
+    chr1 = merge_modkit.densify(sparse_dir, "chr1", 300, 700)
+    assert chr1.columns == dense.columns
+    assert chr1.fill_null(0).equals(dense.filter((pl.col("#chrom") == "chr1") & pl.col("start").is_between(300, 699)))
+
+    # S1 has no chr2 CpGs, but was observed with 0 coverage at chr1:5000
+    s1 = merge_modkit.densify(sparse_dir, "chr2", samples=["S1"])
+    assert s1.columns == merge_modkit.KEY_COLUMNS + [f"S1_{col}" for col in merge_modkit.VALUE_COLUMNS]
+    assert s1.height == len(samples["S0"]) // 2 and s1["S1_validCov"].null_count() == s1.height
+    zero = merge_modkit.densify(sparse_dir, "chr1", 5000, 5001)
+    assert zero["S1_validCov"].to_list() == [0] and zero["S0_validCov"].to_list() == [None]
+    assert merge_modkit.densify(sparse_dir, "chr1", 10000).height == 0
+    with pytest.raises(KeyError):
+        merge_modkit.densify(sparse_dir, "chrX")
+
+    # the TSV of a sparse store is the 0 filled dense table
+    merge_modkit.write_sparse_tsv(sparse_dir, str(tmp_path / "sparse.tsv"))
+    merge_modkit.scan_store(dense_dir).sink_csv(str(tmp_path / "dense.tsv"), separator="\t")
+    assert (tmp_path / "sparse.tsv").read_text() == (tmp_path / "dense.tsv").read_text()
+
+
+@pytest.mark.parametrize("sparse, workers", [(False, 1), (True, 1), (False, 2)])
+def test_append_merges_only_new_samples(tmp_path, sparse, workers):
+    samples = {f"S{i}": sample_sites(i + 1, ["chr1", "chr2"] if i % 2 else ["chr1", "chr3"]) for i in range(5)}
+    links = [write_bedmethyl(tmp_path / f"{name}.bed.gz", sites) for name, sites in samples.items()]
+    outputdir = tmp_path / "out"
+    store_dir = merge_modkit.store_path(str(outputdir), "unphased", sparse)
+
+    def append(links):
+        merge_modkit.merge_beds(links, str(outputdir), "unphased", batch_mb=0.002, workers=workers, sparse=sparse, append=True,
+                                append_batch=2, fs=LocalFileSystem())
+        return merge_modkit.read_state(store_dir)["samples"]
+
+    assert append(links[:2]) == ["S0", "S1"]
+    # the merged samples' inputs are never read again
+    os.remove(links[0])
+    assert append(links) == list(samples)
+    assert_same_table(read_merged(store_dir, sparse), expected_table(samples))
+
+    # a crash between the renames of a batch leaves the previous store and a partial next one
+    os.rename(store_dir, store_dir + ".prev")
+    os.makedirs(store_dir + ".next")
+    assert append(links[1:]) == list(samples)
+    assert not os.path.exists(store_dir + ".prev") and not os.path.exists(store_dir + ".next")
+    assert_same_table(read_merged(store_dir, sparse), expected_table(samples))
+
+    with pytest.raises(ValueError, match="merged with"):
+        merge_modkit.merge_beds(links[1:], str(outputdir), "unphased", chrom_order="lexicographic", workers=workers, sparse=sparse,
+                                append=True, fs=LocalFileSystem())
+
+
+def test_region_index_merges_overlapping_intervals(tmp_path):
+    bed = tmp_path / "regions.bed.gz"
+    with gzip.open(bed, "wt") as f:
+        f.write("track name=cpg_islands\nchr1\t100\t200\nchr1\t150\t300\nchr1\t500\t600\n\nchr2\t0\t10\n")
+    regions = merge_modkit.RegionIndex(str(bed))
+
+    assert regions.chroms == {"chr1", "chr2"}
+    assert regions.starts["chr1"].tolist() == [100, 500] and regions.ends["chr1"].tolist() == [300, 600]
+    assert regions.contains("chr1", [99, 100, 250, 299, 300, 550, 700]).tolist() == [False, True, True, True, False, True, False]
+    assert regions.contains("chr3", [5]).tolist() == [False]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_site_filter_drops_cpgs_as_inputs_are_read(tmp_path, workers):
+    samples = {name: sample_sites(seed, ["chr1", "chr2", "chr3"]) for name, seed in [("S0", 1), ("S1", 2), ("S2", 3)]}
+    inputs = [(write_bedmethyl(tmp_path / f"{name}.bed.gz", sites), name) for name, sites in samples.items()]
+    regions = tmp_path / "regions.bed"
+    regions.write_text("chr1\t200\t400\nchr1\t700\t800\nchr2\t0\t500\nchr3\t0\t1000\n")
+    site_filter = merge_modkit.SiteFilter(chroms=["chr1", "chr2"], regions=str(regions), min_valid_cov=13)
+
+    store_dir = str(tmp_path / "store")
+    if workers > 1:
+        merge_modkit.merge_beds_by_chrom(inputs, store_dir, str(tmp_path), "unphased", batch_mb=0.001, workers=workers,
+                                         site_filter=site_filter, fs=LocalFileSystem())
+    else:
+        merge_modkit.merge_serial(inputs, store_dir, str(tmp_path), "unphased", batch_mb=0.001, site_filter=site_filter,
+                                  fs=LocalFileSystem())
+
+    def kept(chrom, start, valid_cov):
+        in_region = (chrom == "chr1" and (200 <= start < 400 or 700 <= start < 800)) or (chrom == "chr2" and start < 500)
+        return in_region and valid_cov >= 13
+
+    # a CpG is kept while any sample passes, the others are filled in as missing
+    filtered = {name: [site for site in sites if kept(*site[:3])] for name, sites in samples.items()}
+    assert_same_table(read_merged(store_dir), expected_table(filtered))
+    assert list(merge_modkit.store_chrom_dirs(store_dir)) == ["chr1", "chr2"]
+    assert site_filter.description() == {"chroms": ["chr1", "chr2"], "regions": str(regions), "min_valid_cov": 13}
+
+
+def test_append_refuses_a_different_site_filter(tmp_path):
+    links = [write_bedmethyl(tmp_path / f"S{i}.bed.gz", sample_sites(i + 1, ["chr1", "chr2"])) for i in range(2)]
+    merge_modkit.merge_beds(links[:1], str(tmp_path), "unphased", append=True, site_filter=merge_modkit.SiteFilter(chroms=["chr1"]),
+                            fs=LocalFileSystem())
+
+    with pytest.raises(ValueError, match="merged with"):
+        merge_modkit.merge_beds(links, str(tmp_path), "unphased", append=True, site_filter=merge_modkit.SiteFilter(chroms=["chr2"]),
+                                fs=LocalFileSystem())
+
+
+@pytest.mark.parametrize("prefetch, workers", [(0, 1), (2, 1), (0, 2)])
+def test_merge_of_bgzipped_inputs(tmp_path, prefetch, workers):
+    """ bgzipped inputs of several BGZF members, merged with a plain gzip one """
+    chroms = [f"chr{i}" for i in range(1, 81)]
+    samples = {name: sample_sites(seed, chroms) for name, seed in [("S0", 1), ("S1", 2), ("S2", 3)]}
+    inputs = []
+    for name, sites in samples.items():
+        path = write_bedmethyl(tmp_path / f"{name}.bed.gz", sites)
+        if name != "S2":
+            with gzip.open(path, "rb") as f:
+                data = f.read()
+            # several 64KB BGZF members
+            assert len(data) > 2 << 16
+            (tmp_path / f"{name}.bed").write_bytes(data)
+            pysam.tabix_compress(str(tmp_path / f"{name}.bed"), path, force=True)
+        inputs.append((path, name))
+
+    store_dir = str(tmp_path / "store")
+    if workers > 1:
+        merge_modkit.merge_beds_by_chrom(inputs, store_dir, str(tmp_path), "unphased", batch_mb=0.01, workers=workers,
+                                         decode_threads=4, fs=LocalFileSystem())
+    else:
+        merge_modkit.merge_serial(inputs, store_dir, str(tmp_path), "unphased", batch_mb=0.01, prefetch=prefetch,
+                                  decode_threads=2, fs=LocalFileSystem())
+
+    with open(inputs[0][0], "rb") as f:
+        assert is_bgzf(f)
+    assert_same_table(read_merged(store_dir), expected_table(samples))
+
+
+def write_hm_bedmethyl(path, sites):
+    """ gzipped bedMethyl with an h row (a fifth of the reads modified) before the m row of every CpG, as modkit writes them """
+    with gzip.open(path, "wt") as f:
+        for chrom, start, valid_cov, mod_reads in sites:
+            f.write(bedmethyl_row(chrom, start, valid_cov, valid_cov // 5, "h"))
+            f.write(bedmethyl_row(chrom, start, valid_cov, mod_reads))
+    return str(path)
+
+
+@pytest.mark.parametrize("mod_code", ["m", "h"])
+def test_merge_keeps_the_rows_of_one_modification_code(tmp_path, mod_code):
+    samples = {"S0": sample_sites(1, ["chr1", "chr2"]), "S1": sample_sites(2, ["chr1", "chr2"])}
+    inputs = [(write_hm_bedmethyl(tmp_path / f"{name}.bed.gz", sites), name) for name, sites in samples.items()]
+
+    store_dir = str(tmp_path / "store")
+    merge_modkit.merge_serial(inputs, store_dir, str(tmp_path), "unphased", batch_mb=0.001, fs=LocalFileSystem(), mod_code=mod_code)
+
+    if mod_code == "h":
+        samples = {name: [(chrom, start, cov, cov // 5) for chrom, start, cov, _ in sites] for name, sites in samples.items()}
+    assert_same_table(read_merged(store_dir), expected_table(samples))
+
+
+@pytest.mark.parametrize("split", [False, True])
+def test_several_rows_at_one_cpg_are_an_error_without_a_mod_code(tmp_path, split):
+    path = write_hm_bedmethyl(tmp_path / "S0.bed.gz", sample_sites(1, ["chr1"]))
+    # a chunk of just the first h row leaves its m row to start the next one
+    batch_bytes = len(bedmethyl_row("chr1", 101, 14, 2, "h")) if split else 1 << 20
+    with gzip.open(path, "rb") as f, pytest.raises(ValueError, match="S0 has several records at chr1:101"):
+        list(merge_modkit.read_bed_batches(f, "S0", batch_bytes, mod_code=None))
+
+
+@pytest.mark.parametrize("sparse, workers", [(False, 1), (True, 1), (False, 2)])
+def test_inputs_failing_part_way_are_dropped_from_the_merge(tmp_path, sparse, workers):
+    chroms = [f"chr{i}" for i in range(1, 21)]
+    sites = sample_sites(1, chroms)
+    samples = {name: [(chrom, start, cov, mod_reads // (i + 1)) for chrom, start, cov, mod_reads in sites] for i, name in enumerate(["S0", "S1", "S2", "S3"])}
+    inputs = [(write_bedmethyl(tmp_path / f"{name}.bed.gz", sites), name) for name, sites in samples.items()]
+    # S1 is truncated half way and S2 has a record that is not a CpG on chr15
+    data = (tmp_path / "S1.bed.gz").read_bytes()
+    (tmp_path / "S1.bed.gz").write_bytes(data[:len(data) // 2])
+    rows = [bedmethyl_row(*site) for site in samples["S2"]]
+    rows[600] = rows[600].replace(f"\t{sites[600][1] + 1}\t", f"\t{sites[600][1] + 5}\t", 1)
+    with gzip.open(tmp_path / "S2.bed.gz", "wt") as f:
+        f.writelines(rows)
+
+    store_dir = str(tmp_path / "store")
+    if workers > 1:
+        merged_samples = merge_modkit.merge_beds_by_chrom(inputs, store_dir, str(tmp_path), "unphased", batch_mb=0.002, workers=workers,
+                                                          sparse=sparse, fs=LocalFileSystem())
+    else:
+        merged_samples = merge_modkit.merge_serial(inputs, store_dir, str(tmp_path), "unphased", batch_mb=0.002, sparse=sparse,
+                                                   fs=LocalFileSystem())
+
+    assert merged_samples == ["S0", "S3"]
+    if sparse:
+        assert merge_modkit.read_sample_names(store_dir) == ["S0", "S3"]
+    assert_same_table(read_merged(store_dir, sparse), expected_table({name: samples[name] for name in merged_samples}))
+
+
+def test_contig_merge_order_follows_the_inputs():
+    order = merge_modkit.contig_merge_order([["chr2", "chr1", "chrUn_KI270302v1", "chrM"], ["chr2", "chr1", "chrM", "chr1_KI270706v1_random"],
+                                             ["chr1", "chr2"]], merge_modkit.ContigOrder(merge_modkit.karyotype_key))
+    # two inputs start on chr2, the third's chr2 after chr1 is late, and no input orders chrM and chrUn_KI270302v1
+    assert order == ["chr2", "chr1", "chrM", "chr1_KI270706v1_random", "chrUn_KI270302v1"]
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_serial_and_parallel_merges_write_the_same_store(tmp_path, header_ordered_samples, sparse):
+    samples, inputs = header_ordered_samples
+    # an input listing chr2 again after chrEBV
+    inputs.append((write_bedmethyl(tmp_path / "S3.bed.gz", sample_sites(4, HEADER_ORDER) + sample_sites(5, ["chr2"])[:3]), "S3"))
+    tables = []
+    for workers in (1, 2):
+        outputdir = tmp_path / f"workers_{workers}"
+        outputdir.mkdir()
+        merge_modkit.merge_beds([path for path, _ in inputs], str(outputdir), "unphased", batch_mb=0.002, chrom_order="lexicographic",
+                                workers=workers, output_format="both", sparse=sparse, fs=LocalFileSystem())
+        store_dir = merge_modkit.store_path(str(outputdir), "unphased", sparse)
+        assert list(merge_modkit.store_chrom_dirs(store_dir, sparse)) == HEADER_ORDER
+        tables.append((outputdir / "combined_methylation_unphased.tsv").read_text())
+
+    assert tables[0] == tables[1]
+
+
+def test_records_that_are_not_cpgs_are_rejected():
+    rows = [bedmethyl_row("chr1", 100, 10, 5), bedmethyl_row("chr1", 200, 10, 5).replace("\t201\t", "\t203\t", 1)]
+    with pytest.raises(ValueError, match="S0 has records longer than one base, expected CpG bedMethyl records with end = start \\+ 1"):
+        list(merge_modkit.read_bed_batches(io.BytesIO("".join(rows).encode()), "S0"))
+
+
+def test_decoded_ends_match_the_input_records(tmp_path, header_ordered_samples):
+    _, inputs = header_ordered_samples
+    merge_modkit.merge_beds([path for path, _ in inputs], str(tmp_path), "unphased", batch_mb=0.002, output_format="tsv",
+                            fs=LocalFileSystem())
+
+    keys = pl.concat([pl.read_csv(path, separator="\t", has_header=False, columns=[0, 1, 2], new_columns=merge_modkit.KEY_COLUMNS)
+                      for path, _ in inputs]).unique()
+    merged = pl.read_csv(tmp_path / "combined_methylation_unphased.tsv", separator="\t", columns=merge_modkit.KEY_COLUMNS)
+    assert merged.height == keys.height
+    assert merged.sort("#chrom", "start").equals(keys.sort("#chrom", "start").cast(dict(merged.schema)))
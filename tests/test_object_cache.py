@@ -0,0 +1,124 @@
+import os
+
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+
+import object_cache
+from object_cache import ObjectCache
+
+
+class EtagFileSystem(LocalFileSystem):
+    """ local filesystem reporting the ETag of a store like S3 instead of a modification time """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.etags = {}
+
+    def info(self, path, **kwargs):
+        info = super().info(path, **kwargs)
+        del info["mtime"]
+        info["ETag"] = self.etags[path]
+        return info
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    monkeypatch.setattr(object_cache, "log_time", lambda message: None)
+
+
+def write_object(path, size, fill=b"x"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(fill * size)
+    return str(path)
+
+
+def test_get_misses_once_then_hits(tmp_path):
+    link = write_object(tmp_path / "bucket" / "S0.bed.gz", 100)
+    cache = ObjectCache(LocalFileSystem(), str(tmp_path / "cache"))
+
+    first = cache.get(link)
+    second = cache.get(link)
+
+    assert first == second
+    with open(first, "rb") as f:
+        assert f.read() == b"x" * 100
+    assert (cache.hits, cache.misses, cache.downloaded_bytes) == (1, 1, 100)
+
+
+def test_changed_mtime_is_a_new_key(tmp_path):
+    link = write_object(tmp_path / "bucket" / "S0.bed.gz", 100)
+    cache = ObjectCache(LocalFileSystem(), str(tmp_path / "cache"))
+    key = cache.key(link)
+    cache.get(link)
+
+    # replaced with the same size, only the modification time tells
+    write_object(tmp_path / "bucket" / "S0.bed.gz", 100, b"y")
+    os.utime(link, (1_000_000_000, 1_000_000_000))
+
+    assert cache.key(link) != key
+    assert cache.lookup(link) is None
+    with open(cache.get(link), "rb") as f:
+        assert f.read() == b"y" * 100
+    assert cache.downloaded_bytes == 200
+
+
+def test_changed_etag_is_a_new_key(tmp_path):
+    fs = EtagFileSystem(skip_instance_cache=True)
+    link = write_object(tmp_path / "bucket" / "S0.bed.gz", 100)
+    fs.etags[link] = '"a1"'
+    cache = ObjectCache(fs, str(tmp_path / "cache"))
+    key = cache.key(link)
+    assert cache.key(link) == key
+
+    fs.etags[link] = '"b2"'
+    assert cache.key(link) != key
+
+
+def test_least_recently_used_objects_are_evicted(tmp_path):
+    links = [write_object(tmp_path / "bucket" / f"S{i}.bed.gz", 100) for i in range(3)]
+    cache = ObjectCache(LocalFileSystem(), str(tmp_path / "cache"), max_bytes=250)
+    paths = [cache.get(link) for link in links[:2]]
+    # S0 was used after S1
+    os.utime(paths[1], (1_000, 1_000))
+    os.utime(paths[0], (2_000, 2_000))
+
+    cache.get(links[2])
+
+    assert os.path.exists(paths[0])
+    assert not os.path.exists(paths[1])
+    assert cache.lookup(links[2]) is not None
+
+
+def test_writer_reserves_its_size_until_committed(tmp_path):
+    links = [write_object(tmp_path / "bucket" / f"S{i}.bed.gz", 100) for i in range(3)]
+    cache = ObjectCache(LocalFileSystem(), str(tmp_path / "cache"), max_bytes=250)
+    cached = cache.get(links[0])
+
+    first = cache.writer(links[1], cache.key(links[1]), 100)
+    second = cache.writer(links[2], cache.key(links[2]), 100)
+    # the cached object made room for the two being written
+    assert not os.path.exists(cached)
+    # a third would not fit next to them
+    assert cache.writer(links[0], cache.key(links[0]), 100) is None
+
+    first.write(b"x" * 100)
+    first.commit()
+    second.write(b"x" * 40)
+    # an early end drops the partial object
+    second.abort()
+
+    assert cache.lookup(links[1]) == first.path
+    assert cache.lookup(links[2]) is None
+    assert not [name for _, _, files in os.walk(cache.cache_dir) for name in files if ".tmp." in name]
+    assert cache.writer(links[0], cache.key(links[0]), 100) is not None
+
+
+def test_writer_of_a_changed_object_is_not_committed(tmp_path):
+    link = write_object(tmp_path / "bucket" / "S0.bed.gz", 100)
+    cache = ObjectCache(LocalFileSystem(), str(tmp_path / "cache"))
+    writer = cache.writer(link, cache.key(link), 100)
+    writer.write(b"x" * 60)
+    writer.commit()
+
+    assert cache.lookup(link) is None
+    assert cache.downloaded_bytes == 0
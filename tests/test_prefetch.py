@@ -0,0 +1,204 @@
+import os
+import uuid
+
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.implementations.memory import MemoryFileSystem
+
+import prefetch
+from object_cache import ObjectCache
+from prefetch import Prefetcher
+
+
+class FlakyMemoryFileSystem(MemoryFileSystem):
+    """ memory filesystem whose first range read of every object fails with a transient error """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failed = set()
+        self.ranges = []
+
+    def error(self, path):
+        return ConnectionError(f"connection reset reading {path}")
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        if path not in self.failed:
+            self.failed.add(path)
+            raise self.error(path)
+        self.ranges.append((path, start, end))
+        return super().cat_file(path, start=start, end=end, **kwargs)
+
+
+class ResponseError(Exception):
+    """ an HTTP error response that is not an OSError, like gcsfs's HttpError """
+
+    def __init__(self, code):
+        super().__init__(f"{code} response")
+        self.code = code
+
+
+class ThrottledMemoryFileSystem(FlakyMemoryFileSystem):
+    """ memory filesystem whose first range read of every object gets a ResponseError of code """
+
+    code = 429
+
+    def error(self, path):
+        return ResponseError(self.code)
+
+
+class ForbiddenMemoryFileSystem(ThrottledMemoryFileSystem):
+    code = 403
+
+
+def object_contents(n, seed=0):
+    return bytes((i * 31 + seed) % 251 for i in range(n))
+
+
+@pytest.fixture
+def memory_links():
+    fs = MemoryFileSystem()
+    root = f"/prefetch-{uuid.uuid4().hex}"
+    contents = {f"memory://{root}/S{i}.bed.gz": object_contents(1000 + 300 * i, i) for i in range(3)}
+    for link, data in contents.items():
+        fs.pipe_file(link, data)
+    yield fs, contents
+    fs.rm(root, recursive=True)
+
+
+@pytest.fixture
+def local_links(tmp_path):
+    contents = {}
+    for i in range(3):
+        path = tmp_path / "inputs" / f"S{i}.bed.gz"
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(object_contents(1000 + 300 * i, i))
+        contents[str(path)] = path.read_bytes()
+    return LocalFileSystem(), contents
+
+
+@pytest.mark.parametrize("links", ["memory_links", "local_links"])
+def test_streams_read_side_by_side_drop_their_spooled_pieces(tmp_path, request, links):
+    fs, contents = request.getfixturevalue(links)
+    spool_dir = tmp_path / "spool"
+    with Prefetcher(fs, depth=2, spool_dir=str(spool_dir), range_size=256) as prefetcher:
+        streams = {link: prefetcher.open(link) for link in contents}
+        read = dict.fromkeys(contents, b"")
+        # interleaved like a k-way merge
+        while any(len(read[link]) < len(data) for link, data in contents.items()):
+            for link, stream in streams.items():
+                read[link] += stream.read(100)
+                # the spool only holds the pieces of the window of every stream
+                assert len(os.listdir(spool_dir)) <= 2 * len(streams)
+        for stream in streams.values():
+            assert stream.read() == b""
+            stream.close()
+
+    assert read == contents
+    assert os.listdir(spool_dir) == []
+
+
+def test_stream_closed_early_releases_its_pieces(tmp_path, memory_links):
+    fs, contents = memory_links
+    link = next(iter(contents))
+    spool_dir = tmp_path / "spool"
+    with Prefetcher(fs, depth=3, spool_dir=str(spool_dir), range_size=128) as prefetcher:
+        stream = prefetcher.open(link)
+        assert stream.read(10) == contents[link][:10]
+        stream.close()
+    assert os.listdir(spool_dir) == []
+
+
+def test_stream_retries_a_failed_range_read(tmp_path, monkeypatch):
+    monkeypatch.setattr(prefetch, "log_time", lambda message: None)
+    fs = FlakyMemoryFileSystem(skip_instance_cache=True)
+    link = f"memory:///prefetch-{uuid.uuid4().hex}/S0.bed.gz"
+    data = object_contents(1000)
+    fs.pipe_file(link, data)
+
+    with Prefetcher(fs, depth=2, spool_dir=str(tmp_path / "spool"), retries=2, backoff=0, range_size=300) as prefetcher:
+        with prefetcher.open(link) as stream:
+            assert stream.read() == data
+
+    assert fs.failed == {link}
+    # every range was read once after the failure was retried
+    assert sorted(start for _, start, _ in fs.ranges) == [0, 300, 600, 900]
+    fs.rm(link)
+
+
+def test_stream_gives_up_after_retries(tmp_path, monkeypatch):
+    monkeypatch.setattr(prefetch, "log_time", lambda message: None)
+    fs = FlakyMemoryFileSystem(skip_instance_cache=True)
+    link = f"memory:///prefetch-{uuid.uuid4().hex}/S0.bed.gz"
+    fs.pipe_file(link, object_contents(100))
+
+    with Prefetcher(fs, depth=1, retries=0, backoff=0) as prefetcher:
+        with pytest.raises(ConnectionError):
+            prefetcher.open(link).read()
+    fs.rm(link)
+
+
+def test_stream_retries_throttled_responses_of_the_retryable_types(tmp_path, monkeypatch):
+    monkeypatch.setattr(prefetch, "log_time", lambda message: None)
+    fs = ThrottledMemoryFileSystem(skip_instance_cache=True)
+    link = f"memory:///prefetch-{uuid.uuid4().hex}/S0.bed.gz"
+    data = object_contents(1000)
+    fs.pipe_file(link, data)
+
+    with Prefetcher(fs, depth=2, retries=2, backoff=0, range_size=300, retryable=prefetch.TRANSIENT_ERRORS + (ResponseError,)) as prefetcher:
+        with prefetcher.open(link) as stream:
+            assert stream.read() == data
+    assert fs.failed == {link}
+
+    # a client error will not get better by retrying
+    fs = ForbiddenMemoryFileSystem(skip_instance_cache=True)
+    with Prefetcher(fs, depth=1, retries=2, backoff=0, retryable=prefetch.TRANSIENT_ERRORS + (ResponseError,)) as prefetcher:
+        with pytest.raises(ResponseError, match="403"):
+            prefetcher.open(link).read()
+    assert fs.ranges == []
+    fs.rm(link)
+
+
+def test_gcsfs_http_errors_are_retried():
+    retry = pytest.importorskip("gcsfs.retry")
+    assert issubclass(retry.HttpError, prefetch.TRANSIENT_ERRORS)
+
+
+def test_fetch_retries_a_failed_download(tmp_path, monkeypatch):
+    monkeypatch.setattr(prefetch, "log_time", lambda message: None)
+    fs = MemoryFileSystem(skip_instance_cache=True)
+    original_open = fs.open
+    attempts = []
+
+    def flaky_open(path, mode="rb", **kwargs):
+        attempts.append(path)
+        if len(attempts) == 1:
+            raise TimeoutError("read timed out")
+        return original_open(path, mode, **kwargs)
+
+    link = f"memory:///prefetch-{uuid.uuid4().hex}/S0.bed.gz"
+    data = object_contents(500)
+    fs.pipe_file(link, data)
+    fs.open = flaky_open
+
+    with Prefetcher(fs, [link], depth=1, spool_dir=str(tmp_path / "spool"), backoff=0) as prefetcher:
+        path = prefetcher.fetch(link)
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert len(attempts) == 2
+    fs.rm(link)
+
+
+def test_stream_fills_the_cache_and_a_rerun_reads_it(tmp_path, memory_links):
+    fs, contents = memory_links
+    cache = ObjectCache(fs, str(tmp_path / "cache"))
+    for _ in range(2):
+        with Prefetcher(fs, depth=2, spool_dir=str(tmp_path / "spool"), cache=cache, range_size=256) as prefetcher:
+            for link, data in contents.items():
+                with prefetcher.open(link) as stream:
+                    assert stream.read() == data
+
+    assert (cache.misses, cache.hits) == (3, 3)
+    assert cache.downloaded_bytes == sum(map(len, contents.values()))
+    for link, data in contents.items():
+        with open(cache.lookup(link), "rb") as f:
+            assert f.read() == data
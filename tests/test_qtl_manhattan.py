@@ -0,0 +1,176 @@
+import os
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import qtl_manhattan
+
+
+def write_qtl_tsv(path, n=5000, seed=0):
+    """ a QTL result TSV of SNVs and a few SVs on chr1-chr3 and chrX, about 2% of them significant """
+    rng = np.random.default_rng(seed)
+    chroms = rng.choice(["chr1", "chr2", "chr3", "chrX"], n)
+    starts = rng.integers(1, 5_000_000, n)
+    is_sv = rng.random(n) < 0.03
+    variant_ids = [f"{chrom}_{start}_{start}_INS_{50 + start % 200}" if sv else f"{chrom}:{start}:C:A"
+                   for chrom, start, sv in zip(chroms, starts, is_sv)]
+    fdr = np.where(rng.random(n) < 0.02, rng.uniform(1e-12, 1e-3, n), rng.uniform(0.06, 1, n))
+    pd.DataFrame({
+        "variant_id": variant_ids,
+        "bh_fdr": fdr,
+        "slope": rng.normal(0, 0.5, n),
+        qtl_manhattan.CAVIAR_TYPE: np.where(is_sv, "SV", "SNV"),
+    }).to_csv(path, sep="\t", index=False)
+    return str(path)
+
+
+def test_manifest_rows_in_other_directories_write_to_their_output_directory(tmp_path, monkeypatch):
+    (tmp_path / "data").mkdir()
+    write_qtl_tsv(tmp_path / "data" / "cohA.tsv")
+    manifest = tmp_path / "manifest.tsv"
+    pd.DataFrame({"in_qtl_tsv": ["data/cohA.tsv"], "cohort": ["cohA"], "output_directory": ["plots/cohA"]}).to_csv(manifest, sep="\t", index=False)
+    monkeypatch.chdir(tmp_path)
+
+    timings = qtl_manhattan.plot_manifest(str(manifest), tiles=True)
+
+    assert timings["error"].tolist() == [""]
+    assert sorted(p.name for p in (tmp_path / "plots" / "cohA").iterdir()) == [
+        "cohA_cohA_qtl_manhattan.png", "cohA_qtl_tiles.parquet", "cohA_volcano.png"]
+
+
+@pytest.fixture
+def qtl_table(tmp_path):
+    return qtl_manhattan.load_qtl_table(write_qtl_tsv(tmp_path / "cohA.tsv"), "bh_fdr", cache=False)
+
+
+def level_points(df, zoom, base_cells, height_cells, keep_log10p):
+    """ variant_ids of the points decimate keeps at zoom, worked out directly from the table """
+    numeric_chrom = pd.to_numeric(df["chrom"].astype(str).str.strip("chr"), errors="coerce").to_numpy(dtype=float)
+    genome_x, chrom_index, _, _ = qtl_manhattan.genome_layout(numeric_chrom, df["start"].to_numpy(dtype=float))
+    on_chrom = np.flatnonzero(chrom_index >= 0)
+    logp = df["log10p"].to_numpy(dtype=float)[on_chrom]
+    keep = (logp >= keep_log10p) | (df[qtl_manhattan.CAVIAR_TYPE] == "SV").to_numpy()[on_chrom]
+    drawn = qtl_manhattan.decimate(genome_x[on_chrom], logp, keep, base_cells * 2**zoom, height_cells, chrom_index[on_chrom] % 2)
+    return sorted(df["variant_id"].to_numpy()[on_chrom][drawn])
+
+
+def test_every_zoom_level_is_the_decimated_set(tmp_path, qtl_table):
+    path = qtl_manhattan.export_tiles(qtl_table, str(tmp_path / "tiles.parquet"), "log10p", zoom_levels=4, base_cells=32, height_cells=16)
+    keep_log10p = -np.log10(0.05)
+    numbered = qtl_table["chrom"] != "chrX"
+    kept = set(qtl_table.loc[numbered & ((qtl_table["log10p"] >= keep_log10p) | (qtl_table[qtl_manhattan.CAVIAR_TYPE] == "SV")), "variant_id"])
+
+    sizes = []
+    for zoom in range(4):
+        points, used = qtl_manhattan.query_tiles(path, zoom=zoom)
+        assert used == zoom
+        assert sorted(points["variant_id"]) == level_points(qtl_table, zoom, 32, 16, keep_log10p)
+        sizes.append(points.height)
+        # significant points and SVs are never thinned out
+        assert kept <= set(points["variant_id"])
+    points, _ = qtl_manhattan.query_tiles(path, zoom=4)
+    sizes.append(points.height)
+
+    # the finest level holds every point on a numbered chromosome, the coarser ones fewer
+    assert sizes[-1] == numbered.sum()
+    assert sizes == sorted(sizes) and sizes[0] < sizes[-1]
+
+
+def test_region_query_is_the_level_within_the_region(tmp_path, qtl_table):
+    path = qtl_manhattan.export_tiles(qtl_table, str(tmp_path / "tiles.parquet"), "log10p", zoom_levels=4, base_cells=32, height_cells=16)
+    level, _ = qtl_manhattan.query_tiles(path, zoom=2)
+
+    points, zoom = qtl_manhattan.query_tiles(path, "chr2:1,000,000-2,000,000", zoom=2)
+
+    assert zoom == 2
+    expected = level.filter((level["chrom"] == "chr2") & level["start"].is_between(1_000_000, 2_000_000))
+    assert points["variant_id"].to_list() == expected["variant_id"].to_list()
+
+
+def test_decimate_keeps_significant_points_and_one_point_per_cell():
+    rng = np.random.default_rng(1)
+    x, y = rng.uniform(0, 100, 20000), rng.uniform(0, 10, 20000)
+    x[:5] = np.nan
+    keep = y > 9.5
+    group = (x > 50).astype(np.int64)
+
+    drawn = qtl_manhattan.decimate(x, y, keep, 40, 20, group)
+
+    assert np.all(np.diff(drawn) > 0) and not np.isnan(x[drawn]).any()
+    assert set(np.flatnonzero(keep & np.isfinite(x))) <= set(drawn)
+    thinned = drawn[~keep[drawn]]
+    cells = np.minimum((x[thinned] - np.nanmin(x)) * 40 / (np.nanmax(x) - np.nanmin(x)), 39).astype(int) * 20 \
+        + np.minimum((y[thinned] - y[5:].min()) * 20 / (y[5:].max() - y[5:].min()), 19).astype(int)
+    # one point per cell and color, and the data fills nearly every cell below the kept band
+    assert len(np.unique(cells * 2 + group[thinned])) == len(thinned)
+    assert 40 * 19 * 0.95 <= len(thinned) <= 40 * 20 + 20
+
+
+def test_decimate_keeps_every_group_in_a_shared_cell():
+    x, y = np.array([1.0, 1.0, 1.0, 1.0]), np.array([1.0, 1.0, 1.0, 1.0])
+    drawn = qtl_manhattan.decimate(x, y, np.zeros(4, dtype=bool), 10, 10, np.array([0, 1, 0, 1]))
+    assert drawn.tolist() == [0, 1]
+    # nothing to thin
+    assert qtl_manhattan.decimate(x, y, np.ones(4, dtype=bool), 10, 10).tolist() == [0, 1, 2, 3]
+
+
+def test_marker_cells_are_half_a_marker_wide():
+    # a 36 points^2 marker is 6 points, 25px at 300dpi, so 12.5px cells
+    assert qtl_manhattan.marker_cells(10, 36, 300) == 240
+    # cells are never smaller than a pixel
+    assert qtl_manhattan.marker_cells(10, 0.01, 300) == 3000
+
+
+def test_load_qtl_table_parses_variant_ids_and_caches_them(tmp_path):
+    path = write_qtl_tsv(tmp_path / "cohA.tsv", n=200)
+    df = qtl_manhattan.load_qtl_table(path, "bh_fdr")
+    raw = pd.read_csv(path, sep="\t")
+
+    sv = raw[qtl_manhattan.CAVIAR_TYPE] == "SV"
+    assert df["chrom"].astype(str).tolist() == raw["variant_id"].str.split(r"[_:]").str[0].tolist()
+    assert df["start"].tolist() == raw["variant_id"].str.split(r"[_:]").str[1].astype(int).tolist()
+    assert df["size"][~sv].isna().all() and (df["size"][sv] >= 50).all()
+    assert np.allclose(df["log10p"], -np.log10(raw["bh_fdr"]))
+
+    cache_path = tmp_path / "cohA.qtl_bh_fdr.parquet"
+    assert cache_path.exists()
+    cached = qtl_manhattan.load_qtl_table(path, "bh_fdr")
+    pd.testing.assert_frame_equal(cached, df)
+
+    # an input newer than its cache is parsed again
+    write_qtl_tsv(path, n=100, seed=1)
+    os.utime(path, (cache_path.stat().st_mtime + 10,) * 2)
+    assert len(qtl_manhattan.load_qtl_table(path, "bh_fdr")) == 100
+
+
+def test_genome_layout_puts_numbered_chromosomes_end_to_end():
+    # chr10, chr2, chr1 and an alt contig (no number), and a row without a start
+    numeric_chrom = np.array([10, 2, 2, np.nan, 1, 1, 10, 2])
+    start = np.array([50, 300, 100, 999, 500, 100, 20, np.nan])
+
+    genome_x, chrom_index, chrom_numbers, ticks = qtl_manhattan.genome_layout(numeric_chrom, start)
+
+    assert chrom_numbers.tolist() == [1, 2, 10]
+    assert chrom_index.tolist() == [2, 1, 1, -1, 0, 0, 2, -1]
+    # chr1 is 500 long and chr2 300, so chr2 starts at 500 and chr10 at 800
+    np.testing.assert_array_equal(genome_x, [850, 800, 600, np.nan, 500, 100, 820, np.nan])
+    assert ticks.tolist() == [250, 650, 825]
+
+
+def test_load_qtl_table_drops_variant_ids_without_a_position(tmp_path, capsys):
+    path = write_qtl_tsv(tmp_path / "cohA.tsv", n=50)
+    raw = pd.read_csv(path, sep="\t")
+    raw.loc[3, "variant_id"] = "chr1:12a45:C:A"
+    raw.loc[7, "variant_id"] = "chr2_9999999999_9999999999_INS_60"
+    raw.loc[9, "variant_id"] = "novariant"
+    raw.to_csv(path, sep="\t", index=False)
+
+    df = qtl_manhattan.load_qtl_table(path, "bh_fdr", cache=False)
+
+    assert len(df) == 47 and df["start"].notna().all()
+    assert "dropping 3 rows" in capsys.readouterr().out
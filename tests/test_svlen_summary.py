@@ -0,0 +1,33 @@
+import io
+
+import pytest
+
+from svlen_summary import sum_ins_del
+from vcf_scan import InsDelAccumulator
+
+
+VCF = (
+    "##fileformat=VCFv4.2\n"
+    "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+    "chr1\t10\t.\tA\tACGT\t.\tPASS\t.\n"
+    "chr1\t20\t.\tACGTA\tA,AC\t.\tPASS\t.\n"
+    "chr1\t30\t.\tN\t<DEL>\t.\tPASS\tSVLEN=-500\n"
+    "chr1\t40\t.\tA\tAT,<INS>\t.\tPASS\t.\r\n"
+    "chr1\t50\t.\tAC\tG\t.\tPASS\t."
+)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1 << 22])
+def test_bytes_parser_handles_lines_across_chunks(chunk_size):
+    ins_del = InsDelAccumulator()
+
+    assert ins_del.update_from_bytes(io.BytesIO(VCF.encode()), chunk_size=chunk_size) == 5
+    assert (ins_del.total_ins, ins_del.total_del) == (4, 4 + 3 + 1)
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_sum_ins_del(tmp_path, fast):
+    path = tmp_path / "svs.vcf"
+    path.write_text(VCF + "\n")
+
+    assert sum_ins_del(str(path), fast=fast) == (4, 8)
@@ -0,0 +1,105 @@
+import json
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import pandas as pd
+import pysam
+import pytest
+
+import truvariBench_summary_plot as bench
+
+
+HEADER = """##fileformat=VCFv4.2
+##contig=<ID=chr1,length=1000000>
+##INFO=<ID=SVTYPE,Number=1,Type=String,Description="SV type">
+##INFO=<ID=SVLEN,Number=.,Type=Integer,Description="SV length">
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO
+"""
+
+# truvari output vcf -> (SVTYPE, SVLEN) of its records
+BENCH_RECORDS = {
+    "tp-base.vcf": [("INS", 60), ("DEL", -200), ("INS", 20)],
+    "tp-comp.vcf": [("INS", 60), ("DEL", -200)],
+    "fp.vcf": [("INS", 5000)],
+    "fn.vcf": [("DEL", -20000), ("INS", 70)],
+}
+
+
+def write_bench_dir(directory):
+    directory.mkdir()
+    for name, records in BENCH_RECORDS.items():
+        lines = [f"chr1\t{100 * (i + 1)}\t.\tN\t<{svtype}>\t.\tPASS\tSVTYPE={svtype};SVLEN={svlen}\n"
+                 for i, (svtype, svlen) in enumerate(records)]
+        with open(directory / name, "w") as f:
+            f.write(HEADER + "".join(lines))
+        pysam.tabix_index(str(directory / name), preset="vcf", force=True)
+    return str(directory)
+
+
+def row(df, svtype, size_bin):
+    rows = df[(df["svtype"] == svtype) & (df["size_bin"] == size_bin)]
+    assert len(rows) == 1
+    return rows.iloc[0]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_stratified_metrics(tmp_path, monkeypatch, workers):
+    dirs = [write_bench_dir(tmp_path / "bench_S1_hifiasm"), write_bench_dir(tmp_path / "bench_S2_hifiasm")]
+    (tmp_path / "bench_S3_hifiasm").mkdir()
+    monkeypatch.chdir(tmp_path)
+
+    df = bench.stratified_metrics(dirs + [str(tmp_path / "bench_S3_hifiasm")], "coh", workers=workers)
+
+    assert sorted(df["sample"].unique()) == ["coh_S1", "coh_S2"]
+    assert (tmp_path / "coh_truvariBench_stratified.csv").exists()
+    df = df[df["sample"] == "coh_S1"]
+    assert len(df) == 3 * (len(bench.SIZE_LABELS) + 1)
+
+    ins = row(df, "INS", "50-100bp")
+    assert (ins["TP-base"], ins["TP-comp"], ins["FP"], ins["FN"]) == (1, 1, 0, 1)
+    assert (ins["precision"], ins["recall"]) == (1, 0.5)
+
+    assert (row(df, "DEL", ">10kb")["FN"], row(df, "DEL", ">10kb")["recall"]) == (1, 0)
+    assert row(df, "INS", "1kb-10kb")["precision"] == 0
+
+    # the 20bp INS is below every size bin
+    total = row(df, "ALL", "ALL")
+    assert (total["TP-base"], total["TP-comp"], total["FP"], total["FN"]) == (2, 2, 1, 2)
+    assert total["precision"] == pytest.approx(2 / 3)
+    assert total["f1"] == pytest.approx(2 * (2 / 3) * 0.5 / (2 / 3 + 0.5))
+
+
+def test_stratum_metrics_without_calls():
+    assert bench.stratum_metrics({"TP-base": 0, "TP-comp": 0, "FP": 0, "FN": 0}) == {
+        "TP-base": 0, "TP-comp": 0, "FP": 0, "FN": 0, "precision": 0, "recall": 0, "f1": 0}
+
+
+def write_fn_fp_dir(directory, seed):
+    """ a bench directory with sequence resolved fp and fn vcfs, and a summary.json for odd seeds """
+    directory.mkdir()
+    for name, size in [("fp.vcf", 10 + seed), ("fn.vcf", 100 + seed)]:
+        lines = [f"chr1\t100\t.\tA\tA{'C' * size}\t.\tPASS\t.\n", f"chr1\t900\t.\tA{'G' * (seed + 1)}\tA\t.\tPASS\t.\n"]
+        with open(directory / name, "w") as f:
+            f.write(HEADER + "".join(lines))
+        pysam.tabix_index(str(directory / name), preset="vcf", force=True)
+    if seed % 2:
+        with open(directory / "summary.json", "w") as f:
+            json.dump({"TP-base": seed, "TP-comp": seed + 1, "FP": 2, "FN": 3, "precision": 0.5, "recall": seed / 10, "f1": 0.4}, f)
+    return str(directory)
+
+
+def test_directories_give_the_same_frames_on_a_process_pool(tmp_path, monkeypatch):
+    dirs = [write_fn_fp_dir(tmp_path / f"bench_S{seed}_hifiasm", seed) for seed in range(6)]
+    monkeypatch.chdir(tmp_path)
+
+    serial = bench.load_jsons(dirs, "coh"), bench.count_bps_fn_fp(dirs, "coh")
+    parallel = bench.load_jsons(dirs, "coh", workers=2), bench.count_bps_fn_fp(dirs, "coh", workers=2)
+
+    for expected, frame in zip(serial, parallel):
+        pd.testing.assert_frame_equal(frame, expected)
+    metrics, totals = parallel
+    assert metrics["sample"].tolist() == ["coh_S1", "coh_S3", "coh_S5"]
+    assert totals["sample"].tolist() == [f"coh_S{seed}" for seed in range(6) for _ in range(2)]
+    assert totals[["ins_bp", "del_bp"]].values.tolist() == [[bp, seed + 1] for seed in range(6) for bp in (10 + seed, 100 + seed)]
@@ -0,0 +1,168 @@
+import numpy as np
+import pysam
+import pytest
+
+import vcf_scan
+from vcf_scan import LengthAccumulator
+
+HEADER = """##fileformat=VCFv4.2
+##contig=<ID=chr1,length=1000000>
+##INFO=<ID=SVTYPE,Number=1,Type=String,Description="SV type">
+##INFO=<ID=SVLEN,Number=.,Type=Integer,Description="SV length">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	A	B
+"""
+
+
+def write_vcf(path, num_records=500, seed=0, bgzip=False):
+    """ sequence resolved INS/DEL, multi-allelic and symbolic records with SVLEN on some """
+    rng = np.random.default_rng(seed)
+    lines = []
+    for i in range(num_records):
+        size = int(rng.integers(1, 300))
+        gts = "\t".join(rng.choice(["0/0", "0/1", "1|1", "./.", "1"], 2))
+        if i % 5 == 0:
+            ref, alt, info = "N", "<DEL>", f"SVTYPE=DEL;SVLEN=-{size}"
+        elif i % 5 == 1:
+            ref, alt, info = "A" * (size + 1), "A", f"SVTYPE=DEL;SVLEN=-{size}"
+        elif i % 5 == 2:
+            ref, alt, info = "A", "A" + "C" * size + ",AG", "SVTYPE=INS"
+        else:
+            ref, alt, info = "A", "A" + "T" * size, f"SVTYPE=INS;SVLEN={size}"
+        lines.append(f"chr1\t{1 + i * 1000}\t.\t{ref}\t{alt}\t.\tPASS\t{info}\tGT\t{gts}\n")
+    with open(path, "w") as f:
+        f.write(HEADER + "".join(lines))
+    if bgzip:
+        return pysam.tabix_index(str(path), preset="vcf", force=True)
+    return str(path)
+
+
+def test_exact_lengths_keep_their_order_across_growth_and_merges():
+    lengths = np.random.default_rng(0).integers(-10_000, 10_000, 5000)
+    first, second = LengthAccumulator(), LengthAccumulator()
+    for chunk in np.array_split(lengths[:3000], 7):
+        first.extend(chunk)
+    second.extend(lengths[3000:])
+
+    first.merge(second)
+
+    assert len(first) == 5000
+    assert first.values().tolist() == lengths.tolist()
+
+
+def test_sketch_bins_hold_their_lengths():
+    lengths = np.array([-1_000_000, -50, -3, 0, 0, 1, 7, 10, 11, 99, 5_000, 5_001, 2_000_000])
+    sketch = LengthAccumulator(sketch=True)
+    sketch.extend(lengths)
+
+    low, high, counts = sketch.histogram()
+
+    assert counts.sum() == len(lengths) == len(sketch)
+    # every length falls in a non-empty bin, the same bin as an exact accumulator's histogram
+    for length in lengths:
+        assert ((low <= length) & (length < high)).sum() == 1
+    exact = LengthAccumulator()
+    exact.extend(lengths)
+    assert all((a == b).all() for a, b in zip(exact.histogram(), (low, high, counts)))
+    # one bin per value up to 10bp, bins ~12% wide past the rounding of the small edges
+    assert high[low == 7] - 7 == 1
+    assert all((h - l) / l <= 0.13 for l, h in zip(low, high) if l >= 20)
+
+
+def test_sketches_merge_and_do_not_mix_with_exact_lengths():
+    a, b = LengthAccumulator(sketch=True), LengthAccumulator(sketch=True)
+    a.extend([5, 500])
+    b.extend([500, -20])
+    a.merge(b)
+    assert len(a) == 4
+    assert a.histogram()[2].tolist() == [1, 1, 2]
+
+    with pytest.raises(ValueError):
+        LengthAccumulator().merge(a)
+    with pytest.raises(ValueError):
+        a.values()
+
+
+@pytest.mark.parametrize("sketch", [False, True])
+def test_plot_values_are_evenly_spaced_quantiles(sketch):
+    lengths = np.arange(1, 100_001)
+    accumulator = LengthAccumulator(sketch=sketch)
+    accumulator.extend(lengths)
+
+    values = accumulator.plot_values(101)
+
+    assert len(values) == 101
+    assert (np.diff(values) >= 0).all()
+    # within a sketch bin of the true quantiles
+    quantiles = np.quantile(lengths, np.linspace(0, 1, 101))
+    assert np.allclose(values, quantiles, rtol=0.13, atol=1)
+
+
+def test_svtype_accumulator_merges_in_order_of_first_appearance():
+    class Block:
+        def __init__(self, svtype, svlen):
+            self.svtype, self.svlen = svtype, svlen
+
+    first, second = vcf_scan.SvTypeAccumulator(), vcf_scan.SvTypeAccumulator()
+    first.update(Block(["INS", "DEL", "INS"], [10, -20, 30]))
+    second.update(Block(["DUP", "INS"], [400, 50]))
+    first.merge(second)
+
+    assert list(first.svTypes) == ["INS", "DEL", "DUP"]
+    assert first.svTypes["INS"]["count"] == 3
+    assert first.svTypes["INS"]["lengths"].values().tolist() == [10, 30, 50]
+
+
+@pytest.mark.parametrize("bgzip", [False, True])
+def test_one_scan_feeds_every_accumulator_like_pysam_records(tmp_path, bgzip):
+    path = write_vcf(tmp_path / "svs.vcf", bgzip=bgzip)
+    scanner = vcf_scan.VcfScanner(path, batch_size=64)
+    ins_del = scanner.register(vcf_scan.InsDelAccumulator())
+    svtypes = scanner.register(vcf_scan.SvTypeAccumulator())
+    alleles = scanner.register(vcf_scan.AlleleCountAccumulator(scanner.samples))
+
+    assert scanner.run() == 500
+
+    expected_ins_del, expected_svtypes = vcf_scan.InsDelAccumulator(), vcf_scan.SvTypeAccumulator()
+    expected_alleles = vcf_scan.AlleleCountAccumulator(["A", "B"])
+    with pysam.VariantFile(path) as vcf_file:
+        for block in vcf_scan.record_blocks(vcf_file, 2, batch_size=100):
+            for accumulator in (expected_ins_del, expected_svtypes, expected_alleles):
+                accumulator.update(block)
+
+    assert scanner.samples == ["A", "B"]
+    assert (ins_del.total_ins, ins_del.total_del) == (expected_ins_del.total_ins, expected_ins_del.total_del)
+    assert list(svtypes.svTypes) == list(expected_svtypes.svTypes) == ["DEL", "INS"]
+    for svtype, entry in expected_svtypes.svTypes.items():
+        assert svtypes.svTypes[svtype]["lengths"].values().tolist() == entry["lengths"].values().tolist()
+    assert alleles.variant_counts() == expected_alleles.variant_counts()
+
+
+def test_bytes_fast_path_matches_the_decoded_totals(tmp_path):
+    path = write_vcf(tmp_path / "svs.vcf", bgzip=True)
+    totals = []
+    for fast in (True, False):
+        scanner = vcf_scan.VcfScanner(path, fast=fast)
+        ins_del = scanner.register(vcf_scan.InsDelAccumulator())
+        assert scanner.run() == 500
+        totals.append((ins_del.total_ins, ins_del.total_del))
+
+    assert totals[0] == totals[1]
+    assert totals[0][0] > 0 and totals[0][1] > 0
+
+
+def test_headerless_vcf_keeps_its_first_record(tmp_path):
+    path = tmp_path / "svs.vcf"
+    write_vcf(path, num_records=20)
+    lines = open(path).read().splitlines(keepends=True)
+    with open(path, "w") as f:
+        f.writelines(line for line in lines if not line.startswith("#"))
+
+    scanner = vcf_scan.VcfScanner(str(path), fast=False)
+    svtypes = scanner.register(vcf_scan.SvTypeAccumulator())
+    ins_del = scanner.register(vcf_scan.InsDelAccumulator())
+
+    assert scanner.samples == []
+    assert scanner.run() == 20
+    assert {svtype: len(entry["lengths"]) for svtype, entry in svtypes.svTypes.items()} == {"DEL": 8, "INS": 12}
+    assert ins_del.total_del > 0
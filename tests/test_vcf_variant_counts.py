@@ -0,0 +1,252 @@
+import matplotlib
+
+matplotlib.use("Agg")
+
+import os
+
+import numpy as np
+import pysam
+import pytest
+
+import vcf_scan
+import vcf_variant_counts
+
+HEADER = """##fileformat=VCFv4.2
+##contig=<ID=chr1,length=1000000>
+##contig=<ID=chr2,length=1000000>
+##INFO=<ID=SVTYPE,Number=1,Type=String,Description="SV type">
+##INFO=<ID=SVLEN,Number=.,Type=Integer,Description="SV length">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Depth">
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	A	B	C
+"""
+
+# multi-allelic, haploid, missing, no GT, triploid and GT after another FORMAT field
+ODD_RECORDS = """chr1	10	.	A	T,G	.	PASS	SVTYPE=SNV	GT:DP	0/1:3	1|2:4	./.:5
+chr1	20	.	A	T	.	PASS	SVTYPE=SNV	GT	1	0/1	.
+chr1	30	.	A	T	.	PASS	SVTYPE=SNV	DP	3	4	5
+chr2	40	.	A	T	.	PASS	SVTYPE=SNV	GT:DP	./1:3	1/1/1:4	0/0:.
+chr2	50	.	A	T	.	PASS	SVTYPE=SNV	DP:GT	3:0/1	4:1/1	.:.
+"""
+ODD_COUNTS = {"A": 4, "B": 8, "C": 0}
+
+
+def write_vcf(path, records, index=True):
+    """ the vcf at path, bgzipped and tabix indexed unless index is False """
+    with open(path, "w") as f:
+        f.write(HEADER + records)
+    if not index:
+        return str(path)
+    return pysam.tabix_index(str(path), preset="vcf", force=True)
+
+
+def test_record_genotypes_match_the_text_decoder(tmp_path):
+    path = write_vcf(tmp_path / "odd.vcf", ODD_RECORDS, index=False)
+    with pysam.VariantFile(path) as vcf_file:
+        records = list(vcf_file)
+    with open(path) as f:
+        text_blocks = list(vcf_scan.text_blocks(f, 3, batch_size=2))
+
+    for text_block, i in zip(text_blocks, range(0, len(records), 2)):
+        genotypes = vcf_scan.RecordBlock(records[i:i+2], 3).genotypes
+        assert genotypes.dtype == text_block.genotypes.dtype
+        assert genotypes.tolist() == text_block.genotypes.tolist()
+
+    block = vcf_scan.RecordBlock(records, 3)
+    assert block.genotypes.shape == (5, 3, 3)
+    assert block.genotypes[4].tolist() == [[0, 1, -1], [1, 1, -1], [-1, -1, -1]]
+    assert block.alt_dosage.sum(axis=0).tolist() == list(ODD_COUNTS.values())
+
+
+def test_count_region_counts_the_alt_alleles_of_every_sample(tmp_path):
+    path = write_vcf(tmp_path / "odd.vcf", ODD_RECORDS)
+
+    num_records, variant_counts, svTypes, _ = vcf_variant_counts.count_region(path, "chr2", 0, None, batch_size=1)
+
+    assert num_records == 2
+    assert variant_counts == {"A": 2, "B": 5, "C": 0}
+    assert svTypes["SNV"]["count"] == 2
+
+
+def sv_records(num_records=400, num_samples=3, seed=0):
+    """ INS/DEL records over chr1 and chr2 with random diploid, haploid and missing genotypes """
+    rng = np.random.default_rng(seed)
+    genotypes = np.array(["0/0", "0/1", "1|1", "./.", "./1", "1", "."])
+    lines = []
+    for i in range(num_records):
+        chrom = "chr1" if i < num_records // 2 else "chr2"
+        pos = 1 + (i % (num_records // 2)) * 4000
+        svtype = "INS" if i % 3 else "DEL"
+        svlen = int(rng.integers(50, 5000)) * (1 if svtype == "INS" else -1)
+        sample_gts = "\t".join(genotypes[rng.integers(0, len(genotypes), num_samples)])
+        lines.append(f"{chrom}\t{pos}\t.\tN\t<{svtype}>\t.\tPASS\tSVTYPE={svtype};SVLEN={svlen}\tGT\t{sample_gts}\n")
+    return "".join(lines)
+
+
+def assert_same_counts(result, expected):
+    (counts, svTypes), (expected_counts, expected_svTypes) = result, expected
+    assert counts.to_dict("records") == expected_counts.to_dict("records")
+    assert list(svTypes) == list(expected_svTypes)
+    for svtype, entry in expected_svTypes.items():
+        assert svTypes[svtype]["count"] == entry["count"]
+        assert svTypes[svtype]["lengths"].values().tolist() == entry["lengths"].values().tolist()
+
+
+def test_genotype_codes_round_trip_through_the_packing():
+    codes = np.random.default_rng(1).integers(0, 4, (7, 11)).astype(np.uint8)
+    packed = vcf_variant_counts.pack_codes(codes)
+    assert packed.shape == (7, 3)
+    assert (vcf_variant_counts.unpack_codes(packed, 11) == codes).all()
+
+
+def test_genotype_codes_keep_missing_apart_from_hom_ref(tmp_path):
+    path = write_vcf(tmp_path / "odd.vcf", ODD_RECORDS, index=False)
+    with pysam.VariantFile(path) as vcf_file:
+        block = vcf_scan.RecordBlock(list(vcf_file)[:3], 3)
+
+    codes = vcf_variant_counts.genotype_codes(block)
+
+    assert codes.tolist() == [[1, 2, 3], [1, 1, 3], [3, 3, 3]]
+    assert vcf_variant_counts.code_dosage(codes).sum(axis=0).tolist() == [2, 3, 0]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_genotype_cache_round_trip(tmp_path, workers):
+    path = write_vcf(tmp_path / "svs.vcf", sv_records())
+    cache_dir = str(tmp_path / "cache")
+    expected = vcf_variant_counts.vcfEntriesPerSample(path)
+
+    written = vcf_variant_counts.vcfEntriesPerSample(path, workers=workers, shard_size=100_000, genotype_cache=cache_dir)
+    cache_path = vcf_variant_counts.genotype_cache_path(cache_dir, path, vcf_variant_counts.vcf_cache_key(path))
+    loaded = vcf_variant_counts.load_genotype_cache(cache_path, vcf_variant_counts.vcf_cache_key(path))
+    reread = vcf_variant_counts.vcfEntriesPerSample(path, genotype_cache=cache_dir)
+
+    assert_same_counts(written, expected)
+    assert_same_counts(reread, expected)
+    assert loaded[0] == 400
+    # one shard per region of every contig with workers
+    num_shards = len([name for name in os.listdir(cache_path) if name.startswith("shard_")])
+    assert num_shards == (20 if workers > 1 else 1)
+
+
+def test_genotypes_above_two_alt_alleles_are_not_cached(tmp_path):
+    path = write_vcf(tmp_path / "odd.vcf", ODD_RECORDS)
+    cache_dir = str(tmp_path / "cache")
+
+    vcf_variant_counts.vcfEntriesPerSample(path, genotype_cache=cache_dir)
+
+    cache_path = vcf_variant_counts.genotype_cache_path(cache_dir, path, vcf_variant_counts.vcf_cache_key(path))
+    assert vcf_variant_counts.load_genotype_cache(cache_path, vcf_variant_counts.vcf_cache_key(path)) is None
+
+
+def sequence_records(num_records=300, seed=2):
+    """ sequence resolved INS/DEL and SNV records, and DELs with an END far past their start """
+    rng = np.random.default_rng(seed)
+    lines = []
+    for i in range(num_records):
+        chrom = "chr1" if i < num_records // 2 else "chr2"
+        pos = 1 + (i % (num_records // 2)) * 5000
+        gts = "\t".join(rng.choice(["0/0", "0/1", "1/1", "./."], 3))
+        if i % 10 == 0:
+            # spans several 100kb regions, counted only in the one it starts in
+            lines.append(f"{chrom}\t{pos}\t.\tN\t<DEL>\t.\tPASS\tSVTYPE=DEL;SVLEN=-250000;END={pos + 250000}\tGT\t{gts}\n")
+            continue
+        size = int(rng.integers(1, 80))
+        ref, alt = ("A", "A" + "T" * size) if i % 3 else ("A" + "G" * size, "A")
+        svtype = "INS" if i % 3 else "DEL"
+        if i % 7 == 0:
+            ref, alt, svtype = "A", "C", "SNV"
+        lines.append(f"{chrom}\t{pos}\t.\t{ref}\t{alt}\t.\tPASS\tSVTYPE={svtype}\tGT\t{gts}\n")
+    return "".join(lines)
+
+
+def test_region_shards_cover_every_contig_in_file_order(tmp_path):
+    path = write_vcf(tmp_path / "svs.vcf", sv_records())
+    with pysam.VariantFile(path) as vcf_file:
+        shards = vcf_variant_counts.region_shards(vcf_file, 300_000)
+        whole = vcf_variant_counts.region_shards(vcf_file, 0)
+
+    assert shards[:4] == [("chr1", 0, 300_000), ("chr1", 300_000, 600_000), ("chr1", 600_000, 900_000), ("chr1", 900_000, None)]
+    assert [shard[0] for shard in shards] == ["chr1"] * 4 + ["chr2"] * 4
+    assert whole == [("chr1", 0, None), ("chr2", 0, None)]
+
+
+@pytest.mark.parametrize("shard_size", [0, 100_000])
+def test_sharded_counts_match_a_serial_pass(tmp_path, monkeypatch, shard_size):
+    path = write_vcf(tmp_path / "seq.vcf", sequence_records())
+    written = {}
+    monkeypatch.setattr(vcf_variant_counts, "write_ins_del", lambda in_vcf, counter: written.setdefault(in_vcf, []).append((counter.total_ins, counter.total_del)))
+
+    serial = vcf_variant_counts.vcfEntriesPerSample(path, ins_del=True)
+    sharded = vcf_variant_counts.vcfEntriesPerSample(path, workers=3, shard_size=shard_size, ins_del=True)
+
+    assert_same_counts(sharded, serial)
+    assert sum(entry["count"] for entry in sharded[1].values()) == 300
+    # records spanning regions are counted once, so the INS/DEL totals agree too
+    assert written[path][0] == written[path][1]
+
+
+def test_serial_run_resumes_from_its_last_checkpoint(tmp_path, monkeypatch):
+    path = write_vcf(tmp_path / "seq.vcf", sequence_records())
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    ins_del = []
+    monkeypatch.setattr(vcf_variant_counts, "write_ins_del", lambda in_vcf, counter: ins_del.append((counter.total_ins, counter.total_del)))
+    expected = vcf_variant_counts.vcfEntriesPerSample(path, ins_del=True)
+
+    # killed right after its second checkpoint
+    write_checkpoint = vcf_variant_counts.write_checkpoint
+    checkpoints = []
+
+    def killed_after_two(state_path, state):
+        write_checkpoint(state_path, state)
+        checkpoints.append(state["num_records"])
+        if len(checkpoints) == 2:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(vcf_variant_counts, "write_checkpoint", killed_after_two)
+    with pytest.raises(KeyboardInterrupt):
+        vcf_variant_counts.vcfEntriesPerSample(path, batch_size=10, checkpoint_dir=checkpoint_dir, checkpoint_every=50, ins_del=True)
+    assert checkpoints == [50, 100]
+
+    monkeypatch.setattr(vcf_variant_counts, "write_checkpoint", write_checkpoint)
+    resumed = vcf_variant_counts.vcfEntriesPerSample(path, batch_size=10, checkpoint_dir=checkpoint_dir, checkpoint_every=50, resume=True, ins_del=True)
+
+    assert_same_counts(resumed, expected)
+    # the killed run wrote no INS/DEL totals, the resumed one the same as a full pass
+    assert ins_del[0] == ins_del[1]
+    # a finished pass leaves no checkpoint to resume from
+    assert os.listdir(checkpoint_dir) == []
+
+
+def test_sharded_run_loads_finished_regions(tmp_path):
+    path = write_vcf(tmp_path / "svs.vcf", sv_records())
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    os.makedirs(checkpoint_dir)
+    key = vcf_variant_counts.vcf_cache_key(path)
+    with pysam.VariantFile(path) as vcf_file:
+        shards = vcf_variant_counts.region_shards(vcf_file, 300_000)
+    expected = vcf_variant_counts.vcfEntriesPerSample(path)
+
+    # the first region finished before the run was killed, its saved counts are marked
+    result = vcf_variant_counts.count_region(path, *shards[0])
+    result[1]["A"] += 1000
+    config = {"mode": "shards", "length_sketch": False, "ins_del": False, "shards": shards}
+    vcf_variant_counts.write_checkpoint(os.path.join(checkpoint_dir, "shard_000000.pkl"), {"key": key, "config": config, "result": result})
+
+    counts, svTypes = vcf_variant_counts.vcfEntriesPerSample(path, workers=2, shard_size=300_000, checkpoint_dir=checkpoint_dir, resume=True)
+
+    expected_counts = expected[0].set_index("Sample")["VariantCount"]
+    assert counts.set_index("Sample")["VariantCount"].to_dict() == {**expected_counts.to_dict(), "A": expected_counts["A"] + 1000}
+    assert list(svTypes) == list(expected[1])
+    assert os.listdir(checkpoint_dir) == []
+
+
+def test_checkpoint_of_other_options_is_not_resumed(tmp_path):
+    path = write_vcf(tmp_path / "svs.vcf", sv_records())
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    os.makedirs(checkpoint_dir)
+    state = {"key": vcf_variant_counts.vcf_cache_key(path), "config": {"mode": "serial", "length_sketch": True, "extra": []}}
+    vcf_variant_counts.write_checkpoint(os.path.join(checkpoint_dir, "state.pkl"), state)
+
+    with pytest.raises(SystemExit):
+        vcf_variant_counts.vcfEntriesPerSample(path, checkpoint_dir=checkpoint_dir, resume=True)